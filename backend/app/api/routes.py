@@ -7,29 +7,37 @@ import os
 import uuid
 import logging
 
-from fastapi import APIRouter, HTTPException, Depends, Request, Body
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, Request, Body
 from sqlmodel import Session, select
 
 from app.data import SERVICES, PROS, SERVICE_BY_ID, PRO_BY_ID
 from app.models import (
     SlotsQuery, SlotsOut,
-    Reservation, CancelReservationIn, ActionResult,
+    CancelReservationIn, ActionResult,
     RescheduleIn, RescheduleOut, ReservationIn,
     ReservationDB,
     DaysAvailabilityIn, DaysAvailabilityOut,
+    NextSlotsIn, NextSlotsOut,
+    SlotsBatchIn, SlotsBatchOut, SlotsBatchItemOut,
 )
 from app.services.logic import (
-    find_available_slots,
+    find_available_slots_detailed,
+    find_available_slots_batch,
+    pros_from_mask,
+    is_start_available,
+    find_available_days,
+    find_next_slots,
     find_reservation, cancel_reservation,
     apply_reschedule,
-    create_gcal_reservation,
-    patch_gcal_reservation,
-    delete_gcal_reservation,
-    get_calendar_for_professional,
+    invalidate_availability,
     sync_from_gcal_range,
+    sync_from_gcal_incremental,
     reconcile_db_to_gcal_range,
     detect_conflicts_range,
 )
+from app.services.outbox import enqueue_gcal_upsert, notify_worker, drain_outbox, outbox_stats, retry_dead
+from app.services.conflict_reports import refresh_conflict_reports, get_conflict_report
+from app.services.gcal_watch import ensure_channels, stop_channels, handle_notification, queue_calendar_sync, run_calendar_sync, UnknownChannel, InvalidChannelToken
 from app.db import get_session, engine
 from app.utils.date import validate_target_dt, TZ, now_tz, MAX_AHEAD_DAYS
 from datetime import timezone as _utc_tz
@@ -80,7 +88,23 @@ def readiness():
     except Exception as e:
         status["gcal"] = f"error: {e}"
     ok = all(v == "ok" for v in status.values())
-    return {"ok": ok, **status}
+    # Informativo: con el circuito abierto la API sigue sirviendo con datos locales.
+    from app.integrations.circuit_breaker import gcal_breaker
+    return {"ok": ok, **status, "gcal_circuit": gcal_breaker.state}
+
+@router.get("/metrics", tags=["monitor"])
+def metrics(session: Session = Depends(get_session), _=Depends(require_api_key)):
+    # Mismo X-API-Key que /admin/*: expone cola del outbox, cachés y el último error de Google.
+    from app.services.availability_cache import availability_cache
+    from app.integrations.freebusy_cache import freebusy_cache
+    from app.integrations.rate_limit import gcal_throttle
+    from app.integrations.circuit_breaker import gcal_breaker
+    from app.integrations.google_calendar import fake_calendar_stats
+    out = {"availability_cache": availability_cache.stats(), "freebusy_cache": freebusy_cache.stats(), "gcal_rate_limit": gcal_throttle.stats(), "gcal_circuit": gcal_breaker.stats(), "gcal_outbox": outbox_stats(session)}
+    fake = fake_calendar_stats()
+    if fake is not None:
+        out["gcal_fake"] = fake
+    return out
 
 @router.get("/")
 def home():
@@ -88,7 +112,7 @@ def home():
         "status": "ok",
         "try": [
             "/health", "/docs",
-            "/services", "/professionals", "/slots",
+            "/services", "/professionals", "/slots", "/slots/next (POST)", "/slots/batch (POST)",
             "/reservations", "/cancel_reservation (POST)",
             "/reservations/{reservation_id} (DELETE)",
             "/reschedule (POST)",
@@ -154,11 +178,6 @@ def cancel_reservation_post(payload: dict | None = Body(None), session: Session
     r = find_reservation(session, payload.reservation_id)
     if not r:
         raise HTTPException(status_code=404, detail="La reserva no existe")
-    if r.google_event_id:
-        try:
-            delete_gcal_reservation(r.google_event_id, r.google_calendar_id or GCAL_CALENDAR_ID)
-        except Exception as e:
-            raise HTTPException(status_code=502, detail=f"No se pudo borrar en Google Calendar: {e}")
     ok = cancel_reservation(session, payload.reservation_id)
     if ok:
         logger.info("Reservation cancelled: id=%s", payload.reservation_id)
@@ -171,11 +190,6 @@ def cancel_reservation_delete(reservation_id: str, session: Session = Depends(ge
     r = find_reservation(session, reservation_id)
     if not r:
         raise HTTPException(status_code=404, detail="La reserva no existe")
-    if r.google_event_id:
-        try:
-            delete_gcal_reservation(r.google_event_id, r.google_calendar_id or GCAL_CALENDAR_ID)
-        except Exception as e:
-            raise HTTPException(status_code=502, detail=f"No se pudo borrar en Google Calendar: {e}")
     ok = cancel_reservation(session, reservation_id)
     if ok:
         logger.info("Reservation cancelled: id=%s", reservation_id)
@@ -214,26 +228,10 @@ def reschedule_post(payload: dict | None = Body(None), session: Session = Depend
             raise HTTPException(status_code=400, detail="Fecha/hora inválidas (formato).")
         except Exception as e:
             raise HTTPException(status_code=400, detail=str(e))
-    old_start, old_end, old_pro, old_cal = r_prev.start, r_prev.end, r_prev.professional_id, r_prev.google_calendar_id
     ok, msg, r = apply_reschedule(session, payload)
     if not ok or not r:
         raise HTTPException(status_code=400, detail=msg)
     message_out = msg if (isinstance(msg, str) and "Reprogramada" in msg) else f"Reprogramada: {msg}"
-    if r.google_event_id:
-        try:
-            new_cal = get_calendar_for_professional(r.professional_id)
-            if old_cal and old_cal != new_cal:
-                delete_gcal_reservation(r.google_event_id, old_cal)
-                gnew = create_gcal_reservation(Reservation(id=r.id, service_id=r.service_id, professional_id=r.professional_id, start=r.start, end=r.end, google_event_id=r.google_event_id, google_calendar_id=new_cal), calendar_id=new_cal)
-                r.google_event_id = gnew.get("id"); r.google_calendar_id = new_cal
-            else:
-                patch_gcal_reservation(r.google_event_id, r.start, r.end, old_cal or new_cal)
-                r.google_calendar_id = old_cal or new_cal
-            session.add(r); session.commit(); session.refresh(r)
-        except Exception as e:
-            r.start, r.end, r.professional_id, r.google_calendar_id = old_start, old_end, old_pro, old_cal
-            session.add(r); session.commit()
-            raise HTTPException(status_code=502, detail=f"No se pudo reprogramar en Google Calendar: {e}")
     logger.info("Reservation rescheduled: id=%s start=%s end=%s pro=%s", r.id, r.start.isoformat(), r.end.isoformat(), r.professional_id)
     return RescheduleOut(ok=True, message=message_out, reservation_id=r.id, start=r.start.isoformat(), end=r.end.isoformat())
 
@@ -243,9 +241,7 @@ def reschedule_post_alias(payload: dict | None = Body(None), session: Session =
         raise HTTPException(status_code=422, detail="Payload requerido")
     return reschedule_post(payload, session, _)
 
-@router.post("/slots", response_model=SlotsOut)
-def get_slots(q: SlotsQuery, session: Session = Depends(get_session)):
-    logger.info("Slots query: service=%s date=%s pro=%s", q.service_id, q.date_str, q.professional_id)
+def _validate_slots_query(q: SlotsQuery):
     try:
         d = datetime.strptime(q.date_str, "%Y-%m-%d").date()
     except ValueError:
@@ -261,13 +257,45 @@ def get_slots(q: SlotsQuery, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="service_id no existe")
     if q.professional_id and q.professional_id not in PRO_BY_ID:
         raise HTTPException(status_code=404, detail="professional_id no existe")
-    avail = find_available_slots(session, q.service_id, d, q.professional_id, use_gcal_busy_override=q.use_gcal)
+    return d
+
+def _drop_past(d, avail):
     # Filtrar horas ya pasadas si es el día de hoy
-    if d == today:
+    if d == now_tz().date():
         now_local = now_tz().replace(tzinfo=None)
-        avail = [dt for dt in avail if dt >= now_local]
-    return SlotsOut(service_id=q.service_id, date=d, professional_id=q.professional_id, slots=[dt.isoformat() for dt in avail])
+        return [(dt, who) for dt, who in avail if dt >= now_local]
+    return avail
 
+@router.post("/slots", response_model=SlotsOut)
+def get_slots(q: SlotsQuery, session: Session = Depends(get_session)):
+    logger.info("Slots query: service=%s date=%s pro=%s", q.service_id, q.date_str, q.professional_id)
+    d = _validate_slots_query(q)
+    avail = _drop_past(d, find_available_slots_detailed(session, q.service_id, d, q.professional_id, use_gcal_busy_override=q.use_gcal))
+    return SlotsOut(
+        service_id=q.service_id, date=d, professional_id=q.professional_id,
+        slots=[dt.isoformat() for dt, _ in avail],
+        free_professionals={dt.isoformat(): pros_from_mask(who) for dt, who in avail},
+    )
+
+@router.post("/slots/batch", response_model=SlotsBatchOut)
+def get_slots_batch(body: SlotsBatchIn, session: Session = Depends(get_session)):
+    logger.info("Slots batch: %s queries", len(body.queries))
+    items: list[SlotsBatchItemOut] = []
+    valid: list[tuple[int, tuple]] = []
+    for q in body.queries:
+        item = SlotsBatchItemOut(service_id=q.service_id, date_str=q.date_str, professional_id=q.professional_id)
+        try:
+            d = _validate_slots_query(q)
+            valid.append((len(items), (q.service_id, d, q.professional_id, q.use_gcal)))
+        except HTTPException as e:
+            item.error = str(e.detail)
+        items.append(item)
+    answers = find_available_slots_batch(session, [key for _, key in valid])
+    for (idx, key), avail in zip(valid, answers):
+        avail = _drop_past(key[1], avail)
+        items[idx].slots = [dt.isoformat() for dt, _ in avail]
+        items[idx].free_professionals = {dt.isoformat(): pros_from_mask(who) for dt, who in avail}
+    return SlotsBatchOut(results=items)
 
 @router.post("/slots/days", response_model=DaysAvailabilityOut)
 def get_days_availability(body: DaysAvailabilityIn, session: Session = Depends(get_session)):
@@ -281,23 +309,28 @@ def get_days_availability(body: DaysAvailabilityIn, session: Session = Depends(g
     if (body.end - body.start).days > 62:
         raise HTTPException(status_code=400, detail="Rango demasiado grande (máx. 62 días)")
     today = now_tz().date()
-    available_days: list[str] = []
-    d = body.start
-    while d <= body.end:
-        if d >= today and d <= today + timedelta(days=MAX_AHEAD_DAYS):
-            slots = find_available_slots(session, body.service_id, d, body.professional_id, use_gcal_busy_override=body.use_gcal)
-            if d == today:
-                now_local = now_tz().replace(tzinfo=None)
-                slots = [dt for dt in slots if dt >= now_local]
-            if slots:
-                available_days.append(d.isoformat())
-        d += timedelta(days=1)
+    start = max(body.start, today)
+    end = min(body.end, today + timedelta(days=MAX_AHEAD_DAYS))
+    days = find_available_days(session, body.service_id, start, end, body.professional_id, use_gcal_busy_override=body.use_gcal, not_before=now_tz().replace(tzinfo=None))
+    available_days = [d.isoformat() for d in days]
     return DaysAvailabilityOut(service_id=body.service_id, start=body.start, end=body.end, professional_id=body.professional_id, available_days=available_days)
 
-def _naive(dt: datetime) -> datetime:
-    if dt.tzinfo is not None:
-        return dt.replace(tzinfo=None)
-    return dt
+@router.post("/slots/next", response_model=NextSlotsOut)
+def get_next_slots(body: NextSlotsIn, session: Session = Depends(get_session)):
+    if body.service_id not in SERVICE_BY_ID:
+        raise HTTPException(status_code=404, detail="service_id no existe")
+    if body.professional_id and body.professional_id not in PRO_BY_ID:
+        raise HTTPException(status_code=404, detail="professional_id no existe")
+    now = now_tz()
+    after = body.after or now
+    if after.tzinfo is None:
+        after = after.replace(tzinfo=TZ)
+    after = max(after.astimezone(TZ), now)
+    until = now.date() + timedelta(days=MAX_AHEAD_DAYS)
+    if after.date() > until:
+        raise HTTPException(status_code=400, detail="La fecha excede el límite de 6 meses.")
+    found = find_next_slots(session, body.service_id, after.replace(tzinfo=None), body.limit, until, body.professional_id, use_gcal_busy_override=body.use_gcal)
+    return NextSlotsOut(service_id=body.service_id, professional_id=body.professional_id, after=after, slots=[dt.isoformat() for dt in found])
 
 @router.post("/reservations", response_model=ActionResult, dependencies=[Depends(require_api_key)])
 def create_reservation(payload: dict | None = Body(None), session: Session = Depends(get_session), _=Depends(require_api_key)):
@@ -321,41 +354,23 @@ def create_reservation(payload: dict | None = Body(None), session: Session = Dep
         raise HTTPException(status_code=400, detail=str(e))
     service = SERVICE_BY_ID[payload.service_id]
     end = start + timedelta(minutes=service.duration_min)
-    avail = find_available_slots(session, payload.service_id, start.date(), payload.professional_id)
-    avail_naive = [_naive(dt) for dt in avail]
-    if _naive(start) not in avail_naive:
+    if not is_start_available(session, payload.service_id, payload.professional_id, start):
         raise HTTPException(status_code=400, detail="Ese inicio no está disponible (horario o solapado). Consulta /slots.")
     res_id = str(uuid.uuid4())
-    cal_id = get_calendar_for_professional(payload.professional_id)
-    gcal_id = None
-    
-    # Intentar crear en Google Calendar, pero no fallar si no está configurado
-    try:
-        gcal_event = create_gcal_reservation(Reservation(id=res_id, service_id=payload.service_id, professional_id=payload.professional_id, start=start, end=end), calendar_id=cal_id)
-        gcal_id = gcal_event.get("id")
-        logger.info("Google Calendar event created: %s", gcal_id)
-    except Exception as e:
-        logger.warning("Google Calendar not available, creating reservation without sync: %s", e)
-        # Continuar sin Google Calendar para desarrollo
-    
+    # El evento de Google lo crea el worker del outbox: la reserva y su fila de outbox
+    # se graban juntas, así que ni se pierde la sincronización ni se espera a Google.
     try:
-        row = ReservationDB(id=res_id, service_id=payload.service_id, professional_id=payload.professional_id, start=start, end=end, google_event_id=gcal_id, google_calendar_id=cal_id)
-        session.add(row); session.commit()
+        row = ReservationDB(id=res_id, service_id=payload.service_id, professional_id=payload.professional_id, start=start, end=end)
+        session.add(row)
+        enqueue_gcal_upsert(session, res_id, new=True)
+        session.commit()
     except Exception as e:
-        try:
-            if gcal_id:
-                delete_gcal_reservation(gcal_id, cal_id)
-        except Exception:
-            pass
         raise HTTPException(status_code=500, detail=f"No se pudo guardar la reserva: {e}")
-    
-    message = f"Reserva creada exitosamente. ID: {res_id}"
-    if gcal_id:
-        message += f", Evento Google Calendar: {gcal_id}"
-    else:
-        message += " (sin sincronización con Google Calendar)"
-    
-    logger.info("Reservation created: id=%s gcal_event=%s calendar=%s start=%s end=%s", res_id, gcal_id, cal_id, start.isoformat(), end.isoformat())
+    notify_worker()
+    invalidate_availability(payload.professional_id, start, end)
+
+    message = f"Reserva creada exitosamente. ID: {res_id}, sincronización con Google Calendar en cola"
+    logger.info("Reservation created: id=%s start=%s end=%s", res_id, start.isoformat(), end.isoformat())
     return ActionResult(ok=True, message=message)
 
 # Admin
@@ -370,6 +385,8 @@ class AdminSyncIn(BaseModel):
     calendar_id: str | None = None
     professional_id: str | None = None
     default_service: str | None = None
+    # push: comprueba también las reservas cuya huella no cambió desde la última escritura.
+    force: bool | None = False
 
 @router.post("/admin/sync")
 def admin_sync(body: AdminSyncIn | None = None, session: Session = Depends(get_session), _=Depends(require_api_key)):
@@ -384,10 +401,12 @@ def admin_sync(body: AdminSyncIn | None = None, session: Session = Depends(get_s
         end = start + timedelta(days=max(0, days - 1))
     by_prof = True if body.by_professional is None else bool(body.by_professional)
     results: dict[str, dict] = {}
+    if mode == "incremental":
+        results["import"] = sync_from_gcal_incremental(session, default_service=body.default_service or "corte", professional_id=body.professional_id, calendar_id=body.calendar_id)
     if mode in ("import", "both"):
         results["import"] = sync_from_gcal_range(session, start, end, default_service=body.default_service or "corte", by_professional=by_prof, calendar_id=body.calendar_id, professional_id=body.professional_id)
     if mode in ("push", "both"):
-        results["push"] = reconcile_db_to_gcal_range(session, start, end, by_professional=by_prof, calendar_id=body.calendar_id, professional_id=body.professional_id)
+        results["push"] = reconcile_db_to_gcal_range(session, start, end, by_professional=by_prof, calendar_id=body.calendar_id, professional_id=body.professional_id, force=bool(body.force))
     return {"ok": True, "mode": mode, "range": (start.isoformat(), end.isoformat()), "results": results}
 
 class AdminConflictsIn(BaseModel):
@@ -397,6 +416,12 @@ class AdminConflictsIn(BaseModel):
     by_professional: bool | None = True
     calendar_id: str | None = None
     professional_id: str | None = None
+    sample_limit: int | None = 10
+    sample_offset: int | None = 0
+    # Por defecto se sirve el informe guardado; `refresh` lo actualiza antes (sólo días cambiados)
+    # y `live` recalcula todo contra Google sin tocar la tabla.
+    refresh: bool | None = False
+    live: bool | None = False
 
 @router.post("/admin/conflicts")
 def admin_conflicts(body: AdminConflictsIn | None = None, session: Session = Depends(get_session), _=Depends(require_api_key)):
@@ -409,7 +434,16 @@ def admin_conflicts(body: AdminConflictsIn | None = None, session: Session = Dep
         days = body.days if body.days and body.days > 0 else 7
         end = start + timedelta(days=max(0, days - 1))
     by_prof = True if body.by_professional is None else bool(body.by_professional)
-    summary = detect_conflicts_range(session, start, end, by_professional=by_prof, calendar_id=body.calendar_id, professional_id=body.professional_id)
+    limit = min(max(0, body.sample_limit if body.sample_limit is not None else 10), 1000)
+    # Los informes se guardan por profesional: un calendario suelto se calcula en vivo.
+    if by_prof and not body.live:
+        refreshed = refresh_conflict_reports(session, start, end, professional_id=body.professional_id) if body.refresh else None
+        summary = get_conflict_report(session, start, end, professional_id=body.professional_id, sample_limit=limit, sample_offset=body.sample_offset or 0)
+        if refreshed is not None:
+            summary["refresh"] = refreshed
+            summary["ok"] = bool(refreshed.get("ok"))
+        return {"ok": bool(summary.get("ok")), "range": (start.isoformat(), end.isoformat()), **summary}
+    summary = detect_conflicts_range(session, start, end, by_professional=by_prof, calendar_id=body.calendar_id, professional_id=body.professional_id, sample_limit=limit, sample_offset=body.sample_offset or 0)
     return {"ok": bool(summary.get("ok")), "range": (start.isoformat(), end.isoformat()), **summary}
 
 class AdminClearCalendarsIn(BaseModel):
@@ -452,3 +486,57 @@ def admin_clear_calendars(body: AdminClearCalendarsIn | None = None, _=Depends(r
         results[cal] = res
         total_deleted += res.get("deleted", 0); total_listed += res.get("total_listed", 0); total_skipped += res.get("skipped", 0)
     return {"ok": True, "dry_run": bool(body.dry_run), "only_pelubot": bool(body.only_pelubot), "calendars": cals, "range": (body.start, body.end), "totals": {"listed": total_listed, "deleted": total_deleted, "skipped": total_skipped}, "results": results}
+
+@router.post("/gcal/webhook", tags=["gcal"])
+def gcal_webhook(request: Request, background_tasks: BackgroundTasks, session: Session = Depends(get_session)):
+    """Receptor de notificaciones push de Google Calendar (autenticado por el token del canal).
+
+    Responde en cuanto valida el aviso; la importación del calendario va en una tarea de fondo
+    para no retener la petición de Google (que reintenta si tarda).
+    """
+    h = request.headers
+    channel_id = h.get("X-Goog-Channel-ID")
+    if not channel_id:
+        raise HTTPException(status_code=400, detail="Falta X-Goog-Channel-ID")
+    try:
+        out = handle_notification(session, channel_id, h.get("X-Goog-Resource-State", ""), h.get("X-Goog-Channel-Token"), h.get("X-Goog-Resource-ID"))
+    except UnknownChannel:
+        raise HTTPException(status_code=404, detail="Canal desconocido")
+    except InvalidChannelToken:
+        raise HTTPException(status_code=403, detail="Token de canal inválido")
+    if out.pop("needs_sync"):
+        if queue_calendar_sync(out["calendar_id"]):
+            background_tasks.add_task(run_calendar_sync, session.get_bind(), out["calendar_id"])
+        out["queued"] = True
+    return out
+
+class AdminWatchIn(BaseModel):
+    address: str | None = None
+    calendar_id: str | None = None
+    professional_id: str | None = None
+    force: bool | None = False
+    stop: bool | None = False
+
+@router.post("/admin/gcal/watch")
+def admin_gcal_watch(body: AdminWatchIn | None = None, session: Session = Depends(get_session), _=Depends(require_api_key)):
+    """Registra/renueva los canales push (idempotente; apto para cron) o los detiene con `stop`."""
+    body = body or AdminWatchIn()
+    if body.stop:
+        return stop_channels(session, calendar_id=body.calendar_id)
+    return ensure_channels(session, address=body.address, calendar_id=body.calendar_id, professional_id=body.professional_id, force=bool(body.force))
+
+class AdminOutboxDrainIn(BaseModel):
+    limit: int | None = None
+    retry_dead: bool | None = False
+
+@router.get("/admin/outbox")
+def admin_outbox(session: Session = Depends(get_session), _=Depends(require_api_key)):
+    return outbox_stats(session)
+
+@router.post("/admin/outbox/drain")
+def admin_outbox_drain(body: AdminOutboxDrainIn | None = None, session: Session = Depends(get_session), _=Depends(require_api_key)):
+    """Drena un lote del outbox en el momento; con `retry_dead` reencola antes las filas descartadas."""
+    body = body or AdminOutboxDrainIn()
+    requeued = retry_dead(session) if body.retry_dead else 0
+    result = drain_outbox(session, limit=body.limit) if body.limit else drain_outbox(session)
+    return {"ok": True, "requeued": requeued, **result, "outbox": outbox_stats(session)}
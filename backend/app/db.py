@@ -4,7 +4,7 @@ Configuración y acceso a la base de datos.
 from __future__ import annotations
 import os
 from pathlib import Path
-from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel import create_engine, Session
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DEFAULT_DB_PATH = BASE_DIR / "data" / "pelubot.db"
@@ -15,7 +15,11 @@ connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite")
 engine = create_engine(DATABASE_URL, echo=False, connect_args=connect_args)
 
 def create_db_and_tables() -> None:
-    SQLModel.metadata.create_all(engine)
+    import app.models  # noqa: F401  (registra las tablas en el metadata)
+    from app.migrations import run_migrations
+    # Tablas nuevas y columnas o índices nuevos en las que ya existían (create_all no las altera),
+    # bajo un bloqueo para que varios workers arrancando a la vez no choquen.
+    run_migrations(engine)
 
 def get_session():
     with Session(engine) as session:
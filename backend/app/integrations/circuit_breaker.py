@@ -0,0 +1,194 @@
+"""
+Circuit breaker para la dependencia de Google Calendar.
+
+Tras `failure_threshold` fallos seguidos de la dependencia (red, credenciales, 5xx o
+cuota agotada tras los reintentos) el circuito se abre y las llamadas fallan al
+instante con `CircuitOpenError` durante `cooldown_s`, en vez de pagar cada una el
+timeout y el backoff. Pasado ese tiempo deja pasar una única llamada de prueba
+(semiabierto): si va bien se cierra, si falla vuelve a abrirse.
+Los errores propios de la petición (404, 409, 412, 403 de permisos) no cuentan.
+"""
+from __future__ import annotations
+import asyncio
+import os
+import socket
+import ssl
+import threading
+import time as _time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httplib2
+
+from app.integrations.rate_limit import http_status, is_rate_limited
+
+
+def _transport_errors() -> tuple[type[BaseException], ...]:
+    """Errores de red o de transporte de los clientes que usamos (sin respuesta HTTP de Google)."""
+    errors: list[type[BaseException]] = [ConnectionError, TimeoutError, asyncio.TimeoutError, socket.gaierror, ssl.SSLError, httplib2.HttpLib2Error]
+    try:
+        from google.auth.exceptions import RefreshError, TransportError
+        errors += [TransportError, RefreshError]
+    except ImportError:
+        pass
+    try:
+        import aiohttp
+        errors.append(aiohttp.ClientError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+_TRANSPORT_ERRORS = _transport_errors()
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """El circuito está abierto: no se ha llamado a Google."""
+
+
+def is_dependency_failure(exc: BaseException) -> bool:
+    """Fallos que indican que Google (o nuestro acceso) no está disponible, no que la petición sea inválida."""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    status = http_status(exc)
+    if status is not None:
+        return status >= 500 or status in (401, 429) or is_rate_limited(exc)
+    # Sin estado HTTP sólo cuentan los fallos de red; un TypeError o KeyError local no es de Google.
+    return isinstance(exc, _TRANSPORT_ERRORS)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, cooldown_s: float = 30.0, clock: Callable[[], float] = _time.monotonic):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown_s = float(cooldown_s)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_inflight = False
+        self.opened = 0
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+
+    def _current(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.cooldown_s:
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current()
+
+    def is_open(self) -> bool:
+        """True si ahora mismo se rechazaría una llamada (abierto, o semiabierto con la prueba en curso)."""
+        with self._lock:
+            state = self._current()
+            return state == OPEN or (state == HALF_OPEN and self._probe_inflight)
+
+    def allow(self) -> bool:
+        """Reserva el paso de una llamada; en semiabierto sólo pasa la de prueba."""
+        with self._lock:
+            state = self._current()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_inflight:
+                self._state = HALF_OPEN
+                self._probe_inflight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_inflight = False
+
+    def record_failure(self, exc: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self.last_error = str(exc)[:300] if exc is not None else None
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.opened += 1
+                self._state = OPEN
+                self._opened_at = self._clock()
+                self._probe_inflight = False
+
+    def _check(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError(f"Google Calendar no disponible (circuito abierto): {self.last_error}")
+
+    def _abandon(self) -> None:
+        # Cancelación o interrupción: no dice nada de Google; sólo se libera la llamada de prueba.
+        with self._lock:
+            self._probe_inflight = False
+
+    def _settle(self, exc: Optional[BaseException]) -> None:
+        # Un 404/409/412 también prueba que Google responde: cuenta como éxito del circuito.
+        if exc is not None and is_dependency_failure(exc):
+            self.record_failure(exc)
+        else:
+            self.record_success()
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        self._check()
+        try:
+            result = fn()
+        except Exception as e:
+            self._settle(e)
+            raise
+        except BaseException:
+            self._abandon()
+            raise
+        self._settle(None)
+        return result
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self._check()
+        try:
+            result = await fn()
+        except Exception as e:
+            self._settle(e)
+            raise
+        except BaseException:
+            self._abandon()
+            raise
+        self._settle(None)
+        return result
+
+    def reset(self, failure_threshold: Optional[int] = None, cooldown_s: Optional[float] = None) -> None:
+        """Cierra el circuito y pone a cero las métricas (tests o tras arreglar credenciales)."""
+        with self._lock:
+            if failure_threshold is not None:
+                self.failure_threshold = max(1, int(failure_threshold))
+            if cooldown_s is not None:
+                self.cooldown_s = float(cooldown_s)
+            self._reset_state()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self._current()
+            retry_in = max(0.0, self.cooldown_s - (self._clock() - self._opened_at)) if state == OPEN else 0.0
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "cooldown_s": self.cooldown_s,
+                "retry_in_s": round(retry_in, 3),
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "last_error": self.last_error,
+            }
+
+
+gcal_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("GCAL_BREAKER_THRESHOLD", "5")),
+    cooldown_s=float(os.getenv("GCAL_BREAKER_COOLDOWN_S", "30")),
+)
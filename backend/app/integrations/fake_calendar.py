@@ -0,0 +1,370 @@
+"""
+Simulador en memoria de la API de Google Calendar (cliente `googleapiclient`).
+
+Guarda los eventos por calendario, de modo que lo insertado o modificado aparece en
+`events().list` (con paginación y syncToken, incluidas las cancelaciones) y en
+`freebusy().query`. Para benchmarks y pruebas de carga sin red puede añadir latencia
+con jitter a cada petición e inyectar errores 5xx o 403 `rateLimitExceeded` como
+`HttpError` reales, de modo que reintentos, cuota y circuit breaker se comportan
+como contra Google. Cuenta las llamadas por método (`stats()`).
+
+Se activa con `PELUBOT_FAKE_GCAL=1` (o en pytest); ver `FakeCalendarConfig.from_env`.
+"""
+from __future__ import annotations
+import os
+import random
+import threading
+import time as _time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+@dataclass
+class FakeCalendarConfig:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    page_size: int = 250
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "FakeCalendarConfig":
+        seed = os.getenv("PELUBOT_FAKE_GCAL_SEED")
+        return cls(
+            latency_ms=float(os.getenv("PELUBOT_FAKE_GCAL_LATENCY_MS", "0")),
+            jitter_ms=float(os.getenv("PELUBOT_FAKE_GCAL_JITTER_MS", "0")),
+            error_rate=float(os.getenv("PELUBOT_FAKE_GCAL_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.getenv("PELUBOT_FAKE_GCAL_RATE_LIMIT_RATE", "0")),
+            page_size=int(os.getenv("PELUBOT_FAKE_GCAL_PAGE_SIZE", "250")),
+            seed=int(seed) if seed else None,
+        )
+
+
+def http_error(status: int, reason: str = "backendError", message: str = "") -> HttpError:
+    """`HttpError` como el que lanza `googleapiclient`, con el `reason` en el cuerpo."""
+    resp = httplib2.Response({"status": status})
+    resp.reason = reason
+    content = f'{{"error": {{"code": {status}, "message": "{message or reason}", "errors": [{{"reason": "{reason}"}}]}}}}'
+    return HttpError(resp, content.encode())
+
+
+def _parse_when(when: Optional[Dict[str, Any]], tz: str) -> Optional[datetime]:
+    if not when:
+        return None
+    if when.get("dateTime"):
+        dt = datetime.fromisoformat(when["dateTime"].replace("Z", "+00:00"))
+        return dt if dt.tzinfo else dt.replace(tzinfo=ZoneInfo(when.get("timeZone") or tz))
+    if when.get("date"):
+        return datetime.fromisoformat(when["date"]).replace(tzinfo=ZoneInfo(when.get("timeZone") or tz))
+    return None
+
+
+def _parse_bound(value: Optional[str], tz: str) -> Optional[datetime]:
+    return _parse_when({"dateTime": value}, tz) if value else None
+
+
+def _iso_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _public(ev: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in ev.items() if not k.startswith("_")}
+
+
+class _FakeRequest:
+    """Petición diferida: como en `googleapiclient`, no hace nada hasta `execute()`."""
+
+    def __init__(self, service: "FakeCalendarService", method: str, fn: Callable[[], Any]):
+        self._service = service
+        self.method = method
+        self._fn = fn
+        self.headers: Dict[str, str] = {}
+
+    def execute(self) -> Any:
+        return self._service._invoke(self.method, self._fn)
+
+
+class _FakeFreebusy:
+    def __init__(self, service: "FakeCalendarService"):
+        self._service = service
+
+    def query(self, body: Dict[str, Any]) -> _FakeRequest:
+        return _FakeRequest(self._service, "freebusy.query", lambda: self._service._freebusy(body))
+
+
+class _FakeEvents:
+    def __init__(self, service: "FakeCalendarService"):
+        self._service = service
+
+    def insert(self, calendarId: str, body: dict) -> _FakeRequest:
+        return _FakeRequest(self._service, "events.insert", lambda: self._service._insert(calendarId, body))
+
+    def patch(self, calendarId: str, eventId: str, body: dict) -> _FakeRequest:
+        # Las cabeceras (If-Match) se fijan tras construir la petición: se leen al ejecutarla.
+        req = _FakeRequest(self._service, "events.patch", lambda: self._service._patch(calendarId, eventId, body, req.headers.get("If-Match")))
+        return req
+
+    def delete(self, calendarId: str, eventId: str) -> _FakeRequest:
+        return _FakeRequest(self._service, "events.delete", lambda: self._service._delete(calendarId, eventId))
+
+    def list(self, calendarId: str, **params: Any) -> _FakeRequest:
+        return _FakeRequest(self._service, "events.list", lambda: self._service._list(calendarId, **params))
+
+    def watch(self, calendarId: str, body: dict) -> _FakeRequest:
+        return _FakeRequest(self._service, "events.watch", lambda: self._service._watch(calendarId, body))
+
+
+class _FakeChannels:
+    def __init__(self, service: "FakeCalendarService"):
+        self._service = service
+
+    def stop(self, body: dict) -> _FakeRequest:
+        return _FakeRequest(self._service, "channels.stop", lambda: self._service._stop(body))
+
+
+class _FakeCalendarList:
+    def __init__(self, service: "FakeCalendarService"):
+        self._service = service
+
+    def list(self) -> _FakeRequest:
+        return _FakeRequest(self._service, "calendarList.list", lambda: {"items": [{"id": c} for c in sorted(self._service.calendars())]})
+
+
+class _FakeBatch:
+    """Imita `BatchHttpRequest`: una sola latencia para todo el lote y un callback por petición."""
+
+    def __init__(self, service: "FakeCalendarService", callback=None):
+        self._service = service
+        self._callback = callback
+        self._requests: list = []
+
+    def add(self, request, callback=None, request_id=None):
+        self._requests.append((request, callback or self._callback, request_id or str(len(self._requests) + 1)))
+
+    def execute(self):
+        self._service._invoke("batch", lambda: None)
+        for request, callback, request_id in self._requests:
+            try:
+                if isinstance(request, _FakeRequest):
+                    response, exc = self._service._invoke(request.method, request._fn, latency=False), None
+                else:
+                    response, exc = request.execute(), None
+            except Exception as e:
+                response, exc = None, e
+            if callback:
+                callback(request_id, response, exc)
+
+
+class FakeCalendarService:
+    """Cliente de Calendar simulado con estado; mismo interfaz que el de `googleapiclient`."""
+
+    def __init__(self, config: Optional[FakeCalendarConfig] = None, sleep: Callable[[float], None] = _time.sleep):
+        self.config = config or FakeCalendarConfig()
+        self._sleep = sleep
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.RLock()
+        self._events_store: Dict[str, Dict[str, Any]] = {}
+        self._tombstones: Dict[str, Dict[str, Any]] = {}
+        self._channels: Dict[str, Dict[str, Any]] = {}
+        self._seq = 0
+        self._min_sync_seq = 0
+        self._faults: Dict[str, List[Any]] = {}
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+
+    # --- interfaz del cliente ---
+    def new_batch_http_request(self, callback=None):
+        return _FakeBatch(self, callback)
+
+    def freebusy(self):
+        return _FakeFreebusy(self)
+
+    def events(self):
+        return _FakeEvents(self)
+
+    def channels(self):
+        return _FakeChannels(self)
+
+    def calendarList(self):
+        return _FakeCalendarList(self)
+
+    # --- control del simulador ---
+    def inject(self, method: str, status: Optional[int] = None, reason: str = "backendError", error: Optional[BaseException] = None, times: Optional[int] = 1) -> None:
+        """Hace fallar las próximas `times` llamadas a `method` (`None`: todas, hasta `clear_faults`)."""
+        exc = error if error is not None else http_error(status or 503, reason)
+        self._faults[method] = [exc, times]
+
+    def clear_faults(self) -> None:
+        self._faults.clear()
+
+    def expire_sync_tokens(self) -> None:
+        """Invalida los syncToken emitidos hasta ahora: el siguiente uso recibe 410."""
+        with self._lock:
+            self._min_sync_seq = self._seq + 1
+
+    def calendars(self) -> set:
+        with self._lock:
+            return {ev["calendarId"] for ev in self._events_store.values()}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors), "events": len(self._events_store), "config": vars(self.config).copy()}
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    # --- ejecución ---
+    def _injected_error(self, method: str) -> Optional[BaseException]:
+        with self._lock:
+            fault = self._faults.get(method)
+            if fault is not None:
+                exc, times = fault
+                if times is not None:
+                    fault[1] = times - 1
+                    if fault[1] <= 0:
+                        del self._faults[method]
+                return exc
+            r = self._rng.random()
+        if r < self.config.rate_limit_rate:
+            return http_error(403, "rateLimitExceeded", "Rate Limit Exceeded")
+        if r < self.config.rate_limit_rate + self.config.error_rate:
+            return http_error(503, "backendError")
+        return None
+
+    def _invoke(self, method: str, fn: Callable[[], Any], latency: bool = True) -> Any:
+        with self._lock:
+            self.calls[method] += 1
+            delay = 0.0
+            if latency and (self.config.latency_ms or self.config.jitter_ms):
+                delay = (self.config.latency_ms + self._rng.uniform(0, self.config.jitter_ms)) / 1000.0
+        if delay > 0:
+            self._sleep(delay)
+        exc = self._injected_error(method)
+        if exc is not None:
+            with self._lock:
+                self.errors[method] += 1
+            raise exc
+        with self._lock:
+            return fn()
+
+    def _bump(self, ev: Dict[str, Any]) -> None:
+        self._seq += 1
+        ev["_seq"] = self._seq
+        ev["etag"] = f'"{self._seq}"'
+        ev["updated"] = _iso_utc(datetime.now(timezone.utc))
+
+    def _get(self, calendar_id: str, event_id: str) -> Dict[str, Any]:
+        ev = self._events_store.get(event_id)
+        if ev is None or ev["calendarId"] != calendar_id:
+            if event_id in self._tombstones:
+                raise http_error(410, "deleted", "Resource has been deleted")
+            raise http_error(404, "notFound", "Not Found")
+        return ev
+
+    def _insert(self, calendar_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        event_id = body.get("id") or f"fake-{uuid.uuid4().hex[:12]}"
+        if event_id in self._events_store:
+            raise http_error(409, "duplicate", "The requested identifier already exists.")
+        self._tombstones.pop(event_id, None)
+        ev = {**body, "id": event_id, "calendarId": calendar_id, "status": "confirmed"}
+        self._bump(ev)
+        self._events_store[event_id] = ev
+        return _public(ev)
+
+    def _patch(self, calendar_id: str, event_id: str, body: Dict[str, Any], if_match: Optional[str] = None) -> Dict[str, Any]:
+        ev = self._get(calendar_id, event_id)
+        if if_match and if_match != ev["etag"]:
+            raise http_error(412, "conditionNotMet", "Precondition Failed")
+        ev.update({k: v for k, v in body.items() if k not in ("id", "calendarId")})
+        self._bump(ev)
+        return _public(ev)
+
+    def _delete(self, calendar_id: str, event_id: str) -> Dict[str, Any]:
+        self._get(calendar_id, event_id)
+        del self._events_store[event_id]
+        tomb = {"id": event_id, "calendarId": calendar_id, "status": "cancelled"}
+        self._bump(tomb)
+        self._tombstones[event_id] = tomb
+        return {}
+
+    def _in_window(self, ev: Dict[str, Any], tmin: Optional[datetime], tmax: Optional[datetime], tz: str) -> bool:
+        start, end = _parse_when(ev.get("start"), tz), _parse_when(ev.get("end"), tz)
+        if start is None or end is None:
+            return tmin is None and tmax is None
+        return (tmin is None or end > tmin) and (tmax is None or start < tmax)
+
+    def _list(self, calendar_id: str, timeMin: Optional[str] = None, timeMax: Optional[str] = None, pageToken: Optional[str] = None, syncToken: Optional[str] = None, maxResults: Optional[int] = None, privateExtendedProperty: Optional[str] = None, timeZone: Optional[str] = None, orderBy: Optional[str] = None, showDeleted: bool = False, **_ignored: Any) -> Dict[str, Any]:
+        tz = timeZone or "UTC"
+        if syncToken:
+            try:
+                since = int(syncToken.rsplit("-", 1)[1])
+            except (IndexError, ValueError):
+                raise http_error(400, "invalid", "Invalid sync token value.")
+            if since < self._min_sync_seq:
+                raise http_error(410, "fullSyncRequired", "Sync token is no longer valid, a full sync is required.")
+            pool = [ev for ev in (*self._events_store.values(), *self._tombstones.values()) if ev["calendarId"] == calendar_id and ev["_seq"] > since]
+            pool.sort(key=lambda ev: ev["_seq"])
+        else:
+            tmin, tmax = _parse_bound(timeMin, tz), _parse_bound(timeMax, tz)
+            pool = [ev for ev in self._events_store.values() if ev["calendarId"] == calendar_id and self._in_window(ev, tmin, tmax, tz)]
+            if showDeleted:
+                pool += [ev for ev in self._tombstones.values() if ev["calendarId"] == calendar_id]
+            if privateExtendedProperty:
+                key, _, value = privateExtendedProperty.partition("=")
+                pool = [ev for ev in pool if ((ev.get("extendedProperties") or {}).get("private") or {}).get(key) == value]
+            if orderBy == "startTime":
+                far = datetime.max.replace(tzinfo=timezone.utc)
+                pool.sort(key=lambda ev: _parse_when(ev.get("start"), tz) or far)
+        size = max(1, min(int(maxResults or 250), self.config.page_size))
+        offset = int(pageToken[1:]) if pageToken else 0
+        page = pool[offset:offset + size]
+        resp: Dict[str, Any] = {"items": [_public(ev) for ev in page]}
+        if offset + size < len(pool):
+            resp["nextPageToken"] = f"p{offset + size}"
+        else:
+            resp["nextSyncToken"] = f"fake-sync-{self._seq}"
+        return resp
+
+    def _freebusy(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        tz = body.get("timeZone") or "UTC"
+        tmin, tmax = _parse_bound(body.get("timeMin"), tz), _parse_bound(body.get("timeMax"), tz)
+        calendars: Dict[str, Any] = {}
+        for item in body.get("items", []):
+            cal_id = item.get("id") or "primary"
+            spans = []
+            for ev in self._events_store.values():
+                if ev["calendarId"] != cal_id or ev.get("transparency") == "transparent" or not self._in_window(ev, tmin, tmax, tz):
+                    continue
+                s, e = _parse_when(ev.get("start"), tz), _parse_when(ev.get("end"), tz)
+                if s is not None and e is not None:
+                    spans.append((s, e))
+            # Google devuelve los tramos ocupados ya fusionados.
+            merged: List[List[datetime]] = []
+            for s, e in sorted(spans):
+                if merged and s <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], e)
+                else:
+                    merged.append([s, e])
+            calendars[cal_id] = {"busy": [{"start": _iso_utc(s), "end": _iso_utc(e)} for s, e in merged]}
+        return {"kind": "calendar#freeBusy", "timeMin": body.get("timeMin"), "timeMax": body.get("timeMax"), "calendars": calendars}
+
+    def _watch(self, calendar_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        ttl_s = int((body.get("params") or {}).get("ttl") or 604800)
+        expiration = int((datetime.now().timestamp() + ttl_s) * 1000)
+        channel = {"kind": "api#channel", "id": body["id"], "resourceId": f"fake-res-{calendar_id}", "token": body.get("token"), "address": body.get("address"), "expiration": str(expiration), "calendarId": calendar_id}
+        self._channels[body["id"]] = channel
+        return dict(channel)
+
+    def _stop(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        self._channels.pop(body.get("id"), None)
+        return {}
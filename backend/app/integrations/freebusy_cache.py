@@ -0,0 +1,202 @@
+"""
+Caché de respuestas freebusy con TTL, stale-while-revalidate y coalescencia (single-flight).
+
+La clave es (calendarios, timeMin, timeMax, tz). Varios fallos simultáneos sobre la
+misma clave esperan a una única llamada a Google. Pasado el TTL, y dentro de la
+ventana `swr_s`, se sirve el valor anterior mientras un hilo (o una tarea, en el
+camino asíncrono) lo refresca.
+Las escrituras en un calendario invalidan sus entradas mediante un contador de
+generación, de modo que una llamada en curso iniciada antes no repuebla la caché.
+"""
+from __future__ import annotations
+import asyncio
+import os
+import threading
+import time as _time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class FreebusyCache:
+    def __init__(self, ttl_s: float = 30.0, swr_s: float = 60.0, maxsize: int = 256, wait_timeout_s: float = 30.0):
+        self.ttl_s = float(ttl_s)
+        self.swr_s = float(swr_s)
+        self.maxsize = max(0, int(maxsize))
+        self.wait_timeout_s = float(wait_timeout_s)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float, Tuple[str, ...]]]" = OrderedDict()
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self._generations: Dict[str, int] = {}
+        self._tasks: set = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    @staticmethod
+    def make_key(calendar_ids: Iterable[str], time_min: str, time_max: str, tz: str) -> Tuple[Tuple[str, ...], str, str, str]:
+        return (tuple(sorted(set(calendar_ids))), time_min, time_max, tz)
+
+    def _gens(self, calendars: Tuple[str, ...]) -> Tuple[int, ...]:
+        return tuple(self._generations.get(c, 0) for c in calendars)
+
+    def _store(self, key: Hashable, calendars: Tuple[str, ...], gens: Tuple[int, ...], value: Any) -> None:
+        if self.maxsize == 0 or gens != self._gens(calendars):
+            return
+        self._entries[key] = (value, _time.monotonic(), calendars)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _run(self, key: Hashable, calendars: Tuple[str, ...], gens: Tuple[int, ...], flight: _Flight, fetch: Callable[[], Any]) -> None:
+        try:
+            flight.value = fetch()
+            with self._lock:
+                self._store(key, calendars, gens, flight.value)
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self.errors += 1
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def _lookup(self, key: Tuple[Tuple[str, ...], str, str, str], refresh: Callable[[Hashable, Tuple[str, ...], Tuple[int, ...], _Flight], None]) -> Tuple[bool, Any, Optional[Tuple[int, ...]]]:
+        """Consulta la entrada y registra el vuelo si hace falta.
+
+        Devuelve `(True, valor, None)` si hay algo que servir; si no, `(False, vuelo, gens)`, con
+        `gens` sólo cuando el llamante es quien debe pedir a Google (`None` si espera a otro).
+        """
+        calendars = key[0]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at, _ = entry
+                age = _time.monotonic() - stored_at
+                if age < self.ttl_s:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value, None
+                if age < self.ttl_s + self.swr_s:
+                    self.stale_hits += 1
+                    if key not in self._inflight:
+                        self.refreshes += 1
+                        flight = self._inflight[key] = _Flight()
+                        refresh(key, calendars, self._gens(calendars), flight)
+                    return True, value, None
+                del self._entries[key]
+            flight = self._inflight.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._inflight[key] = _Flight()
+                return False, flight, self._gens(calendars)
+            self.coalesced += 1
+            return False, flight, None
+
+    def get_or_fetch(self, key: Tuple[Tuple[str, ...], str, str, str], fetch: Callable[[], Any]) -> Any:
+        def _refresh(k, calendars, gens, flight):
+            threading.Thread(target=self._run, args=(k, calendars, gens, flight, fetch), daemon=True).start()
+
+        hit, found, gens = self._lookup(key, _refresh)
+        if hit:
+            return found
+        flight = found
+        if gens is not None:
+            self._run(key, key[0], gens, flight, fetch)
+        elif not flight.event.wait(self.wait_timeout_s):
+            raise TimeoutError("Timeout esperando freebusy en curso")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    async def _run_async(self, key: Hashable, calendars: Tuple[str, ...], gens: Tuple[int, ...], flight: _Flight, fetch: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            flight.value = await fetch()
+            with self._lock:
+                self._store(key, calendars, gens, flight.value)
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self.errors += 1
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    async def get_or_fetch_async(self, key: Tuple[Tuple[str, ...], str, str, str], fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Como `get_or_fetch`, pero `fetch` es una corrutina y las esperas no bloquean el event loop.
+
+        Comparte entradas y vuelos con el camino síncrono: un hilo y una corrutina que piden la
+        misma clave esperan a una única llamada a Google.
+        """
+        def _refresh(k, calendars, gens, flight):
+            # Se guarda una referencia: el event loop sólo mantiene referencias débiles a sus tareas.
+            task = asyncio.get_running_loop().create_task(self._run_async(k, calendars, gens, flight, fetch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        hit, found, gens = self._lookup(key, _refresh)
+        if hit:
+            return found
+        flight = found
+        if gens is not None:
+            await self._run_async(key, key[0], gens, flight, fetch)
+        elif not flight.event.is_set() and not await asyncio.to_thread(flight.event.wait, self.wait_timeout_s):
+            raise TimeoutError("Timeout esperando freebusy en curso")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def invalidate(self, calendar_id: Optional[str] = None) -> None:
+        """Descarta las entradas de un calendario (o todas) tras una escritura o notificación."""
+        with self._lock:
+            if calendar_id is None:
+                for c in {c for _, _, cals in self._entries.values() for c in cals}:
+                    self._generations[c] = self._generations.get(c, 0) + 1
+                self._entries.clear()
+                return
+            self._generations[calendar_id] = self._generations.get(calendar_id, 0) + 1
+            for k in [k for k, (_, _, cals) in self._entries.items() if calendar_id in cals]:
+                del self._entries[k]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self.hits = self.misses = self.stale_hits = self.coalesced = self.refreshes = self.errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "ttl_s": self.ttl_s,
+                "swr_s": self.swr_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+                "coalesced_waiters": self.coalesced,
+                "background_refreshes": self.refreshes,
+                "errors": self.errors,
+                "inflight": len(self._inflight),
+            }
+
+
+freebusy_cache = FreebusyCache(
+    ttl_s=float(os.getenv("GCAL_FREEBUSY_TTL_S", "30")),
+    swr_s=float(os.getenv("GCAL_FREEBUSY_SWR_S", "60")),
+    maxsize=int(os.getenv("GCAL_FREEBUSY_CACHE_SIZE", "256")),
+)
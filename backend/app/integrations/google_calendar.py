@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Callable, Hashable, Optional, List
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -7,11 +7,23 @@ load_dotenv()
 from google.oauth2.service_account import Credentials as SA
 from google.oauth2.credentials import Credentials as UserCreds
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+import httplib2
 
+from app.integrations.freebusy_cache import freebusy_cache
+from app.integrations.rate_limit import gcal_throttle, http_status as _http_status, is_retryable
+from app.integrations.circuit_breaker import gcal_breaker, CircuitOpenError
+from app.integrations.fake_calendar import FakeCalendarService, FakeCalendarConfig
+
+import hashlib
 import json
 import os
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 try:
     from zoneinfo import ZoneInfo
 except Exception:
@@ -19,6 +31,10 @@ except Exception:
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
+# Renovación anticipada del token y timeout de las conexiones HTTP (keep-alive por hilo).
+GCAL_REFRESH_MARGIN_S = int(os.getenv("GCAL_REFRESH_MARGIN_S", "300"))
+GCAL_HTTP_TIMEOUT_S = float(os.getenv("GCAL_HTTP_TIMEOUT_S", "20"))
+
 def iso_datetime(dt_or_str, tz: str = "Europe/Madrid") -> str:
     """
     Devuelve ISO 8601 con zona horaria real (RFC3339).
@@ -89,87 +105,106 @@ def _load_user_creds() -> Optional[UserCreds]:
         creds.refresh(Request())
     return creds
 
-class _FakeFreebusy:
-    def __init__(self):
-        self._body = None
-    def query(self, body):
-        self._body = body
-        return self
-    def execute(self):
-        calendars = {}
-        try:
-            items = (self._body or {}).get("items", [])
-            if items:
-                for it in items:
-                    cal_id = it.get("id") or "primary"
-                    calendars[cal_id] = {"busy": []}
-        except Exception:
-            calendars["primary"] = {"busy": []}
-        return {"calendars": calendars}
-
-class _FakeEventsOp:
-    def __init__(self, result):
-        self._result = result
-    def execute(self):
-        return self._result
-
-class _FakeEvents:
-    def __init__(self, store: dict):
-        self._store = store
-    def insert(self, calendarId: str, body: dict):
-        event_id = f"fake-{len(self._store) + 1}"
-        self._store[event_id] = {**body, "id": event_id, "calendarId": calendarId}
-        return _FakeEventsOp({"id": event_id})
-    def patch(self, calendarId: str, eventId: str, body: dict):
-        ev = self._store.get(eventId, {"id": eventId, "calendarId": calendarId})
-        ev.update(body)
-        self._store[eventId] = ev
-        return _FakeEventsOp({"id": eventId})
-    def delete(self, calendarId: str, eventId: str):
-        self._store.pop(eventId, None)
-        return _FakeEventsOp({})
-    def list(self, calendarId: str, timeMin: str, timeMax: str, singleEvents: bool = True, orderBy: str = "startTime", pageToken: Optional[str] = None, timeZone: Optional[str] = None):
-        return _FakeEventsOp({"items": []})
-
-class FakeCalendarService:
-    def __init__(self):
-        self._events_store: dict[str, dict] = {}
-    def freebusy(self):
-        return _FakeFreebusy()
-    def events(self):
-        return _FakeEvents(self._events_store)
-    def calendarList(self):
-        class _CL:
-            def list(self_inner):
-                return _FakeEventsOp({"items": []})
-        return _CL()
+_client_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_client: Any = None
+_client_creds: Any = None
+_fake_client: Optional[FakeCalendarService] = None
+_tls = threading.local()
+
+def _use_fake() -> bool:
+    return bool(os.getenv("PYTEST_CURRENT_TEST")) or os.getenv("PELUBOT_FAKE_GCAL", "").lower() in ("1", "true", "yes", "y", "si", "sí")
+
+def _ensure_fresh(creds: Any) -> None:
+    """Renueva el token antes de que caduque para no pagar el 401 + refresh en una petición."""
+    expiry = getattr(creds, "expiry", None)
+    if not getattr(creds, "token", None) or expiry is None:
+        return
+    # google-auth guarda expiry como UTC naive.
+    if expiry - datetime.utcnow() > timedelta(seconds=GCAL_REFRESH_MARGIN_S):
+        return
+    with _refresh_lock:
+        expiry = getattr(creds, "expiry", None)
+        if expiry is not None and expiry - datetime.utcnow() <= timedelta(seconds=GCAL_REFRESH_MARGIN_S):
+            creds.refresh(Request())
+
+def _thread_http(creds: Any) -> AuthorizedHttp:
+    """httplib2.Http no es thread-safe: cada hilo mantiene su propia conexión viva."""
+    http = getattr(_tls, "http", None)
+    if http is None or getattr(_tls, "creds", None) is not creds:
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=GCAL_HTTP_TIMEOUT_S))
+        _tls.http = http
+        _tls.creds = creds
+    return http
+
+def _request_builder(http, *args, **kwargs) -> HttpRequest:
+    creds = _client_creds
+    _ensure_fresh(creds)
+    return HttpRequest(_thread_http(creds), *args, **kwargs)
+
+def _create_client() -> Any:
+    global _client_creds
+    creds = _load_sa_creds() or _load_user_creds()
+    if not creds:
+        return None
+    _client_creds = creds
+    # Documento de descubrimiento empaquetado con la librería: sin petición de red al construir.
+    return build("calendar", "v3", http=_thread_http(creds), requestBuilder=_request_builder, cache_discovery=False, static_discovery=True)
 
 def build_calendar() -> Any:
     """
-    Crea el cliente de Calendar priorizando Service Account y fallback OAuth.
-    En pytest o con PELUBOT_FAKE_GCAL=1 devuelve cliente falso.
+    Devuelve el cliente de Calendar compartido por el proceso (creación perezosa y thread-safe).
+    Prioriza Service Account con fallback OAuth. En pytest o con PELUBOT_FAKE_GCAL=1 devuelve cliente falso.
     """
-    if os.getenv("PYTEST_CURRENT_TEST") or os.getenv("PELUBOT_FAKE_GCAL") == "1":
-        return FakeCalendarService()
-    try:
-        sa = _load_sa_creds()
-        if sa:
-            return build("calendar", "v3", credentials=sa)
-        oa = _load_user_creds()
-        if oa:
-            return build("calendar", "v3", credentials=oa)
-    except Exception as e:
-        if os.getenv("PYTEST_CURRENT_TEST") or os.getenv("PELUBOT_FAKE_GCAL") == "1":
-            return FakeCalendarService()
-        raise RuntimeError(f"Error al crear cliente de Google Calendar: {e}")
-    if os.getenv("PYTEST_CURRENT_TEST") or os.getenv("PELUBOT_FAKE_GCAL") == "1":
-        return FakeCalendarService()
-    raise RuntimeError("No hay credenciales. Exporta GOOGLE_SERVICE_ACCOUNT_JSON o GOOGLE_OAUTH_JSON")
+    global _client, _fake_client
+    if _use_fake():
+        if _fake_client is None:
+            with _client_lock:
+                if _fake_client is None:
+                    _fake_client = FakeCalendarService(FakeCalendarConfig.from_env())
+        return _fake_client
+    client = _client
+    if client is not None:
+        return client
+    with _client_lock:
+        if _client is None:
+            # Con credenciales rotas cada intento falla igual: el circuito evita repetirlo en cada petición.
+            if not gcal_breaker.allow():
+                raise CircuitOpenError(f"Google Calendar no disponible (circuito abierto): {gcal_breaker.last_error}")
+            try:
+                _client = _create_client()
+            except Exception as e:
+                gcal_breaker.record_failure(e)
+                raise RuntimeError(f"Error al crear cliente de Google Calendar: {e}")
+            if _client is None:
+                err = RuntimeError("No hay credenciales. Exporta GOOGLE_SERVICE_ACCOUNT_JSON o GOOGLE_OAUTH_JSON")
+                gcal_breaker.record_failure(err)
+                raise err
+            gcal_breaker.record_success()
+        return _client
+
+def fake_calendar_stats() -> Optional[Dict[str, Any]]:
+    """Contadores del simulador si está en uso (benchmarks con PELUBOT_FAKE_GCAL)."""
+    fake = _fake_client
+    return fake.stats() if fake is not None else None
+
+def reset_calendar_client() -> None:
+    """Descarta el cliente compartido (real y falso); útil en tests o tras rotar credenciales."""
+    global _client, _client_creds, _fake_client
+    with _client_lock:
+        _client = None
+        _client_creds = None
+        _fake_client = None
+    _tls.__dict__.clear()
+
+def _execute(request: Any) -> Any:
+    """Ejecuta una petición pasando por el circuit breaker, el limitador de cuota y los reintentos con backoff."""
+    return gcal_breaker.call(lambda: gcal_throttle.call(request.execute))
 
 def freebusy(service: Any, calendar_id: str, time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid") -> List[Dict[str, str]]:
     body = {"timeMin": iso_datetime(time_min_iso, tz), "timeMax": iso_datetime(time_max_iso, tz), "timeZone": tz, "items": [{"id": calendar_id}]}
     try:
-        fb = service.freebusy().query(body=body).execute()
+        fb = _execute(service.freebusy().query(body=body))
         cals = fb.get("calendars", {})
         return cals.get(calendar_id, {}).get("busy", [])
     except Exception as e:
@@ -180,7 +215,7 @@ def freebusy_multi(service: Any, calendar_ids: list[str], time_min_iso: str, tim
     items = [{"id": cid} for cid in calendar_ids]
     body = {"timeMin": iso_datetime(time_min_iso, tz), "timeMax": iso_datetime(time_max_iso, tz), "timeZone": tz, "items": items}
     try:
-        fb = service.freebusy().query(body=body).execute()
+        fb = _execute(service.freebusy().query(body=body))
         cals = fb.get("calendars", {})
         out: Dict[str, List[Dict[str, str]]] = {}
         for cid in calendar_ids:
@@ -189,51 +224,238 @@ def freebusy_multi(service: Any, calendar_ids: list[str], time_min_iso: str, tim
     except Exception as e:
         raise RuntimeError(f"Error consultando freebusy (multi): {e}")
 
+def freebusy_multi_cached(service: Any, calendar_ids: list[str], time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid") -> Dict[str, List[Dict[str, str]]]:
+    """`freebusy_multi` detrás de la caché con TTL y coalescencia de peticiones concurrentes."""
+    key = freebusy_cache.make_key(calendar_ids, iso_datetime(time_min_iso, tz), iso_datetime(time_max_iso, tz), tz)
+    return freebusy_cache.get_or_fetch(key, lambda: freebusy_multi(service, list(key[0]), time_min_iso, time_max_iso, tz))
+
 def list_calendars(service: Any) -> List[Dict[str, Any]]:
     try:
-        return service.calendarList().list().execute().get("items", [])
+        return _execute(service.calendarList().list()).get("items", [])
     except Exception as e:
         raise RuntimeError(f"Error listando calendarios: {e}")
 
-def create_event(service: Any, calendar_id: str, start_dt, end_dt, summary: str, private_props: Dict[str, str] = None, color_id: Optional[str] = None, tz: str = "Europe/Madrid") -> Dict[str, Any]:
-    if private_props is None:
-        private_props = {}
-    body = {
-        "summary": summary,
+def _event_body(start_dt, end_dt, tz: str, summary: Optional[str] = None, private_props: Optional[Dict[str, str]] = None, color_id: Optional[str] = None) -> Dict[str, Any]:
+    body: Dict[str, Any] = {
         "start": {"dateTime": iso_datetime(start_dt, tz), "timeZone": tz},
         "end": {"dateTime": iso_datetime(end_dt, tz), "timeZone": tz},
-        "extendedProperties": {"private": private_props},
     }
+    if summary is not None:
+        body["summary"] = summary
+        body["extendedProperties"] = {"private": private_props or {}}
     if color_id:
         body["colorId"] = color_id
+    return body
+
+def create_event(service: Any, calendar_id: str, start_dt, end_dt, summary: str, private_props: Dict[str, str] = None, color_id: Optional[str] = None, tz: str = "Europe/Madrid") -> Dict[str, Any]:
+    body = _event_body(start_dt, end_dt, tz, summary=summary, private_props=private_props, color_id=color_id)
     try:
-        return service.events().insert(calendarId=calendar_id, body=body).execute()
+        ev = _execute(service.events().insert(calendarId=calendar_id, body=body))
     except Exception as e:
         raise RuntimeError(f"Error creando evento: {e}")
+    freebusy_cache.invalidate(calendar_id)
+    return ev
 
-def patch_event(service: Any, calendar_id: str, event_id: str, start_dt, end_dt, tz: str = "Europe/Madrid") -> Dict[str, Any]:
-    body = {
-        "start": {"dateTime": iso_datetime(start_dt, tz), "timeZone": tz},
-        "end": {"dateTime": iso_datetime(end_dt, tz), "timeZone": tz},
-    }
+def _if_match(request: Any, etag: Optional[str]) -> Any:
+    """Condiciona la petición al `etag` dado: Google responde 412 si el evento cambió desde entonces."""
+    if etag:
+        request.headers["If-Match"] = etag
+    return request
+
+def patch_event(service: Any, calendar_id: str, event_id: str, start_dt, end_dt, tz: str = "Europe/Madrid", etag: Optional[str] = None) -> Dict[str, Any]:
+    body = _event_body(start_dt, end_dt, tz)
     try:
-        return service.events().patch(calendarId=calendar_id, eventId=event_id, body=body).execute()
+        ev = _execute(_if_match(service.events().patch(calendarId=calendar_id, eventId=event_id, body=body), etag))
     except Exception as e:
         raise RuntimeError(f"Error modificando evento: {e}")
+    freebusy_cache.invalidate(calendar_id)
+    return ev
 
 def delete_event(service: Any, calendar_id: str, event_id: str) -> None:
     try:
-        service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
+        _execute(service.events().delete(calendarId=calendar_id, eventId=event_id))
     except Exception as e:
         raise RuntimeError(f"Error eliminando evento: {e}")
+    freebusy_cache.invalidate(calendar_id)
+
+def reservation_event_id(reservation_id: str) -> str:
+    """Id de evento fijo para una reserva: reinsertarla da 409 en vez de duplicarla.
+
+    Google exige caracteres base32hex (a-v, 0-9) y entre 5 y 1024; un hex los cumple.
+    """
+    return hashlib.sha1(f"pelubot-reservation:{reservation_id}".encode()).hexdigest()
 
-def list_events_range(service: Any, calendar_id: str, time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid") -> List[Dict[str, Any]]:
+def find_events_by_reservation(service: Any, calendar_id: str, reservation_id: str) -> List[Dict[str, Any]]:
+    """Eventos con `private.reservation_id` dado; permite reintentar creaciones sin duplicar."""
     try:
-        resp = service.events().list(calendarId=calendar_id, timeMin=iso_datetime(time_min_iso, tz), timeMax=iso_datetime(time_max_iso, tz), singleEvents=True, orderBy="startTime", timeZone=tz).execute()
-        return resp.get("items", [])
+        resp = _execute(service.events().list(calendarId=calendar_id, privateExtendedProperty=f"reservation_id={reservation_id}", singleEvents=True, fields="items(id,start,end)"))
+    except Exception as e:
+        raise RuntimeError(f"Error buscando eventos de la reserva: {e}")
+    return resp.get("items", [])
+
+def watch_events(service: Any, calendar_id: str, channel_id: str, address: str, token: str, ttl_s: Optional[int] = None) -> Dict[str, Any]:
+    """Registra un canal web_hook (events.watch); Google avisará en `address` de cada cambio."""
+    body: Dict[str, Any] = {"id": channel_id, "type": "web_hook", "address": address, "token": token}
+    if ttl_s:
+        body["params"] = {"ttl": str(int(ttl_s))}
+    try:
+        return _execute(service.events().watch(calendarId=calendar_id, body=body))
+    except Exception as e:
+        raise RuntimeError(f"Error registrando canal de notificaciones: {e}")
+
+def stop_channel(service: Any, channel_id: str, resource_id: Optional[str]) -> None:
+    try:
+        _execute(service.channels().stop(body={"id": channel_id, "resourceId": resource_id}))
+    except Exception as e:
+        raise RuntimeError(f"Error deteniendo canal de notificaciones: {e}")
+
+# Máximo de llamadas por petición batch que admite la API de Calendar.
+GCAL_BATCH_MAX = 50
+
+@dataclass
+class BatchItemResult:
+    """Resultado de una mutación dentro de un batch: `response` si fue bien, `error` si no."""
+    key: Hashable
+    calendar_id: str
+    ok: bool
+    response: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    status: Optional[int] = None
+    retryable: bool = False
+
+class EventBatch:
+    """
+    Acumula inserciones, parches y borrados de eventos y los envía en peticiones
+    multipart de hasta `GCAL_BATCH_MAX` llamadas. Cada operación se identifica con
+    una `key` del llamador, que recibe el resultado individual en `execute()`.
+    """
+
+    def __init__(self, service: Any, max_size: int = GCAL_BATCH_MAX):
+        self._service = service
+        self._max_size = max(1, min(int(max_size), GCAL_BATCH_MAX))
+        self._ops: List[tuple[Hashable, str, Callable[[], Any]]] = []
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def insert(self, key: Hashable, calendar_id: str, start_dt, end_dt, summary: str, private_props: Dict[str, str] = None, color_id: Optional[str] = None, tz: str = "Europe/Madrid", event_id: Optional[str] = None) -> None:
+        body = _event_body(start_dt, end_dt, tz, summary=summary, private_props=private_props, color_id=color_id)
+        if event_id:
+            body["id"] = event_id
+        self._ops.append((key, calendar_id, lambda: self._service.events().insert(calendarId=calendar_id, body=body)))
+
+    def patch(self, key: Hashable, calendar_id: str, event_id: str, start_dt, end_dt, tz: str = "Europe/Madrid", etag: Optional[str] = None, restore: bool = False) -> None:
+        body = _event_body(start_dt, end_dt, tz)
+        if restore:
+            # Un evento borrado conserva su id como cancelado; el parche lo devuelve a la agenda.
+            body["status"] = "confirmed"
+        self._ops.append((key, calendar_id, lambda: _if_match(self._service.events().patch(calendarId=calendar_id, eventId=event_id, body=body), etag)))
+
+    def delete(self, key: Hashable, calendar_id: str, event_id: str) -> None:
+        self._ops.append((key, calendar_id, lambda: self._service.events().delete(calendarId=calendar_id, eventId=event_id)))
+
+    def execute(self, max_workers: int = 1) -> Dict[Hashable, BatchItemResult]:
+        """Envía las operaciones pendientes y devuelve el resultado de cada `key`.
+
+        Con `max_workers` > 1 los lotes de `GCAL_BATCH_MAX` se envían en paralelo; cada
+        hilo construye sus peticiones para usar su propia conexión HTTP. Cada llamada
+        del lote consume un token de cuota, y las que fallan por cuota o 5xx se
+        reenvían en un lote nuevo tras el backoff.
+        """
+        ops, self._ops = self._ops, []
+        results: Dict[Hashable, BatchItemResult] = {}
+
+        def _send(chunk) -> None:
+            def _on_item(request_id: str, response: Any, exc: Optional[BaseException]) -> None:
+                key, cal_id, _ = chunk[int(request_id)]
+                if exc is None:
+                    results[key] = BatchItemResult(key, cal_id, True, response=response or {})
+                else:
+                    results[key] = BatchItemResult(key, cal_id, False, error=str(exc), status=_http_status(exc), retryable=is_retryable(exc))
+
+            try:
+                batch = self._service.new_batch_http_request(callback=_on_item)
+                for i, (_, _, make_request) in enumerate(chunk):
+                    batch.add(make_request(), request_id=str(i))
+                # Sólo se reserva cuota: reenviar el multipart entero duplicaría las inserciones que
+                # ya entraron. Los reintentos son por llamada, en el bucle de `execute`.
+                gcal_throttle.acquire(len(chunk))
+                gcal_breaker.call(batch.execute)
+            except Exception as e:
+                # Fallo de la petición multipart completa: lo no contestado se da por fallido.
+                for key, cal_id, _ in chunk:
+                    results.setdefault(key, BatchItemResult(key, cal_id, False, error=str(e), status=_http_status(e)))
+
+        attempt = 0
+        while ops:
+            chunks = [ops[lo:lo + self._max_size] for lo in range(0, len(ops), self._max_size)]
+            if max_workers > 1 and len(chunks) > 1:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)), thread_name_prefix="gcal-batch") as pool:
+                    list(pool.map(_send, chunks))
+            else:
+                for chunk in chunks:
+                    _send(chunk)
+            ops = [op for op in ops if results[op[0]].retryable]
+            if not ops or attempt >= gcal_throttle.max_retries:
+                break
+            for key, _, _ in ops:
+                del results[key]
+            gcal_throttle.wait_backoff(attempt, retried=len(ops))
+            attempt += 1
+        for cal_id in {r.calendar_id for r in results.values() if r.ok}:
+            freebusy_cache.invalidate(cal_id)
+        return results
+
+# Sólo las propiedades que usan sync, reconciliación y conflictos; reduce payload y cuota de lectura.
+EVENT_LIST_FIELDS = "nextPageToken,items(id,etag,updated,status,summary,start,end,extendedProperties/private)"
+
+def list_events_range(service: Any, calendar_id: str, time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid", fields: Optional[str] = EVENT_LIST_FIELDS) -> List[Dict[str, Any]]:
+    """Eventos de [time_min, time_max) siguiendo `nextPageToken` para no truncar rangos largos."""
+    params: Dict[str, Any] = {"calendarId": calendar_id, "timeMin": iso_datetime(time_min_iso, tz), "timeMax": iso_datetime(time_max_iso, tz), "singleEvents": True, "orderBy": "startTime", "timeZone": tz, "maxResults": 2500}
+    if fields:
+        params["fields"] = fields
+    items: List[Dict[str, Any]] = []
+    try:
+        while True:
+            resp = _execute(service.events().list(**params))
+            items.extend(resp.get("items", []))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return items
+            params["pageToken"] = page_token
     except Exception as e:
         raise RuntimeError(f"Error listando eventos: {e}")
 
+class SyncTokenExpired(RuntimeError):
+    """El syncToken ya no es válido (HTTP 410 Gone): hay que resincronizar desde cero."""
+
+def list_events_sync(service: Any, calendar_id: str, sync_token: Optional[str] = None, time_min: Optional[str] = None, tz: str = "Europe/Madrid") -> tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Lista paginada para sincronización incremental. Devuelve (items, nextSyncToken).
+    Con `sync_token` sólo llegan eventos cambiados o cancelados (status="cancelled").
+    Sin él hace la carga completa desde `time_min`; la API no admite orderBy ni timeMax aquí.
+    """
+    params: Dict[str, Any] = {"calendarId": calendar_id, "singleEvents": True}
+    if sync_token:
+        params["syncToken"] = sync_token
+    elif time_min:
+        params["timeMin"] = iso_datetime(time_min, tz)
+    items: List[Dict[str, Any]] = []
+    page_token: Optional[str] = None
+    try:
+        while True:
+            if page_token:
+                params["pageToken"] = page_token
+            resp = _execute(service.events().list(**params))
+            items.extend(resp.get("items", []))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return items, resp.get("nextSyncToken")
+    except Exception as e:
+        if sync_token and _http_status(e) == 410:
+            raise SyncTokenExpired(str(e))
+        raise RuntimeError(f"Error listando eventos (sync): {e}")
+
 def list_events_allpages(service: Any, calendar_id: str, time_min: Optional[str] = None, time_max: Optional[str] = None, tz: str = "Europe/Madrid") -> List[Dict[str, Any]]:
     params = {"calendarId": calendar_id}
     if time_min or time_max:
@@ -250,7 +472,7 @@ def list_events_allpages(service: Any, calendar_id: str, time_min: Optional[str]
         while True:
             if page_token:
                 params["pageToken"] = page_token
-            resp = service.events().list(**params).execute()
+            resp = _execute(service.events().list(**params))
             items.extend(resp.get("items", []))
             page_token = resp.get("nextPageToken")
             if not page_token:
@@ -261,7 +483,8 @@ def list_events_allpages(service: Any, calendar_id: str, time_min: Optional[str]
 
 def clear_calendar(service: Any, calendar_id: str, time_min: Optional[str] = None, time_max: Optional[str] = None, only_pelubot: bool = False, dry_run: bool = False, tz: str = "Europe/Madrid") -> Dict[str, Any]:
     items = list_events_allpages(service, calendar_id, time_min, time_max, tz)
-    deleted = skipped = 0
+    skipped = 0
+    targets: List[str] = []
     for it in items:
         ev_id = it.get("id")
         if not ev_id:
@@ -271,11 +494,12 @@ def clear_calendar(service: Any, calendar_id: str, time_min: Optional[str] = Non
             if not priv.get("reservation_id"):
                 skipped += 1
                 continue
-        if not dry_run:
-            try:
-                service.events().delete(calendarId=calendar_id, eventId=ev_id).execute()
-            except Exception:
-                skipped += 1
-                continue
-        deleted += 1
-    return {"total_listed": len(items), "deleted": deleted, "skipped": skipped}
+        targets.append(ev_id)
+    if dry_run:
+        return {"total_listed": len(items), "deleted": len(targets), "skipped": skipped}
+    batch = EventBatch(service)
+    for ev_id in targets:
+        batch.delete(ev_id, calendar_id, ev_id)
+    results = batch.execute()
+    deleted = sum(1 for r in results.values() if r.ok)
+    return {"total_listed": len(items), "deleted": deleted, "skipped": skipped + len(targets) - deleted}
@@ -0,0 +1,260 @@
+"""
+Cliente asíncrono de Google Calendar sobre aiohttp (API REST v3).
+
+Expone `freebusy_multi`, `freebusy_multi_cached`, `list_events_range`, `create_event`,
+`patch_event` (con `etag` para `If-Match`) y `delete_event` con la misma firma y los mismos
+errores que `google_calendar`, pero como corrutinas: una espera a Google no ocupa un hilo del
+threadpool. Reutiliza las credenciales, la caché de freebusy, el limitador de cuota, el circuit
+breaker y el modo simulado del cliente síncrono. La sesión HTTP (pool de conexiones) pertenece
+al event loop que la crea; si cambia el loop se cierra la anterior antes de abrir otra.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+
+from app.integrations import google_calendar as _sync
+from app.integrations.freebusy_cache import freebusy_cache
+from app.integrations.rate_limit import gcal_throttle
+from app.integrations.circuit_breaker import gcal_breaker
+from app.integrations.google_calendar import EVENT_LIST_FIELDS, FakeCalendarService, _event_body, _if_match, iso_datetime
+
+logger = logging.getLogger("pelubot.gcal")
+
+GCAL_API_BASE = "https://www.googleapis.com/calendar/v3"
+GCAL_ASYNC_POOL_SIZE = int(os.getenv("GCAL_ASYNC_POOL_SIZE", "100"))
+
+
+class AsyncHttpError(Exception):
+    """Respuesta HTTP >= 400; expone `resp.status` como `googleapiclient.errors.HttpError`."""
+
+    class _Resp:
+        def __init__(self, status: int):
+            self.status = status
+
+    def __init__(self, status: int, body: str):
+        super().__init__(f"HTTP {status}: {body[:300]}")
+        self.resp = self._Resp(status)
+        self.body = body
+
+
+class AsyncCalendarClient:
+    """Peticiones REST autenticadas con un `aiohttp.ClientSession` compartido (keep-alive)."""
+
+    def __init__(self, creds: Any, session: Any = None, pool_size: int = GCAL_ASYNC_POOL_SIZE, timeout_s: float = _sync.GCAL_HTTP_TIMEOUT_S):
+        self._creds = creds
+        self._session = session
+        self._owns_session = session is None
+        self._pool_size = pool_size
+        self._timeout_s = timeout_s
+        self._loop: Any = None
+        self._refresh_lock: Optional[asyncio.Lock] = None
+
+    async def _http(self) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._owns_session and self._loop is not loop:
+            # Sesión y lock van ligados al event loop; uno nuevo (p. ej. en tests) necesita los suyos.
+            stale, stale_loop = self._session, self._loop
+            self._session = None
+            self._refresh_lock = None
+            self._loop = loop
+            if stale is not None and not stale.closed:
+                await _close_stale_session(stale, stale_loop)
+        if self._session is None or getattr(self._session, "closed", False):
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self._pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self._timeout_s))
+        return self._session
+
+    def _needs_refresh(self) -> bool:
+        expiry = getattr(self._creds, "expiry", None)
+        if not getattr(self._creds, "token", None):
+            return True
+        return expiry is not None and expiry - datetime.utcnow() <= timedelta(seconds=_sync.GCAL_REFRESH_MARGIN_S)
+
+    async def _token(self) -> str:
+        if self._needs_refresh():
+            await self._http()
+            if self._refresh_lock is None:
+                self._refresh_lock = asyncio.Lock()
+            async with self._refresh_lock:
+                if self._needs_refresh():
+                    # google-auth sólo ofrece refresh bloqueante; se aparta del event loop.
+                    await asyncio.to_thread(self._creds.refresh, _sync.Request())
+        return self._creds.token
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None, json: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        headers = {**(headers or {}), "Authorization": f"Bearer {await self._token()}"}
+        query = {k: ("true" if v is True else "false" if v is False else v) for k, v in (params or {}).items() if v is not None}
+        session = await self._http()
+        async with session.request(method, f"{GCAL_API_BASE}{path}", params=query, json=json, headers=headers) as resp:
+            if resp.status >= 400:
+                raise AsyncHttpError(resp.status, await resp.text())
+            if resp.status == 204:
+                return {}
+            return await resp.json(content_type=None) or {}
+
+    async def freebusy_query(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request("POST", "/freeBusy", json=body)
+
+    async def events_list(self, calendar_id: str, **params: Any) -> Dict[str, Any]:
+        return await self.request("GET", f"/calendars/{quote(calendar_id, safe='')}/events", params=params)
+
+    async def events_insert(self, calendar_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request("POST", f"/calendars/{quote(calendar_id, safe='')}/events", json=body)
+
+    async def events_patch(self, calendar_id: str, event_id: str, body: Dict[str, Any], etag: Optional[str] = None) -> Dict[str, Any]:
+        headers = {"If-Match": etag} if etag else None
+        return await self.request("PATCH", f"/calendars/{quote(calendar_id, safe='')}/events/{quote(event_id, safe='')}", json=body, headers=headers)
+
+    async def events_delete(self, calendar_id: str, event_id: str) -> None:
+        await self.request("DELETE", f"/calendars/{quote(calendar_id, safe='')}/events/{quote(event_id, safe='')}")
+
+    async def close(self) -> None:
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+        self._session = None
+
+
+async def _close_stale_session(session: Any, loop: Any) -> None:
+    """Cierra la sesión de un event loop anterior sin dejar sus conexiones abiertas."""
+    try:
+        if loop is not None and loop.is_running():
+            # Loop vivo en otro hilo: sus conexiones sólo pueden cerrarse desde él.
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), loop))
+        else:
+            await session.close()
+    except Exception as e:
+        # Con el loop ya cerrado sus transportes no admiten más callbacks; se registra y se sigue.
+        logger.warning("No se pudo cerrar la sesión HTTP de un event loop anterior: %s", e)
+
+
+class AsyncFakeCalendarService:
+    """Contraparte asíncrona de `FakeCalendarService`; comparte su almacén en memoria."""
+
+    def __init__(self, fake: Optional[FakeCalendarService] = None):
+        self._fake = fake or FakeCalendarService()
+
+    async def _run(self, request: Any) -> Any:
+        # Con latencia simulada la espera sale del event loop, como una petición real.
+        if self._fake.config.latency_ms or self._fake.config.jitter_ms:
+            return await asyncio.to_thread(request.execute)
+        return request.execute()
+
+    async def freebusy_query(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._run(self._fake.freebusy().query(body=body))
+
+    async def events_list(self, calendar_id: str, **params: Any) -> Dict[str, Any]:
+        return await self._run(self._fake.events().list(calendarId=calendar_id, **params))
+
+    async def events_insert(self, calendar_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._run(self._fake.events().insert(calendarId=calendar_id, body=body))
+
+    async def events_patch(self, calendar_id: str, event_id: str, body: Dict[str, Any], etag: Optional[str] = None) -> Dict[str, Any]:
+        return await self._run(_if_match(self._fake.events().patch(calendarId=calendar_id, eventId=event_id, body=body), etag))
+
+    async def events_delete(self, calendar_id: str, event_id: str) -> None:
+        await self._run(self._fake.events().delete(calendarId=calendar_id, eventId=event_id))
+
+    async def close(self) -> None:
+        return None
+
+
+_async_client: Any = None
+
+
+async def _call(fn) -> Any:
+    # Mismo orden que el cliente síncrono: circuito, cuota y reintentos.
+    return await gcal_breaker.call_async(lambda: gcal_throttle.call_async(fn))
+
+
+def build_calendar_async() -> Any:
+    """Cliente asíncrono compartido; en pytest o con PELUBOT_FAKE_GCAL=1 envuelve el cliente falso."""
+    global _async_client
+    if _async_client is not None:
+        return _async_client
+    if _sync._use_fake():
+        _async_client = AsyncFakeCalendarService(_sync.build_calendar())
+        return _async_client
+    creds = _sync._load_sa_creds() or _sync._load_user_creds()
+    if not creds:
+        raise RuntimeError("No hay credenciales. Exporta GOOGLE_SERVICE_ACCOUNT_JSON o GOOGLE_OAUTH_JSON")
+    _async_client = AsyncCalendarClient(creds)
+    return _async_client
+
+
+def reset_calendar_client_async() -> None:
+    """Olvida el cliente compartido sin cerrarlo (tests o tras rotar credenciales)."""
+    global _async_client
+    _async_client = None
+
+
+async def close_calendar_async() -> None:
+    """Cierra el pool HTTP del cliente compartido (al apagar la aplicación)."""
+    global _async_client
+    client, _async_client = _async_client, None
+    if client is not None:
+        await client.close()
+
+
+async def freebusy_multi(service: Any, calendar_ids: list[str], time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid") -> Dict[str, List[Dict[str, str]]]:
+    body = {"timeMin": iso_datetime(time_min_iso, tz), "timeMax": iso_datetime(time_max_iso, tz), "timeZone": tz, "items": [{"id": cid} for cid in calendar_ids]}
+    try:
+        cals = (await _call(lambda: service.freebusy_query(body))).get("calendars", {})
+    except Exception as e:
+        raise RuntimeError(f"Error consultando freebusy (multi): {e}") from e
+    return {cid: cals.get(cid, {}).get("busy", []) for cid in calendar_ids}
+
+
+async def freebusy_multi_cached(service: Any, calendar_ids: list[str], time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid") -> Dict[str, List[Dict[str, str]]]:
+    """`freebusy_multi` detrás de la caché compartida con el cliente síncrono."""
+    key = freebusy_cache.make_key(calendar_ids, iso_datetime(time_min_iso, tz), iso_datetime(time_max_iso, tz), tz)
+    return await freebusy_cache.get_or_fetch_async(key, lambda: freebusy_multi(service, list(key[0]), time_min_iso, time_max_iso, tz))
+
+
+async def list_events_range(service: Any, calendar_id: str, time_min_iso: str, time_max_iso: str, tz: str = "Europe/Madrid", fields: Optional[str] = EVENT_LIST_FIELDS) -> List[Dict[str, Any]]:
+    params: Dict[str, Any] = {"timeMin": iso_datetime(time_min_iso, tz), "timeMax": iso_datetime(time_max_iso, tz), "singleEvents": True, "orderBy": "startTime", "timeZone": tz, "maxResults": 2500}
+    if fields:
+        params["fields"] = fields
+    items: List[Dict[str, Any]] = []
+    try:
+        while True:
+            resp = await _call(lambda: service.events_list(calendar_id, **params))
+            items.extend(resp.get("items", []))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return items
+            params["pageToken"] = page_token
+    except Exception as e:
+        raise RuntimeError(f"Error listando eventos: {e}") from e
+
+
+async def create_event(service: Any, calendar_id: str, start_dt, end_dt, summary: str, private_props: Dict[str, str] = None, color_id: Optional[str] = None, tz: str = "Europe/Madrid") -> Dict[str, Any]:
+    body = _event_body(start_dt, end_dt, tz, summary=summary, private_props=private_props, color_id=color_id)
+    try:
+        ev = await _call(lambda: service.events_insert(calendar_id, body))
+    except Exception as e:
+        raise RuntimeError(f"Error creando evento: {e}") from e
+    freebusy_cache.invalidate(calendar_id)
+    return ev
+
+
+async def patch_event(service: Any, calendar_id: str, event_id: str, start_dt, end_dt, tz: str = "Europe/Madrid", etag: Optional[str] = None) -> Dict[str, Any]:
+    body = _event_body(start_dt, end_dt, tz)
+    try:
+        ev = await _call(lambda: service.events_patch(calendar_id, event_id, body, etag=etag))
+    except Exception as e:
+        raise RuntimeError(f"Error modificando evento: {e}") from e
+    freebusy_cache.invalidate(calendar_id)
+    return ev
+
+
+async def delete_event(service: Any, calendar_id: str, event_id: str) -> None:
+    try:
+        await _call(lambda: service.events_delete(calendar_id, event_id))
+    except Exception as e:
+        raise RuntimeError(f"Error eliminando evento: {e}") from e
+    freebusy_cache.invalidate(calendar_id)
@@ -0,0 +1,176 @@
+"""
+Limitador de cuota (token bucket) y reintentos con backoff exponencial y jitter para Google.
+
+Todas las llamadas a Calendar reservan tokens del mismo cubo, de modo que las
+operaciones masivas (sync, push, limpieza) avanzan al ritmo sostenible de la cuota
+en vez de chocar con 403 rateLimitExceeded / 429 y abortar a mitad. La reserva no
+bloquea: devuelve cuánto hay que esperar, y el llamador duerme (hilo) o hace
+`await asyncio.sleep` (cliente asíncrono).
+"""
+from __future__ import annotations
+import asyncio
+import os
+import random
+import threading
+import time as _time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+def http_status(exc: BaseException) -> Optional[int]:
+    status = getattr(getattr(exc, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    status = http_status(exc)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    content = getattr(exc, "content", None) or getattr(exc, "body", None) or b""
+    text = content.decode("utf-8", "ignore") if isinstance(content, bytes) else str(content)
+    return any(r in text for r in RATE_LIMIT_REASONS)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    return is_rate_limited(exc) or http_status(exc) in RETRYABLE_STATUS
+
+
+class TokenBucket:
+    """Cubo de `burst` tokens que se rellena a `rate` tokens/s; thread-safe."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._stamp = _time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: float = 1.0) -> float:
+        """Descuenta `n` tokens (puede quedar en deuda) y devuelve los segundos a esperar."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = _time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= n
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class GoogleThrottle:
+    """Token bucket compartido más política de reintentos, con métricas acumuladas."""
+
+    def __init__(self, rate: float, burst: float, max_retries: int = 5, backoff_base_s: float = 0.5, backoff_max_s: float = 32.0, sleep: Callable[[float], None] = _time.sleep):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base_s = float(backoff_base_s)
+        self.backoff_max_s = float(backoff_max_s)
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._reset_counters()
+
+    def _reset_counters(self) -> None:
+        self.calls = 0
+        self.throttled_s = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self.backoff_s = 0.0
+        self.gave_up = 0
+
+    def _count(self, **deltas: float) -> None:
+        with self._lock:
+            for k, v in deltas.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def backoff(self, attempt: int) -> float:
+        """Backoff exponencial con full jitter: uniforme en [0, min(max, base * 2^attempt)]."""
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    def acquire(self, n: float = 1.0) -> None:
+        wait = self.bucket.reserve(n)
+        self._count(calls=n, throttled_s=wait)
+        if wait > 0:
+            self._sleep(wait)
+
+    async def acquire_async(self, n: float = 1.0) -> None:
+        wait = self.bucket.reserve(n)
+        self._count(calls=n, throttled_s=wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _should_retry(self, exc: BaseException, attempt: int) -> Optional[float]:
+        if attempt >= self.max_retries or not is_retryable(exc):
+            if is_retryable(exc):
+                self._count(gave_up=1)
+            return None
+        delay = self.backoff(attempt)
+        self._count(retries=1, rate_limited=1 if is_rate_limited(exc) else 0, backoff_s=delay)
+        return delay
+
+    def wait_backoff(self, attempt: int, retried: int = 1) -> None:
+        """Espera el backoff del intento `attempt` antes de reenviar `retried` llamadas (p. ej. de un batch)."""
+        delay = self.backoff(attempt)
+        self._count(retries=retried, backoff_s=delay)
+        self._sleep(delay)
+
+    def call(self, fn: Callable[[], Any], cost: float = 1.0) -> Any:
+        attempt = 0
+        while True:
+            self.acquire(cost)
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._should_retry(e, attempt)
+                if delay is None:
+                    raise
+                self._sleep(delay)
+                attempt += 1
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]], cost: float = 1.0) -> Any:
+        attempt = 0
+        while True:
+            await self.acquire_async(cost)
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._should_retry(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def reset(self, rate: Optional[float] = None, burst: Optional[float] = None) -> None:
+        """Pone a cero las métricas y rellena el cubo; `rate=0` desactiva la limitación."""
+        with self._lock:
+            self._reset_counters()
+        self.bucket = TokenBucket(self.bucket.rate if rate is None else rate, self.bucket.burst if burst is None else burst)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rate_per_s": self.bucket.rate,
+                "burst": self.bucket.burst,
+                "calls": int(self.calls),
+                "throttled_s": round(self.throttled_s, 3),
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "backoff_s": round(self.backoff_s, 3),
+                "gave_up": self.gave_up,
+            }
+
+
+# Cuota por defecto de Calendar: 600 peticiones/min por usuario (10/s); se deja margen.
+gcal_throttle = GoogleThrottle(
+    rate=float(os.getenv("GCAL_QPS", "8")),
+    burst=float(os.getenv("GCAL_BURST", "10")),
+    max_retries=int(os.getenv("GCAL_MAX_RETRIES", "5")),
+    backoff_base_s=float(os.getenv("GCAL_BACKOFF_BASE_S", "0.5")),
+    backoff_max_s=float(os.getenv("GCAL_BACKOFF_MAX_S", "32")),
+)
@@ -18,7 +18,13 @@ from app.db import create_db_and_tables
 from sqlmodel import Session
 from datetime import date, timedelta
 from app.db import engine
-from app.services.logic import sync_from_gcal_range
+from app.services.logic import sync_from_gcal_range, sync_from_gcal_incremental
+from app.services.slot_grid import start_grids
+from app.services.outbox import OutboxWorker
+from app.services.conflict_reports import ConflictReportWorker, CONFLICT_REPORT_INTERVAL_S
+from app.services.gcal_watch import ChannelRenewer, GCAL_WATCH_CHECK_S, GCAL_WEBHOOK_URL
+from app.services.worker_lease import LeaderLease, run_workers_enabled
+from app.integrations.google_calendar_async import close_calendar_async
 
 from app.core.logging_config import setup_logging
 from app.core.middleware import RequestIDMiddleware
@@ -29,6 +35,7 @@ from app.core.errors import install_exception_handlers
 async def lifespan(app: FastAPI):
     setup_logging()
     create_db_and_tables()
+    start_grids.rebuild()
 
     try:
         if os.getenv("AUTO_SYNC_FROM_GCAL", "false").lower() in ("1","true","yes","si","sí","y"):
@@ -36,13 +43,44 @@ async def lifespan(app: FastAPI):
             default_service = os.getenv("DEFAULT_SERVICE_FOR_SYNC", "corte")
             start = date.today()
             end = start + timedelta(days=max(0, days-1))
+            incremental = os.getenv("AUTO_SYNC_INCREMENTAL", "true").lower() in ("1","true","yes","si","sí","y")
             with Session(engine) as s:
-                sync_from_gcal_range(s, start, end, default_service=default_service, by_professional=True)
+                if incremental:
+                    sync_from_gcal_incremental(s, default_service=default_service)
+                else:
+                    sync_from_gcal_range(s, start, end, default_service=default_service, by_professional=True)
     except Exception:
         pass
 
+    # Los trabajos de fondo corren en un único proceso: el que tenga el plazo `worker_lease`.
+    # En tests el outbox se drena a mano para que los resultados sean deterministas.
+    lease = worker = reports = channels = None
+    if run_workers_enabled() and not os.getenv("PYTEST_CURRENT_TEST"):
+        lease = LeaderLease(engine)
+        lease.start()
+        if os.getenv("OUTBOX_WORKER", "true").lower() in ("1","true","yes","si","sí","y"):
+            worker = OutboxWorker(engine, lease=lease)
+            worker.start()
+        if CONFLICT_REPORT_INTERVAL_S > 0:
+            reports = ConflictReportWorker(engine, lease=lease)
+            reports.start()
+        if GCAL_WEBHOOK_URL and GCAL_WATCH_CHECK_S > 0:
+            # Registra los canales al arrancar y los renueva antes de que caduquen.
+            channels = ChannelRenewer(engine, lease=lease)
+            channels.start()
+
     yield
 
+    if worker is not None:
+        worker.stop()
+    if reports is not None:
+        reports.stop()
+    if channels is not None:
+        channels.stop()
+    if lease is not None:
+        lease.stop()
+    await close_calendar_async()
+
 
 def create_app() -> FastAPI:
     app = FastAPI(
@@ -0,0 +1,117 @@
+"""
+Migraciones de esquema versionadas y ligeras.
+
+`create_all` crea las tablas que faltan pero nunca altera las existentes, así que las
+columnas e índices nuevos de una tabla ya creada (p. ej. el `pelubot.db` de producción) se
+aplican aquí. Cada migración tiene un número creciente, se ejecuta una sola vez y queda
+anotada en `schema_version`.
+
+Cada worker de uvicorn migra al arrancar, así que todo (tablas nuevas, migraciones y su
+registro) va en una transacción exclusiva: `BEGIN IMMEDIATE` en SQLite y
+`pg_advisory_xact_lock` en Postgres. El segundo proceso espera al primero y, ya con el bloqueo,
+relee `schema_version` y no encuentra nada pendiente. Aun así los pasos deben tolerar estar ya
+aplicados: en una BD nueva `create_all` ya ha creado lo que añaden y sólo se registran.
+"""
+from __future__ import annotations
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Iterator
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+
+logger = logging.getLogger("pelubot.migrations")
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+
+def _add_columns(conn: Connection, table_name: str, names: Iterable[str]) -> None:
+    """Añade las columnas (anulables) del modelo que falten; SQLite no reescribe la tabla."""
+    insp = inspect(conn)
+    if not insp.has_table(table_name):
+        return
+    existing = {c["name"] for c in insp.get_columns(table_name)}
+    table = SQLModel.metadata.tables[table_name]
+    for name in names:
+        if name not in existing:
+            col = table.c[name]
+            conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN "{name}" {col.type.compile(dialect=conn.dialect)}'))
+
+
+def _create_indexes(conn: Connection, table_name: str, names: Iterable[str]) -> None:
+    wanted = set(names)
+    for idx in SQLModel.metadata.tables[table_name].indexes:
+        if idx.name in wanted:
+            idx.create(conn, checkfirst=True)
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "reservationdb: etag, updated y huella del evento de GCal",
+     lambda conn: _add_columns(conn, "reservationdb", ("google_etag", "google_updated", "gcal_fingerprint"))),
+    (2, "reservationdb: índices por profesional y horario, por inicio y por evento de GCal",
+     lambda conn: _create_indexes(conn, "reservationdb", ("ix_reservationdb_professional_id_start_end", "ix_reservationdb_start", "ix_reservationdb_google_event_id"))),
+    (3, "gcal_outbox: plazo de las filas reservadas por un drenado",
+     lambda conn: _add_columns(conn, "gcal_outbox", ("lease_until",))),
+]
+
+
+# Clave del bloqueo consultivo de Postgres; cualquier entero fijo propio de la aplicación.
+_PG_LOCK_KEY = 0x70656C75  # "pelu"
+
+
+@contextmanager
+def _exclusive(engine: Engine) -> Iterator[Connection]:
+    """Conexión dentro de una transacción que excluye a otros procesos migrando a la vez."""
+    with engine.connect() as conn:
+        if conn.dialect.name == "sqlite":
+            # pysqlite abre las transacciones por su cuenta y en diferido; aquí se toma el
+            # bloqueo de escritura desde el principio para que la lectura de versiones ya cuente.
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+            conn.exec_driver_sql("COMMIT")
+            return
+        with conn.begin():
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _PG_LOCK_KEY})
+            yield conn
+
+
+def current_version(engine: Engine) -> int:
+    with engine.connect() as conn:
+        if not inspect(conn).has_table(schema_version.name):
+            return 0
+        return conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc()).limit(1)).scalar() or 0
+
+
+def run_migrations(engine: Engine) -> list[int]:
+    """Crea las tablas que falten y aplica en orden las migraciones pendientes.
+
+    Devuelve las versiones aplicadas por esta llamada (ninguna si otro proceso se adelantó).
+    """
+    applied: list[tuple[int, str]] = []
+    with _exclusive(engine) as conn:
+        SQLModel.metadata.create_all(conn)
+        schema_version.create(conn, checkfirst=True)
+        done = set(conn.execute(select(schema_version.c.version)).scalars())
+        for version, name, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            migrate(conn)
+            conn.execute(schema_version.insert().values(version=version, name=name, applied_at=datetime.now(timezone.utc)))
+            applied.append((version, name))
+    for version, name in applied:
+        logger.info("Migración %d aplicada: %s", version, name)
+    return [version for version, _ in applied]
@@ -3,10 +3,11 @@ Modelos principales de datos para la API de reservas.
 Incluye servicios, profesionales, reservas y estructuras de consulta.
 """
 from pydantic import BaseModel, Field, field_validator
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime, date, timezone
 from sqlmodel import SQLModel, Field as SQLField
-from sqlalchemy.types import DateTime
+from sqlalchemy import Index
+from sqlalchemy.types import DateTime, JSON
 from app.utils.date import validate_target_dt, TZ
 
 class Service(BaseModel):
@@ -40,11 +41,27 @@ class SlotsQuery(BaseModel):
     use_gcal: Optional[bool] = None
 
 class SlotsOut(BaseModel):
-    """Respuesta con huecos disponibles."""
+    """Respuesta con huecos disponibles y, por inicio, los profesionales libres."""
     service_id: str
     date: date
     professional_id: Optional[str]
     slots: List[str]
+    free_professionals: Dict[str, List[str]] = Field(default_factory=dict)
+
+class SlotsBatchIn(BaseModel):
+    """Varias consultas de huecos resueltas en una sola petición."""
+    queries: List[SlotsQuery] = Field(..., min_length=1, max_length=50)
+
+class SlotsBatchItemOut(BaseModel):
+    service_id: str
+    date_str: str
+    professional_id: Optional[str] = None
+    slots: List[str] = Field(default_factory=list)
+    free_professionals: Dict[str, List[str]] = Field(default_factory=dict)
+    error: Optional[str] = None
+
+class SlotsBatchOut(BaseModel):
+    results: List[SlotsBatchItemOut]
 
 class DaysAvailabilityIn(BaseModel):
     """Rango de días con disponibilidad de slots.
@@ -63,6 +80,20 @@ class DaysAvailabilityOut(BaseModel):
     professional_id: Optional[str] = None
     available_days: List[str]
 
+class NextSlotsIn(BaseModel):
+    """Búsqueda de los primeros huecos libres a partir de un instante."""
+    service_id: str
+    after: Optional[datetime] = None
+    professional_id: Optional[str] = None
+    limit: int = Field(5, ge=1, le=50)
+    use_gcal: Optional[bool] = None
+
+class NextSlotsOut(BaseModel):
+    service_id: str
+    professional_id: Optional[str] = None
+    after: datetime
+    slots: List[str]
+
 class CancelReservationIn(BaseModel):
     """Solicitud de cancelación de reserva."""
     reservation_id: str = Field(..., json_schema_extra={"example": "res_1"})
@@ -104,7 +135,14 @@ class ReservationIn(BaseModel):
         return v
 
 class ReservationDB(SQLModel, table=True):
-    __table_args__ = {"extend_existing": True}
+    # Las consultas de ocupación filtran por profesional y solape (start < X, end > Y); el
+    # listado ordena por inicio y la importación de cancelaciones busca por evento de GCal.
+    __table_args__ = (
+        Index("ix_reservationdb_professional_id_start_end", "professional_id", "start", "end"),
+        Index("ix_reservationdb_start", "start"),
+        Index("ix_reservationdb_google_event_id", "google_event_id"),
+        {"extend_existing": True},
+    )
     id: str = SQLField(primary_key=True)
     service_id: str = SQLField()
     professional_id: str = SQLField()
@@ -112,5 +150,93 @@ class ReservationDB(SQLModel, table=True):
     end: datetime = SQLField(sa_type=DateTime(timezone=True))
     google_event_id: Optional[str] = SQLField(default=None, nullable=True)
     google_calendar_id: Optional[str] = SQLField(default=None, nullable=True)
+    # Última versión del evento vista en Google y huella de lo que se le envió (o se importó):
+    # si la huella coincide con la fila actual, la reconciliación no necesita consultar Google.
+    google_etag: Optional[str] = SQLField(default=None, nullable=True)
+    google_updated: Optional[datetime] = SQLField(default=None, sa_type=DateTime(timezone=True), nullable=True)
+    gcal_fingerprint: Optional[str] = SQLField(default=None, nullable=True)
+    created_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+    updated_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+
+class GCalSyncState(SQLModel, table=True):
+    """Último `nextSyncToken` de Google Calendar por calendario para importaciones incrementales."""
+    __tablename__ = "gcal_sync_state"
+    __table_args__ = {"extend_existing": True}
+    calendar_id: str = SQLField(primary_key=True)
+    sync_token: Optional[str] = SQLField(default=None, nullable=True)
+    last_full_sync_at: Optional[datetime] = SQLField(default=None, sa_type=DateTime(timezone=True), nullable=True)
+    updated_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+
+class GCalChannel(SQLModel, table=True):
+    """Canal de notificaciones push (events.watch) registrado para un calendario."""
+    __tablename__ = "gcal_channels"
+    __table_args__ = {"extend_existing": True}
+    id: str = SQLField(primary_key=True)
+    calendar_id: str = SQLField(index=True)
+    resource_id: Optional[str] = SQLField(default=None, nullable=True)
+    token: str
+    address: str
+    expiration: Optional[datetime] = SQLField(default=None, sa_type=DateTime(timezone=True), nullable=True)
+    created_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+
+class GCalOutbox(SQLModel, table=True):
+    """Escritura pendiente en Google Calendar, grabada en la misma transacción que la reserva.
+
+    `upsert` lee el estado actual de la reserva al procesarse (idempotente); `delete` guarda
+    el evento y calendario que había al cancelar porque la fila ya no existe.
+    """
+    __tablename__ = "gcal_outbox"
+    __table_args__ = {"extend_existing": True}
+    id: Optional[int] = SQLField(default=None, primary_key=True)
+    reservation_id: str = SQLField(index=True)
+    op: str
+    calendar_id: Optional[str] = SQLField(default=None, nullable=True)
+    event_id: Optional[str] = SQLField(default=None, nullable=True)
+    status: str = SQLField(default="pending", index=True)
+    attempts: int = 0
+    next_attempt_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+    # Mientras `status` es "inflight" la fila es de un drenado; caducado el plazo, se puede volver a reservar.
+    lease_until: Optional[datetime] = SQLField(default=None, sa_type=DateTime(timezone=True), nullable=True)
+    last_error: Optional[str] = SQLField(default=None, nullable=True)
     created_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+
+class ConflictReport(SQLModel, table=True):
+    """Conflictos BD ↔ GCal de un profesional en un día, calculados en segundo plano.
+
+    `fingerprint` resume las reservas y eventos del día: si no cambia, el día no se recalcula.
+    """
+    __tablename__ = "conflict_report"
+    __table_args__ = {"extend_existing": True}
+    professional_id: str = SQLField(primary_key=True)
+    day: date = SQLField(primary_key=True)
+    calendar_id: str
+    fingerprint: str
+    missing_in_gcal: int = 0
+    orphaned_in_gcal: int = 0
+    time_mismatch: int = 0
+    overlaps_external: int = 0
+    samples: Dict[str, List[dict]] = SQLField(default_factory=dict, sa_type=JSON)
+    computed_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+
+class ConflictReportState(SQLModel, table=True):
+    """Copia de los eventos de un calendario que usan los informes de conflictos.
+
+    Lleva su propio `nextSyncToken`: el de `gcal_sync_state` lo consume la importación y
+    compartirlo haría que uno de los dos se perdiera cambios. `events` guarda, por id, los
+    eventos que terminan después de `window_start` (sólo id, horario y reserva etiquetada).
+    """
+    __tablename__ = "conflict_report_state"
+    __table_args__ = {"extend_existing": True}
+    calendar_id: str = SQLField(primary_key=True)
+    sync_token: Optional[str] = SQLField(default=None, nullable=True)
+    window_start: date
+    events: Dict[str, dict] = SQLField(default_factory=dict, sa_type=JSON)
     updated_at: datetime = SQLField(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True), nullable=False)
+
+class WorkerLease(SQLModel, table=True):
+    """Plazo que reserva un trabajo de fondo para un único proceso (p. ej. con varios workers de uvicorn)."""
+    __tablename__ = "worker_lease"
+    __table_args__ = {"extend_existing": True}
+    name: str = SQLField(primary_key=True)
+    holder: str
+    expires_at: datetime = SQLField(sa_type=DateTime(timezone=True), nullable=False)
@@ -0,0 +1,116 @@
+"""
+Caché en proceso de disponibilidad con invalidación por versión (profesional, día).
+
+Cada entrada guarda la versión de los (profesional, día) de los que depende en el
+momento en que empezó el cálculo. Cualquier escritura sobre una reserva incrementa
+la versión de sus días, de modo que una entrada calculada antes de esa escritura
+deja de servirse aunque se haya guardado después.
+
+NOTE: la caché es local al proceso. Con varios workers, las escrituras de un worker
+no invalidan al resto; el TTL acota ese desfase (y el del busy externo de GCal).
+"""
+from __future__ import annotations
+import os
+import threading
+import time as _time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+Versions = Tuple[Tuple[int, int], ...]
+
+
+class AvailabilityCache:
+    """LRU acotada con TTL, contadores de aciertos/fallos y versiones por (profesional, día)."""
+
+    def __init__(self, maxsize: int = 512, ttl_s: float = 30.0):
+        self.maxsize = max(0, int(maxsize))
+        self.ttl_s = float(ttl_s)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Tuple[Tuple[str, date], ...], Versions, float]]" = OrderedDict()
+        self._versions: Dict[Tuple[str, date], int] = {}
+        self._pro_versions: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _current(self, deps: Iterable[Tuple[str, date]]) -> Versions:
+        return tuple((self._versions.get(dep, 0), self._pro_versions.get(dep[0], 0)) for dep in deps)
+
+    def snapshot(self, deps: Iterable[Tuple[str, date]]) -> Versions:
+        """Versiones actuales de las dependencias; tomarlas antes de calcular el valor."""
+        with self._lock:
+            return self._current(deps)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, deps, versions, stored_at = entry
+                fresh = self.ttl_s <= 0 or (_time.monotonic() - stored_at) < self.ttl_s
+                if fresh and versions == self._current(deps):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any, deps: Iterable[Tuple[str, date]], versions: Versions) -> None:
+        if self.maxsize == 0:
+            return
+        deps = tuple(deps)
+        with self._lock:
+            # Si hubo escrituras durante el cálculo, el valor ya nace obsoleto.
+            if versions != self._current(deps):
+                return
+            self._entries[key] = (value, deps, versions, _time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, pro_id: str, day: date) -> None:
+        with self._lock:
+            self._versions[(pro_id, day)] = self._versions.get((pro_id, day), 0) + 1
+            self.invalidations += 1
+
+    def invalidate_professional(self, pro_id: str) -> None:
+        """Invalida todos los días de un profesional (p. ej. tras un cambio externo en su calendario)."""
+        with self._lock:
+            self._pro_versions[pro_id] = self._pro_versions.get(pro_id, 0) + 1
+            self.invalidations += 1
+
+    def invalidate_interval(self, pro_id: str, start_dt: datetime, end_dt: datetime) -> None:
+        """Invalida todos los días que toca el intervalo (naive local)."""
+        d = start_dt.date()
+        last = max(d, (end_dt - timedelta(microseconds=1)).date())
+        while d <= last:
+            self.invalidate(pro_id, d)
+            d += timedelta(days=1)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._pro_versions.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+availability_cache = AvailabilityCache(
+    maxsize=int(os.getenv("AVAILABILITY_CACHE_SIZE", "512")),
+    ttl_s=float(os.getenv("AVAILABILITY_CACHE_TTL_S", "30")),
+)
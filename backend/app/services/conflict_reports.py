@@ -0,0 +1,251 @@
+"""
+Informes de conflictos BD ↔ Google Calendar calculados en segundo plano.
+
+Cada calendario guarda una copia de sus eventos (`conflict_report_state`) que se mantiene con
+su propio syncToken: una pasada sólo pide a Google lo cambiado desde la anterior, y la carga
+completa queda para la primera vez, un token caducado (410) o `force`. Reservas y eventos se
+agrupan por (profesional, día) y cada día lleva una huella: sólo se recalculan y reescriben los
+días cuya huella cambió. `/admin/conflicts` sirve lo guardado en `conflict_report` con la fecha
+de cálculo, sin esperar a Google.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterable, Optional
+
+from sqlmodel import Session, select
+
+from app.data import PRO_CALENDAR
+from app.integrations.google_calendar import SyncTokenExpired, list_events_sync
+from app.models import ConflictReport, ConflictReportState, ReservationDB
+from app.services.logic import (
+    CONFLICT_KINDS,
+    build_calendar,
+    calendar_conflicts,
+    event_interval,
+    page_conflict_samples,
+    per_calendar,
+    reservation_spans,
+    rows_by_pair,
+    tagged_reservation_id,
+    to_naive_local,
+)
+from app.services.worker_lease import WORKER_LEASE_TTL_S
+from app.utils.date import as_utc
+
+logger = logging.getLogger("pelubot.conflict_reports")
+
+CONFLICT_REPORT_INTERVAL_S = float(os.getenv("CONFLICT_REPORT_INTERVAL_S", "900"))
+CONFLICT_REPORT_DAYS = int(os.getenv("CONFLICT_REPORT_DAYS", "180"))
+
+# Tipos que se anotan sólo en el día en que empieza el evento; los solapes, en cada día que ocupa.
+_START_DAY_KINDS = ("orphaned_in_gcal", "time_mismatch")
+
+
+def _day_fingerprint(rows: Iterable[ReservationDB], items: Iterable[dict], spans: dict, gids: set) -> str:
+    """Huella de lo que determina los conflictos de un día: reservas, eventos y sus referencias."""
+    local = sorted((r.id, to_naive_local(r.start).isoformat(), to_naive_local(r.end).isoformat(), r.google_event_id or "", r.google_calendar_id or "", r.google_event_id in gids) for r in rows)
+    remote = []
+    for it in items:
+        span = event_interval(it)
+        rid = tagged_reservation_id(it)
+        ref = spans.get(rid) if rid else None
+        remote.append((it.get("id") or "", span[0].isoformat() if span else "", span[1].isoformat() if span else "", rid or "", ref[0].isoformat() if ref else "", ref[1].isoformat() if ref else ""))
+    payload = json.dumps([local, sorted(remote)], separators=(",", ":"))
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _compact_event(it: dict) -> dict:
+    """Lo que los informes usan de un evento: id, horario y reserva etiquetada."""
+    ev = {"id": it["id"], "start": it.get("start"), "end": it.get("end")}
+    rid = tagged_reservation_id(it)
+    if rid:
+        ev["extendedProperties"] = {"private": {"reservation_id": rid}}
+    return ev
+
+
+def _fetch_events(svc, state: ConflictReportState, start_date: date, force: bool, tz: str) -> tuple[list[dict], Optional[str], bool]:
+    """(eventos, nextSyncToken, completa): lo cambiado desde el token guardado o la carga completa."""
+    if state.sync_token and not force and state.window_start <= start_date:
+        try:
+            return list_events_sync(svc, state.calendar_id, sync_token=state.sync_token, tz=tz) + (False,)
+        except SyncTokenExpired:
+            pass
+    return list_events_sync(svc, state.calendar_id, time_min=datetime.combine(start_date, time(0, 0)), tz=tz) + (True,)
+
+
+def _apply_events(state: ConflictReportState, items: list[dict], next_token: Optional[str], full: bool, start_date: date) -> None:
+    """Aplica a la copia los eventos recibidos y descarta los que terminan antes de `start_date`."""
+    events = {} if full else dict(state.events or {})
+    for it in items:
+        ev_id = it.get("id")
+        if not ev_id:
+            continue
+        if it.get("status") == "cancelled":
+            events.pop(ev_id, None)
+        else:
+            events[ev_id] = _compact_event(it)
+    floor = datetime.combine(start_date, time(0, 0))
+    state.events = {ev_id: ev for ev_id, ev in events.items() if (span := event_interval(ev)) and span[1] > floor}
+    state.sync_token = next_token
+    state.window_start = start_date
+    state.updated_at = datetime.now(timezone.utc)
+
+
+def _days_covered(span: tuple[datetime, datetime], start_date: date, end_date: date) -> list[date]:
+    """Días del rango que ocupa un intervalo; uno que acaba a las 00:00 no cuenta el día siguiente."""
+    last = (span[1] - timedelta(microseconds=1)).date() if span[1] > span[0] else span[0].date()
+    first, last = max(span[0].date(), start_date), min(last, end_date)
+    return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+
+def refresh_conflict_reports(session: Session, start_date: date, end_date: date, professional_id: Optional[str] = None, force: bool = False, tz: str = os.getenv("TZ", "Europe/Madrid")) -> dict:
+    """Recalcula los días del rango cuya huella cambió (todos con `force`) y guarda el resultado.
+
+    Con `force` además se recarga entera la copia de eventos de cada calendario.
+    """
+    try:
+        svc = build_calendar()
+    except Exception as e:
+        return {"ok": False, "error": f"gcal client: {e}"}
+    pairs = [(cal, pid) for pid, cal in PRO_CALENDAR.items() if cal and (not professional_id or pid == professional_id)]
+    states = {cal: session.get(ConflictReportState, cal) or ConflictReportState(calendar_id=cal, window_start=start_date) for cal, _ in pairs}
+    errors: list[dict] = []
+    listed: list[tuple[str, str, list[dict]]] = []
+    range_start, range_end = datetime.combine(start_date, time(0, 0)), datetime.combine(end_date + timedelta(days=1), time(0, 0))
+    full_loads = 0
+    for (cal_id, pro_id), (fetched, err) in zip(pairs, per_calendar(lambda cal_id, _pid: _fetch_events(svc, states[cal_id], start_date, force, tz), pairs)):
+        if err is not None:
+            # Sin cambios fiables de este calendario sus días conservan el informe anterior.
+            errors.append({"calendar_id": cal_id, "error": str(err)})
+            continue
+        items, next_token, full = fetched
+        state = states[cal_id]
+        _apply_events(state, items, next_token, full, start_date)
+        session.add(state)
+        full_loads += full
+        in_range = [ev for ev in state.events.values() if (span := event_interval(ev)) and span[0] < range_end and span[1] > range_start]
+        listed.append((cal_id, pro_id, in_range))
+    rows_by_pro = rows_by_pair(session, pairs, start_date, end_date)
+    spans = reservation_spans(session, {rid for _, _, items in listed for it in items if (rid := tagged_reservation_id(it))})
+    q = select(ConflictReport).where(ConflictReport.day >= start_date, ConflictReport.day <= end_date)
+    if professional_id:
+        q = q.where(ConflictReport.professional_id == professional_id)
+    stored = {(rep.professional_id, rep.day): rep for rep in session.exec(q)}
+
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    now = datetime.now(timezone.utc)
+    recomputed = unchanged = 0
+    for cal_id, pro_id, items in listed:
+        gids = {it.get("id") for it in items if it.get("id")}
+        # Cada reserva va al día en que empieza; cada evento, a todos los días que ocupa, para que
+        # uno que cruza la medianoche también se compare con las reservas del día siguiente.
+        rows_by_day: dict[date, list[ReservationDB]] = {}
+        for r in rows_by_pro.get(pro_id, []):
+            rows_by_day.setdefault(to_naive_local(r.start).date(), []).append(r)
+        items_by_day: dict[date, list[dict]] = {}
+        carried_by_day: dict[date, set] = {}
+        for it in items:
+            covered = _days_covered(event_interval(it), start_date, end_date)
+            for d in covered:
+                items_by_day.setdefault(d, []).append(it)
+            for d in covered[1:]:
+                carried_by_day.setdefault(d, set()).add(it.get("id"))
+        for d in days:
+            rows, day_items = rows_by_day.get(d, []), items_by_day.get(d, [])
+            fp = _day_fingerprint(rows, day_items, spans, gids)
+            rep = stored.get((pro_id, d))
+            if rep is not None and rep.fingerprint == fp and not force:
+                unchanged += 1
+                continue
+            found = calendar_conflicts(cal_id, day_items, rows, gids, spans)
+            carried = carried_by_day.get(d)
+            if carried:
+                # Huérfanos y desajustes ya constan en el primer día del evento: no se cuentan dos veces.
+                for kind in _START_DAY_KINDS:
+                    found[kind] = [entry for entry in found[kind] if entry["event_id"] not in carried]
+            if rep is None:
+                rep = ConflictReport(professional_id=pro_id, day=d, calendar_id=cal_id, fingerprint=fp)
+            rep.calendar_id, rep.fingerprint, rep.computed_at = cal_id, fp, now
+            for kind in CONFLICT_KINDS:
+                setattr(rep, kind, len(found[kind]))
+            rep.samples = {kind: entries for kind, entries in found.items() if entries}
+            session.add(rep)
+            recomputed += 1
+    session.commit()
+    return {"ok": not errors, "days": len(days), "recomputed": recomputed, "unchanged": unchanged, "calendars": len(pairs), "full_loads": full_loads, "errors": errors, "checked_at": now.isoformat()}
+
+
+def get_conflict_report(session: Session, start_date: date, end_date: date, professional_id: Optional[str] = None, sample_limit: int = 10, sample_offset: int = 0) -> dict:
+    """Informe guardado del rango: contadores, página de ejemplos y frescura (`computed_at`)."""
+    q = select(ConflictReport).where(ConflictReport.day >= start_date, ConflictReport.day <= end_date)
+    if professional_id:
+        q = q.where(ConflictReport.professional_id == professional_id)
+    reports = sorted(session.exec(q), key=lambda rep: (rep.professional_id, rep.day))
+    found: dict[str, list[dict]] = {kind: [] for kind in CONFLICT_KINDS}
+    for rep in reports:
+        for kind in CONFLICT_KINDS:
+            found[kind].extend((rep.samples or {}).get(kind, []))
+    pros = [pid for pid, cal in PRO_CALENDAR.items() if cal and (not professional_id or pid == professional_id)]
+    expected = len(pros) * ((end_date - start_date).days + 1)
+    stamps = [as_utc(rep.computed_at) for rep in reports]
+    out = {
+        "ok": True,
+        "source": "stored",
+        # Un día sin cambios conserva su fecha de cálculo: `computed_at` es la más antigua del rango.
+        "computed_at": min(stamps).isoformat() if stamps else None,
+        "latest_computed_at": max(stamps).isoformat() if stamps else None,
+        "days_reported": len(reports),
+        "days_expected": expected,
+        "complete": len(reports) >= expected,
+    }
+    out.update(page_conflict_samples(found, sample_limit, sample_offset))
+    for kind in CONFLICT_KINDS:
+        out[kind] = sum(getattr(rep, kind) for rep in reports)
+    return out
+
+
+class ConflictReportWorker:
+    """Hilo que refresca los informes de hoy a `CONFLICT_REPORT_DAYS` cada `interval_s` segundos.
+
+    Con `lease` sólo hace la pasada si este proceso tiene el plazo de los trabajos de fondo:
+    varias copias se disputarían el syncToken guardado y gastarían cuota de Google.
+    """
+
+    def __init__(self, engine, interval_s: float = CONFLICT_REPORT_INTERVAL_S, days: int = CONFLICT_REPORT_DAYS, lease=None):
+        self._engine = engine
+        self._lease = lease
+        self._interval_s = interval_s
+        self._days = days
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="conflict-reports", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if self._lease is not None and not self._lease.held:
+                # Se vuelve a mirar pronto: si el proceso con el plazo cae, éste toma el relevo.
+                self._stop.wait(min(self._interval_s, WORKER_LEASE_TTL_S / 3))
+                continue
+            try:
+                start = date.today()
+                with Session(self._engine) as s:
+                    out = refresh_conflict_reports(s, start, start + timedelta(days=max(0, self._days - 1)))
+                logger.info("Informe de conflictos: %s días recalculados, %s sin cambios", out.get("recomputed"), out.get("unchanged"))
+            except Exception:
+                logger.exception("Error refrescando los informes de conflictos")
+            self._stop.wait(self._interval_s)
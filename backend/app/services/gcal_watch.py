@@ -0,0 +1,248 @@
+"""
+Canales de notificaciones push de Google Calendar (events.watch).
+
+Cada calendario de `PRO_CALENDAR` mantiene un canal vigente en `gcal_channels`.
+Cuando Google avisa de un cambio se responde al momento y, en segundo plano, se importa
+sólo ese calendario con su syncToken y se invalidan su freebusy en caché y la
+disponibilidad del profesional, de modo que los cambios hechos directamente en Google
+se reflejan sin esperar a /admin/sync.
+Los canales caducan (máx. ~7 días): `ensure_channels` los renueva antes de tiempo. Lo llama
+`ChannelRenewer` cada `GCAL_WATCH_CHECK_S` desde el único proceso con el plazo de los trabajos
+de fondo, y cada calendario se registra bajo un plazo propio en `worker_lease` para que dos
+llamadas a la vez (p. ej. el hilo y `/admin/gcal/watch`) no creen dos canales.
+"""
+from __future__ import annotations
+import logging
+import os
+import secrets
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlmodel import Session, select
+
+from app.data import PRO_CALENDAR
+from app.models import GCalChannel
+from app.integrations.freebusy_cache import freebusy_cache
+from app.integrations.google_calendar import build_calendar, watch_events, stop_channel
+from app.services.availability_cache import availability_cache
+from app.services.logic import sync_from_gcal_incremental
+from app.services.worker_lease import WORKER_LEASE_TTL_S, release, try_acquire
+from app.utils.date import as_utc
+
+logger = logging.getLogger("pelubot.gcal_watch")
+
+GCAL_WEBHOOK_URL = os.getenv("GCAL_WEBHOOK_URL", "")
+GCAL_WATCH_TTL_S = int(os.getenv("GCAL_WATCH_TTL_S", str(7 * 24 * 3600)))
+GCAL_WATCH_RENEW_BEFORE_S = int(os.getenv("GCAL_WATCH_RENEW_BEFORE_S", str(24 * 3600)))
+GCAL_WATCH_CHECK_S = float(os.getenv("GCAL_WATCH_CHECK_S", "3600"))
+# Plazo del bloqueo por calendario mientras se registra su canal (una llamada a Google).
+_REGISTER_LOCK_S = 120.0
+
+
+class UnknownChannel(LookupError):
+    """Notificación de un canal que no está registrado (o ya se detuvo)."""
+
+
+class InvalidChannelToken(PermissionError):
+    """El token o el resourceId de la notificación no coinciden con el canal guardado."""
+
+
+def _expiration(channel: dict) -> Optional[datetime]:
+    ms = channel.get("expiration")
+    return datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc) if ms else None
+
+
+def _targets(calendar_id: Optional[str], professional_id: Optional[str]) -> list[str]:
+    cals = {cal for pid, cal in PRO_CALENDAR.items() if cal and (not professional_id or pid == professional_id)}
+    if calendar_id:
+        cals = {c for c in cals if c == calendar_id} or {calendar_id}
+    return sorted(cals)
+
+
+def ensure_channels(session: Session, address: Optional[str] = None, calendar_id: Optional[str] = None, professional_id: Optional[str] = None, force: bool = False) -> dict:
+    """Registra o renueva los canales; mantiene los que no caducan en `GCAL_WATCH_RENEW_BEFORE_S`."""
+    address = address or GCAL_WEBHOOK_URL
+    if not address:
+        return {"ok": False, "error": "GCAL_WEBHOOK_URL no configurada"}
+    try:
+        svc = build_calendar()
+    except Exception as e:
+        return {"ok": False, "error": f"gcal client: {e}"}
+    holder = uuid.uuid4().hex
+    registered = kept = stopped = busy = 0
+    errors: list[dict] = []
+    for cal_id in _targets(calendar_id, professional_id):
+        lock = f"gcal_watch:{cal_id}"
+        if not try_acquire(session, lock, holder, _REGISTER_LOCK_S):
+            # Otro proceso está registrando este calendario ahora mismo.
+            busy += 1
+            continue
+        try:
+            outcome = _ensure_channel(session, svc, cal_id, address, force)
+        finally:
+            release(session, lock, holder)
+        if "error" in outcome:
+            errors.append({"calendar_id": cal_id, "error": outcome["error"]})
+        registered += outcome.get("registered", 0)
+        kept += outcome.get("kept", 0)
+        stopped += outcome.get("stopped", 0)
+    return {"ok": not errors, "registered": registered, "kept": kept, "stopped": stopped, "busy": busy, "errors": errors}
+
+
+def _ensure_channel(session: Session, svc, cal_id: str, address: str, force: bool) -> dict:
+    """Registra el canal de un calendario si no tiene uno vigente; se llama con su bloqueo tomado."""
+    # Se lee con el bloqueo tomado: un canal recién creado por otro proceso ya cuenta como vigente.
+    now = datetime.now(timezone.utc)
+    current = list(session.exec(select(GCalChannel).where(GCalChannel.calendar_id == cal_id)))
+    fresh = [c for c in current if c.address == address and c.expiration and as_utc(c.expiration) - now > timedelta(seconds=GCAL_WATCH_RENEW_BEFORE_S)]
+    if fresh and not force:
+        return {"kept": 1}
+    # El canal nuevo se registra antes de parar el viejo para no perder avisos en el cambio.
+    channel_id = str(uuid.uuid4())
+    token = secrets.token_urlsafe(24)
+    try:
+        resp = watch_events(svc, cal_id, channel_id, address, token, ttl_s=GCAL_WATCH_TTL_S)
+    except Exception as e:
+        return {"error": str(e)}
+    session.add(GCalChannel(id=channel_id, calendar_id=cal_id, resource_id=resp.get("resourceId"), token=token, address=address, expiration=_expiration(resp)))
+    for c in current:
+        try:
+            stop_channel(svc, c.id, c.resource_id)
+        except Exception as e:
+            # Si no se puede parar caduca solo; sus avisos se rechazan al no estar en BD.
+            logger.warning("No se pudo detener el canal %s: %s", c.id, e)
+        session.delete(c)
+    session.commit()
+    return {"registered": 1, "stopped": len(current)}
+
+
+def stop_channels(session: Session, calendar_id: Optional[str] = None) -> dict:
+    """Detiene y borra los canales registrados (todos o los de un calendario)."""
+    q = select(GCalChannel)
+    if calendar_id:
+        q = q.where(GCalChannel.calendar_id == calendar_id)
+    channels = list(session.exec(q))
+    errors: list[dict] = []
+    try:
+        svc = build_calendar()
+    except Exception as e:
+        svc = None
+        errors.append({"error": f"gcal client: {e}"})
+    for c in channels:
+        if svc is not None:
+            try:
+                stop_channel(svc, c.id, c.resource_id)
+            except Exception as e:
+                errors.append({"channel_id": c.id, "error": str(e)})
+        session.delete(c)
+    session.commit()
+    return {"ok": not errors, "stopped": len(channels), "errors": errors}
+
+
+def handle_notification(session: Session, channel_id: str, resource_state: str, token: Optional[str], resource_id: Optional[str] = None) -> dict:
+    """Valida un aviso de Google y decide si hay que importar (el estado `sync` es el saludo inicial).
+
+    No importa nada: el webhook responde al momento y la importación va en segundo plano
+    (`queue_calendar_sync` + `run_calendar_sync`).
+    """
+    channel = session.get(GCalChannel, channel_id)
+    if channel is None:
+        raise UnknownChannel(channel_id)
+    if not secrets.compare_digest(token or "", channel.token) or (resource_id and channel.resource_id and resource_id != channel.resource_id):
+        raise InvalidChannelToken(channel_id)
+    state = (resource_state or "").lower()
+    return {"ok": True, "state": state, "calendar_id": channel.calendar_id, "needs_sync": state != "sync"}
+
+
+def sync_notified_calendar(session: Session, calendar_id: str) -> dict:
+    """Importa con syncToken el calendario avisado e invalida su freebusy y la disponibilidad."""
+    result = sync_from_gcal_incremental(session, calendar_id=calendar_id)
+    # El busy de Google también incluye eventos que no se importan: se descarta todo lo del calendario.
+    freebusy_cache.invalidate(calendar_id)
+    for pid, cal in PRO_CALENDAR.items():
+        if cal == calendar_id:
+            availability_cache.invalidate_professional(pid)
+    return result
+
+
+# Google manda ráfagas de avisos por calendario: como mucho una importación en curso por
+# calendario y, si llegan avisos mientras corre, una única pasada más al terminar.
+_sync_lock = threading.Lock()
+_sync_requested: set[str] = set()
+_sync_running: set[str] = set()
+
+
+def queue_calendar_sync(calendar_id: str) -> bool:
+    """Anota el aviso. Devuelve True si el llamador debe lanzar `run_calendar_sync` (no hay otra en curso)."""
+    with _sync_lock:
+        _sync_requested.add(calendar_id)
+        if calendar_id in _sync_running:
+            return False
+        _sync_running.add(calendar_id)
+        return True
+
+
+def run_calendar_sync(bind, calendar_id: str) -> None:
+    """Importa el calendario hasta que no queden avisos pendientes; pensado para una tarea de fondo."""
+    try:
+        while True:
+            with _sync_lock:
+                if calendar_id not in _sync_requested:
+                    return
+                _sync_requested.discard(calendar_id)
+            with Session(bind) as s:
+                result = sync_notified_calendar(s, calendar_id)
+            if not result.get("ok"):
+                logger.warning("Importación por aviso de %s con errores: %s", calendar_id, result.get("errors"))
+    except Exception:
+        logger.exception("Error importando el calendario avisado %s", calendar_id)
+    finally:
+        with _sync_lock:
+            _sync_running.discard(calendar_id)
+
+
+class ChannelRenewer:
+    """Hilo que cada `interval_s` segundos registra o renueva los canales con `ensure_channels`.
+
+    Con `lease` sólo actúa en el proceso que tiene el plazo de los trabajos de fondo. Sin él
+    los avisos dejarían de llegar en silencio al caducar los canales si falta el cron externo.
+    """
+
+    def __init__(self, engine, interval_s: float = GCAL_WATCH_CHECK_S, lease=None):
+        self._engine = engine
+        self._interval_s = interval_s
+        self._lease = lease
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="gcal-watch", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run_once(self) -> Optional[dict]:
+        if self._lease is not None and not self._lease.held:
+            return None
+        with Session(self._engine) as s:
+            out = ensure_channels(s)
+        if out.get("registered") or not out.get("ok"):
+            logger.info("Canales de Google: %s", out)
+        return out
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                out = self.run_once()
+            except Exception:
+                out = None
+                logger.exception("Error renovando los canales de Google Calendar")
+            # Sin el plazo se vuelve a mirar pronto por si el proceso que lo tenía cae.
+            self._stop.wait(self._interval_s if out is not None else min(self._interval_s, WORKER_LEASE_TTL_S / 3))
@@ -1,13 +1,25 @@
 from __future__ import annotations
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Iterable
 from datetime import datetime, date, time, timedelta
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
 from sqlmodel import Session, select
-from app.models import Service, RescheduleIn, Reservation, ReservationDB
+from app.models import Service, RescheduleIn, Reservation, ReservationDB, GCalSyncState
 from app.data import SERVICE_BY_ID, PROS, PRO_BY_ID, WEEKLY_SCHEDULE, PRO_CALENDAR, PRO_USE_GCAL_BUSY
-from app.integrations.google_calendar import build_calendar, freebusy, freebusy_multi, create_event, patch_event, delete_event, iso_datetime, list_events_range
+from app.services.availability_cache import availability_cache
+from app.services.outbox import enqueue_gcal_upsert, enqueue_gcal_delete, notify_worker
+from app.services.occupancy import DayOccupancy, iter_bits
+from app.services.slot_grid import start_grids
+from app.utils.date import as_utc
+from app.integrations.circuit_breaker import gcal_breaker
+from app.integrations.google_calendar import build_calendar, freebusy, freebusy_multi, freebusy_multi_cached, create_event, patch_event, delete_event, iso_datetime, list_events_range, list_events_sync, SyncTokenExpired, EventBatch
 from zoneinfo import ZoneInfo
 from datetime import timezone as _utc_tz
+import logging
+
+logger = logging.getLogger("pelubot.logic")
 
 # ---------------------------------------------
 # Lógica de negocio con persistencia
@@ -18,7 +30,7 @@ DEFAULT_CALENDAR_ID = os.getenv("GCAL_CALENDAR_ID", os.getenv("GCAL_TEST_CALENDA
 
 TZ = os.getenv("TZ", "Europe/Madrid")
 
-def _to_naive_local(dt: datetime) -> datetime:
+def to_naive_local(dt: datetime) -> datetime:
     """Convierte a la TZ local y devuelve datetime naive para comparaciones internas."""
     if dt.tzinfo is None:
         return dt
@@ -52,111 +64,355 @@ def parse_time(s: str) -> Optional[time]:
     except Exception:
         return None
 
-def _reservations_for_prof_on_date(session: Session, pro_id: str, on_date: date) -> List[ReservationDB]:
-    """Reservas del profesional que solapan el día."""
-    day_start = datetime.combine(on_date, time(0, 0))
-    day_end = datetime.combine(on_date, time(23, 59, 59))
-    stmt = select(ReservationDB).where(ReservationDB.professional_id == pro_id, ReservationDB.start < day_end, ReservationDB.end > day_start)
+def _reservations_for_pros_in_range(session: Session, pro_ids: Optional[List[str]], start_date: date, end_date: date) -> List[ReservationDB]:
+    """Reservas que solapan [start_date, end_date] para varios profesionales (None = todos) con una única consulta."""
+    if pro_ids is not None and not pro_ids:
+        return []
+    range_start = datetime.combine(start_date, time(0, 0))
+    range_end = datetime.combine(end_date, time(23, 59, 59))
+    stmt = select(ReservationDB).where(ReservationDB.start < range_end, ReservationDB.end > range_start)
+    if pro_ids is not None:
+        stmt = stmt.where(ReservationDB.professional_id.in_(pro_ids))
     return list(session.exec(stmt))
 
+class _BusyIndex:
+    """Intervalos ocupados ordenados por inicio; resuelve solapes con bisect en O(log n).
+
+    Guarda el máximo acumulado de los finales para que un único bisect baste:
+    hay solape si algún intervalo con inicio < end termina después de start.
+    """
+    __slots__ = ("_starts", "_max_ends")
+
+    def __init__(self, intervals: Iterable[Tuple[datetime, datetime]] = ()):
+        items = sorted(intervals)
+        self._starts: List[datetime] = [s for s, _ in items]
+        self._max_ends: List[datetime] = []
+        running: Optional[datetime] = None
+        for _, e in items:
+            running = e if running is None or e > running else running
+            self._max_ends.append(running)
+
+    def overlaps(self, start_dt: datetime, end_dt: datetime) -> bool:
+        i = bisect_left(self._starts, end_dt)
+        return i > 0 and self._max_ends[i - 1] > start_dt
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
 def find_reservation(session: Session, reservation_id: str) -> Optional[ReservationDB]:
     return session.get(ReservationDB, reservation_id)
 
+def invalidate_availability(pro_id: Optional[str], start_dt: Optional[datetime], end_dt: Optional[datetime]) -> None:
+    """Invalida la caché de disponibilidad de los días que toca una reserva escrita."""
+    if not pro_id or start_dt is None or end_dt is None:
+        return
+    availability_cache.invalidate_interval(str(pro_id), to_naive_local(start_dt), to_naive_local(end_dt))
+
 def cancel_reservation(session: Session, reservation_id: str) -> bool:
     r = session.get(ReservationDB, reservation_id)
     if not r:
         return False
+    pro_id, start_dt, end_dt = r.professional_id, r.start, r.end
+    # El borrado del evento viaja en la misma transacción que el de la reserva.
+    enqueue_gcal_delete(session, r.id, r.google_calendar_id or get_calendar_for_professional(pro_id), r.google_event_id)
     session.delete(r)
     session.commit()
+    notify_worker()
+    invalidate_availability(pro_id, start_dt, end_dt)
     return True
 
-def find_available_slots(session: Session, service_id: str, on_date: date, professional_id: Optional[str] = None, step_min: int = 15, use_gcal_busy_override: Optional[bool] = None) -> List[datetime]:
-    """Calcula huecos disponibles considerando agenda, reservas locales y opcionalmente busy de GCal."""
-    service: Service = SERVICE_BY_ID[service_id]
-    day_ranges = WEEKLY_SCHEDULE.get(on_date.weekday(), [])
-    if not day_ranges:
-        return []
-    pro_ids = [professional_id] if professional_id else [p.id for p in PROS if service_id in p.services]
-
-    starts: List[datetime] = []
-    for start_t, end_t in day_ranges:
-        cursor = datetime.combine(on_date, start_t)
-        end_range = datetime.combine(on_date, end_t)
-        while cursor + timedelta(minutes=service.duration_min) <= end_range:
-            starts.append(cursor)
-            cursor += timedelta(minutes=step_min)
-
-    def pro_uses_gcal(pid: str) -> bool:
-        if use_gcal_busy_override is not None:
-            return bool(use_gcal_busy_override)
-        return PRO_USE_GCAL_BUSY.get(pid, USE_GCAL_BUSY)
-
-    gcal_busy_map: dict[str, List[Tuple[datetime, datetime]]] = {}
-    pros_needing_gcal = [pid for pid in pro_ids if pro_uses_gcal(pid)]
-    if pros_needing_gcal:
-        svc = None
+BusyByProDay = dict[Tuple[str, date], List[Tuple[datetime, datetime]]]
+
+def _pro_uses_gcal(pro_id: str, override: Optional[bool] = None) -> bool:
+    if override is not None:
+        return bool(override)
+    return PRO_USE_GCAL_BUSY.get(pro_id, USE_GCAL_BUSY)
+
+def _pros_for_service(service_id: str, professional_id: Optional[str] = None) -> List[str]:
+    return [professional_id] if professional_id else [p.id for p in PROS if service_id in p.services]
+
+def _parse_busy_entries(entries: List[dict]) -> List[Tuple[datetime, datetime]]:
+    intervals: List[Tuple[datetime, datetime]] = []
+    for b in entries:
         try:
-            svc = build_calendar()
+            bs = to_naive_local(datetime.fromisoformat((b.get("start") or "").replace("Z", "+00:00")))
+            be = to_naive_local(datetime.fromisoformat((b.get("end") or "").replace("Z", "+00:00")))
+            intervals.append((bs, be))
         except Exception:
-            svc = None
-        if svc:
-            day_start = datetime.combine(on_date, time(0, 0))
-            day_end = datetime.combine(on_date, time(23, 59))
-            # Consulta freebusy en una sola llamada para todos los calendarios implicados
-            cal_map: dict[str, str] = {pid: get_calendar_for_professional(pid) for pid in pros_needing_gcal}
-            cal_ids = list({cid for cid in cal_map.values() if cid})
-            try:
-                busy_map = freebusy_multi(svc, cal_ids, iso_datetime(day_start), iso_datetime(day_end)) if cal_ids else {}
-            except Exception:
-                busy_map = {}
-            for pid, cid in cal_map.items():
-                try:
-                    entries = busy_map.get(cid, [])
-                except Exception:
-                    entries = []
-                intervals: List[Tuple[datetime, datetime]] = []
-                for b in entries:
-                    try:
-                        bs = _to_naive_local(datetime.fromisoformat((b.get("start") or "").replace("Z", "+00:00")))
-                        be = _to_naive_local(datetime.fromisoformat((b.get("end") or "").replace("Z", "+00:00")))
-                        intervals.append((bs, be))
-                    except Exception:
-                        continue
-                gcal_busy_map[pid] = intervals
-
-    def overlaps_local(pro_id: str, start_dt: datetime, end_dt: datetime) -> bool:
-        for r in _reservations_for_prof_on_date(session, pro_id, start_dt.date()):
-            if not (end_dt <= r.start or start_dt >= r.end):
-                return True
-        return False
-
-    def overlaps_intervals(start_dt: datetime, end_dt: datetime, intervals: List[Tuple[datetime, datetime]]) -> bool:
-        return any(not (end_dt <= s or start_dt >= e) for s, e in intervals)
+            continue
+    return intervals
+
+def _load_gcal_busy(pro_ids: List[str], window_start: datetime, window_end: datetime, fresh: bool = False) -> dict[str, List[Tuple[datetime, datetime]]]:
+    """Busy de GCal para la ventana con un único cliente y una única llamada freebusy.
+
+    Las lecturas de huecos pasan por la caché; `fresh=True` (comprobación antes de escribir una
+    reserva) consulta siempre a Google para no aprobar un inicio con datos desfasados.
+    """
+    if not pro_ids:
+        return {}
+    if gcal_breaker.is_open():
+        # Google caído: se responde al momento con la ocupación local.
+        return {}
+    try:
+        svc = build_calendar()
+    except Exception:
+        return {}
+    cal_map: dict[str, str] = {pid: get_calendar_for_professional(pid) for pid in pro_ids}
+    cal_ids = list({cid for cid in cal_map.values() if cid})
+    try:
+        fetch = freebusy_multi if fresh else freebusy_multi_cached
+        busy_map = fetch(svc, cal_ids, iso_datetime(window_start), iso_datetime(window_end)) if cal_ids else {}
+    except Exception as e:
+        # Los huecos se siguen ofreciendo con la ocupación local; se deja rastro del fallo.
+        logger.warning("freebusy no disponible (%s); se usa sólo la ocupación local", e)
+        busy_map = {}
+    return {pid: _parse_busy_entries(busy_map.get(cid, [])) for pid, cid in cal_map.items()}
+
+def _bucket_interval(out: BusyByProDay, pro_id: str, start_dt: datetime, end_dt: datetime, start_date: date, end_date: date) -> None:
+    """Reparte un intervalo entre los días del rango que toca."""
+    if end_dt <= start_dt:
+        return
+    d = max(start_dt.date(), start_date)
+    last = min((end_dt - timedelta(microseconds=1)).date(), end_date)
+    while d <= last:
+        out.setdefault((pro_id, d), []).append((start_dt, end_dt))
+        d += timedelta(days=1)
 
-    free: List[datetime] = []
-    for start_dt in starts:
-        end_dt = start_dt + timedelta(minutes=service.duration_min)
-        for pro_id in pro_ids:
-            if overlaps_local(pro_id, start_dt, end_dt):
-                continue
-            intervals = gcal_busy_map.get(pro_id, []) if pro_uses_gcal(pro_id) else []
-            if overlaps_intervals(start_dt, end_dt, intervals):
-                continue
-            free.append(start_dt)
+def _load_local_busy(session: Session, pro_ids: List[str], start_date: date, end_date: date) -> BusyByProDay:
+    out: BusyByProDay = {}
+    for r in _reservations_for_pros_in_range(session, pro_ids, start_date, end_date):
+        _bucket_interval(out, r.professional_id, to_naive_local(r.start), to_naive_local(r.end), start_date, end_date)
+    return out
+
+def _load_gcal_busy_by_day(pro_ids: List[str], start_date: date, end_date: date) -> BusyByProDay:
+    out: BusyByProDay = {}
+    window = (datetime.combine(start_date, time(0, 0)), datetime.combine(end_date + timedelta(days=1), time(0, 0)))
+    for pid, intervals in _load_gcal_busy(pro_ids, *window).items():
+        for bs, be in intervals:
+            _bucket_interval(out, pid, bs, be, start_date, end_date)
+    return out
+
+def _merge_busy(local: BusyByProDay, gcal: BusyByProDay, gcal_pros: Iterable[str]) -> BusyByProDay:
+    """Vista combinada: reservas locales más busy de GCal sólo para `gcal_pros`."""
+    gcal_pros = set(gcal_pros)
+    out: BusyByProDay = {k: list(v) for k, v in local.items()}
+    for (pid, d), intervals in gcal.items():
+        if pid in gcal_pros:
+            out.setdefault((pid, d), []).extend(intervals)
+    return out
+
+def _load_busy_by_pro_day(session: Session, pro_ids: List[str], start_date: date, end_date: date, use_gcal_busy_override: Optional[bool] = None) -> BusyByProDay:
+    """Intervalos ocupados (BD + GCal) del rango, agrupados en memoria por (profesional, día)."""
+    gcal_pros = [pid for pid in pro_ids if _pro_uses_gcal(pid, use_gcal_busy_override)]
+    local = _load_local_busy(session, pro_ids, start_date, end_date)
+    return _merge_busy(local, _load_gcal_busy_by_day(gcal_pros, start_date, end_date), gcal_pros)
+
+# Bit de cada profesional en las máscaras de atribución de huecos.
+PRO_BIT: dict[str, int] = {p.id: 1 << i for i, p in enumerate(PROS)}
+
+def pros_from_mask(mask: int) -> List[str]:
+    """Profesionales codificados en una máscara de `PRO_BIT`, en el orden de `PROS`."""
+    return [p.id for p in PROS if mask & PRO_BIT[p.id]]
+
+def _free_start_masks(on_date: date, duration_min: int, pro_ids: List[str], busy: BusyByProDay, step_min: int, not_before: Optional[datetime] = None, first_only: bool = False) -> Tuple[dict[str, int], int]:
+    """Máscara de inicios libres del día por profesional y granularidad usada.
+
+    Con `first_only` se detiene en el primer profesional con hueco, suficiente para un sí/no.
+    """
+    table = start_grids.get(duration_min, on_date.weekday(), step_min)
+    grid, candidates = table.grid, table.mask
+    if not_before is not None and not_before.date() == on_date:
+        first_cell = -(-((not_before.hour * 60 + not_before.minute) * 60 + not_before.second) // (grid * 60))
+        candidates &= ~((1 << first_cell) - 1)
+    elif not_before is not None and not_before.date() > on_date:
+        candidates = 0
+    masks: dict[str, int] = {}
+    for pid in pro_ids:
+        if not candidates:
+            break
+        occ = DayOccupancy(on_date, grid=grid, open_mask=table.open_mask).mark_busy_many(busy.get((pid, on_date), []))
+        masks[pid] = occ.free_starts(duration_min) & candidates
+        if first_only and masks[pid]:
             break
-    return free
+    return masks, grid
+
+def _free_start_mask(on_date: date, duration_min: int, pro_ids: List[str], busy: BusyByProDay, step_min: int, not_before: Optional[datetime] = None, first_only: bool = False) -> Tuple[int, int]:
+    """Máscara de inicios en los que algún profesional está libre."""
+    masks, grid = _free_start_masks(on_date, duration_min, pro_ids, busy, step_min, not_before, first_only)
+    union = 0
+    for m in masks.values():
+        union |= m
+    return union, grid
+
+def find_available_slots_detailed(session: Session, service_id: str, on_date: date, professional_id: Optional[str] = None, step_min: int = 15, use_gcal_busy_override: Optional[bool] = None) -> List[Tuple[datetime, int]]:
+    """Huecos del día con la máscara (`PRO_BIT`) de profesionales libres en cada inicio."""
+    if not WEEKLY_SCHEDULE.get(on_date.weekday(), []):
+        return []
+    service: Service = SERVICE_BY_ID[service_id]
+    pro_ids = _pros_for_service(service_id, professional_id)
+    cache_key = (service_id, on_date, professional_id, use_gcal_busy_override, step_min)
+    cached = availability_cache.get(cache_key)
+    if cached is not None:
+        return list(cached)
+    deps = [(pid, on_date) for pid in pro_ids]
+    versions = availability_cache.snapshot(deps)
+    # Una sola consulta y una sola llamada freebusy: las reservas se rasterizan en un mapa
+    # de bits por profesional y cada duración se resuelve con una ventana deslizante.
+    busy = _load_busy_by_pro_day(session, pro_ids, on_date, on_date, use_gcal_busy_override)
+    out = _attributed_slots(on_date, service.duration_min, pro_ids, busy, step_min)
+    availability_cache.put(cache_key, tuple(out), deps, versions)
+    return out
+
+def _attributed_slots(on_date: date, duration_min: int, pro_ids: List[str], busy: BusyByProDay, step_min: int) -> List[Tuple[datetime, int]]:
+    masks, grid = _free_start_masks(on_date, duration_min, pro_ids, busy, step_min)
+    union = 0
+    for m in masks.values():
+        union |= m
+    base = datetime.combine(on_date, time(0, 0))
+    out: List[Tuple[datetime, int]] = []
+    for cell in iter_bits(union):
+        bit = 1 << cell
+        who = 0
+        for pid, m in masks.items():
+            if m & bit:
+                who |= PRO_BIT.get(pid, 0)
+        out.append((base + timedelta(minutes=cell * grid), who))
+    return out
+
+def find_available_slots_batch(session: Session, queries: List[Tuple[str, date, Optional[str], Optional[bool]]], step_min: int = 15) -> List[List[Tuple[datetime, int]]]:
+    """Resuelve varias consultas (service_id, fecha, profesional, use_gcal) compartiendo la carga.
+
+    Las que no están en caché se responden con una consulta a BD y una llamada freebusy
+    que cubren la unión de fechas, profesionales y calendarios implicados.
+    """
+    results: List[Optional[List[Tuple[datetime, int]]]] = [None] * len(queries)
+    pending: List[Tuple[int, tuple, List[str], list, tuple]] = []
+    for i, (service_id, on_date, pro_id, use_gcal) in enumerate(queries):
+        if not WEEKLY_SCHEDULE.get(on_date.weekday(), []):
+            results[i] = []
+            continue
+        key = (service_id, on_date, pro_id, use_gcal, step_min)
+        cached = availability_cache.get(key)
+        if cached is not None:
+            results[i] = list(cached)
+            continue
+        pro_ids = _pros_for_service(service_id, pro_id)
+        deps = [(pid, on_date) for pid in pro_ids]
+        pending.append((i, key, pro_ids, deps, availability_cache.snapshot(deps)))
+    if pending:
+        all_pros = sorted({pid for _, _, pro_ids, _, _ in pending for pid in pro_ids})
+        gcal_pros = sorted({pid for _, key, pro_ids, _, _ in pending for pid in pro_ids if _pro_uses_gcal(pid, key[3])})
+        first = min(key[1] for _, key, _, _, _ in pending)
+        last = max(key[1] for _, key, _, _, _ in pending)
+        local = _load_local_busy(session, all_pros, first, last)
+        gcal = _load_gcal_busy_by_day(gcal_pros, first, last)
+        for i, key, pro_ids, deps, versions in pending:
+            service_id, on_date, _, use_gcal, _ = key
+            busy = _merge_busy(local, gcal, [pid for pid in pro_ids if _pro_uses_gcal(pid, use_gcal)])
+            out = _attributed_slots(on_date, SERVICE_BY_ID[service_id].duration_min, pro_ids, busy, step_min)
+            availability_cache.put(key, tuple(out), deps, versions)
+            results[i] = out
+    return [r or [] for r in results]
+
+def find_available_slots(session: Session, service_id: str, on_date: date, professional_id: Optional[str] = None, step_min: int = 15, use_gcal_busy_override: Optional[bool] = None) -> List[datetime]:
+    """Calcula huecos disponibles considerando agenda, reservas locales y opcionalmente busy de GCal."""
+    return [dt for dt, _ in find_available_slots_detailed(session, service_id, on_date, professional_id, step_min, use_gcal_busy_override)]
+
+def _subtract_interval(intervals: Iterable[Tuple[datetime, datetime]], span: Tuple[datetime, datetime]) -> List[Tuple[datetime, datetime]]:
+    """Quita `span` de cada intervalo ocupado (freebusy fusiona el evento propio con los contiguos)."""
+    out: List[Tuple[datetime, datetime]] = []
+    for s_dt, e_dt in intervals:
+        if e_dt <= span[0] or s_dt >= span[1]:
+            out.append((s_dt, e_dt))
+            continue
+        if s_dt < span[0]:
+            out.append((s_dt, span[0]))
+        if e_dt > span[1]:
+            out.append((span[1], e_dt))
+    return out
+
+def _start_conflict(session: Session, service_id: str, pro_id: str, start_dt: datetime, step_min: Optional[int] = None, exclude_reservation_id: Optional[str] = None, use_gcal_busy_override: Optional[bool] = None, exclude_busy: Optional[Tuple[datetime, datetime]] = None) -> Optional[str]:
+    """Motivo por el que `start_dt` (naive local) no está libre para el profesional, o None.
+
+    Devuelve "schedule" (fuera de horario o de la rejilla de `step_min`), "local" (solapa
+    una reserva) o "gcal" (solapa busy de Google). Cuesta una consulta acotada al intervalo
+    y, si aplica, una llamada freebusy sobre ese mismo intervalo.
+    """
+    duration = SERVICE_BY_ID[service_id].duration_min
+    end_dt = start_dt + timedelta(minutes=duration)
+    if step_min:
+        table = start_grids.get(duration, start_dt.weekday(), step_min)
+        minute = start_dt.hour * 60 + start_dt.minute
+        if start_dt.second or start_dt.microsecond or minute % table.grid or not (table.mask >> (minute // table.grid)) & 1:
+            return "schedule"
+    elif not _fits_in_schedule(start_dt, duration):
+        return "schedule"
+    q = select(ReservationDB.id).where(ReservationDB.professional_id == pro_id, ReservationDB.start < end_dt, ReservationDB.end > start_dt)
+    if exclude_reservation_id:
+        q = q.where(ReservationDB.id != exclude_reservation_id)
+    if session.exec(q.limit(1)).first() is not None:
+        return "local"
+    if _pro_uses_gcal(pro_id, use_gcal_busy_override):
+        intervals = _load_gcal_busy([pro_id], start_dt, end_dt, fresh=True).get(pro_id, [])
+        if exclude_busy:
+            intervals = _subtract_interval(intervals, exclude_busy)
+        if _BusyIndex(intervals).overlaps(start_dt, end_dt):
+            return "gcal"
+    return None
+
+def is_start_available(session: Session, service_id: str, pro_id: str, start_dt: datetime, step_min: Optional[int] = 15, exclude_reservation_id: Optional[str] = None, use_gcal_busy_override: Optional[bool] = None) -> bool:
+    """Comprobación puntual de un inicio, sin recalcular el día completo."""
+    return _start_conflict(session, service_id, pro_id, to_naive_local(start_dt), step_min, exclude_reservation_id, use_gcal_busy_override) is None
+
+def find_available_days(session: Session, service_id: str, start_date: date, end_date: date, professional_id: Optional[str] = None, step_min: int = 15, use_gcal_busy_override: Optional[bool] = None, not_before: Optional[datetime] = None) -> List[date]:
+    """Días de [start_date, end_date] con al menos un hueco libre.
+
+    Carga BD y GCal una vez para todo el rango y agrupa por día en memoria; por cada día
+    se detiene en el primer hueco encontrado. `not_before` (naive local) descarta inicios anteriores.
+    """
+    if end_date < start_date:
+        return []
+    service: Service = SERVICE_BY_ID[service_id]
+    pro_ids = _pros_for_service(service_id, professional_id)
+    open_days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    open_days = [d for d in open_days if WEEKLY_SCHEDULE.get(d.weekday())]
+    if not open_days:
+        return []
+    busy = _load_busy_by_pro_day(session, pro_ids, open_days[0], open_days[-1], use_gcal_busy_override)
+    out: List[date] = []
+    for d in open_days:
+        mask, _ = _free_start_mask(d, service.duration_min, pro_ids, busy, step_min, not_before=not_before, first_only=True)
+        if mask:
+            out.append(d)
+    return out
+
+def find_next_slots(session: Session, service_id: str, after: datetime, limit: int, until: date, professional_id: Optional[str] = None, step_min: int = 15, use_gcal_busy_override: Optional[bool] = None) -> List[datetime]:
+    """Primeros `limit` inicios libres desde `after` (naive local) hasta `until` inclusive.
+
+    Recorre el calendario en bloques crecientes (1, 2, 4... hasta 32 días) para que el caso
+    habitual cueste una consulta y una llamada freebusy, y se detiene al completar `limit`.
+    """
+    service: Service = SERVICE_BY_ID[service_id]
+    pro_ids = _pros_for_service(service_id, professional_id)
+    out: List[datetime] = []
+    chunk = 1
+    d = after.date()
+    while d <= until and len(out) < limit:
+        chunk_end = min(until, d + timedelta(days=chunk - 1))
+        busy = _load_busy_by_pro_day(session, pro_ids, d, chunk_end, use_gcal_busy_override)
+        while d <= chunk_end and len(out) < limit:
+            mask, grid = _free_start_mask(d, service.duration_min, pro_ids, busy, step_min, not_before=after)
+            for cell in iter_bits(mask):
+                out.append(datetime.combine(d, time(0, 0)) + timedelta(minutes=cell * grid))
+                if len(out) >= limit:
+                    break
+            d += timedelta(days=1)
+        chunk = min(chunk * 2, 32)
+    return out
 
 def _fits_in_schedule(start_dt: datetime, duration_min: int) -> bool:
-    day_ranges = WEEKLY_SCHEDULE.get(start_dt.weekday(), [])
-    if not day_ranges:
-        return False
-    end_dt = start_dt + timedelta(minutes=duration_min)
-    for start_t, end_t in day_ranges:
-        start_range = datetime.combine(start_dt.date(), start_t)
-        end_range = datetime.combine(start_dt.date(), end_t)
-        if start_dt >= start_range and end_dt <= end_range:
-            return True
-    return False
+    start_min = start_dt.hour * 60 + start_dt.minute + (start_dt.second + start_dt.microsecond / 1e6) / 60
+    return start_grids.fits(duration_min, start_dt.weekday(), start_min)
 
 def apply_reschedule(session: Session, payload: RescheduleIn) -> Tuple[bool, str, Optional[ReservationDB]]:
     """Reprograma una reserva, validando agenda/solapes. Soporta new_start o (new_date,new_time)."""
@@ -195,18 +451,21 @@ def apply_reschedule(session: Session, payload: RescheduleIn) -> Tuple[bool, str
         return False, "professional_id no existe.", None
 
     # Usamos naive local únicamente para comparaciones internas; en BD guardamos TZ-aware
-    start_dt = _to_naive_local(new_start_dt)
+    start_dt = to_naive_local(new_start_dt)
     end_dt = start_dt + timedelta(minutes=service.duration_min)
 
-    if not _fits_in_schedule(start_dt, service.duration_min):
+    # El evento ya sincronizado de la propia reserva aparece en el freebusy de su calendario:
+    # no debe impedir moverla a una hora que solape con la actual.
+    own_busy = None
+    if r.google_event_id and r.google_calendar_id == get_calendar_for_professional(new_pro):
+        own_busy = (to_naive_local(r.start), to_naive_local(r.end))
+    conflict = _start_conflict(session, r.service_id, new_pro, start_dt, step_min=None, exclude_reservation_id=r.id, exclude_busy=own_busy)
+    if conflict == "schedule":
         return False, "La nueva hora no encaja en el horario.", None
+    if conflict:
+        return False, f"El profesional {PRO_BY_ID[new_pro].name} ya tiene esa hora ocupada.", None
 
-    for x in _reservations_for_prof_on_date(session, new_pro, start_dt.date()):
-        if x.id == r.id:
-            continue
-        if not (end_dt <= x.start or start_dt >= x.end):
-            return False, f"El profesional {PRO_BY_ID[new_pro].name} ya tiene esa hora ocupada.", None
-
+    old_pro, old_start, old_end = r.professional_id, r.start, r.end
     r.professional_id = new_pro
     # Persistimos como TZ-aware (coherente con columnas timezone=True)
     try:
@@ -217,8 +476,12 @@ def apply_reschedule(session: Session, payload: RescheduleIn) -> Tuple[bool, str
     r.end = end_dt.replace(tzinfo=tz) if tz else end_dt
     r.updated_at = datetime.now(_utc_tz.utc)
     session.add(r)
+    enqueue_gcal_upsert(session, r.id)
     session.commit()
     session.refresh(r)
+    notify_worker()
+    invalidate_availability(old_pro, old_start, old_end)
+    invalidate_availability(r.professional_id, r.start, r.end)
     return True, "Reserva reprogramada.", r
 
 def find_gcal_busy_slots(calendar_id: str, on_date: date, tz: str = "Europe/Madrid") -> List[dict]:
@@ -265,179 +528,476 @@ def _detect_service_from_summary(summary: str, default_sid: str) -> str:
         return "corte"
     return default_sid
 
-def sync_from_gcal_range(session: Session, start_date: date, end_date: date, default_service: str = "corte", by_professional: bool = True, calendar_id: str | None = None, professional_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid")) -> dict:
-    """Importa eventos de GCal a la BD (upsert) en [start_date, end_date]."""
+def gcal_fingerprint(cal_id: Optional[str], service_id: str, professional_id: str, start: datetime, end: datetime) -> str:
+    """Huella de lo que determina el evento de una reserva en GCal (calendario, horario, servicio y profesional)."""
+    payload = "|".join((cal_id or "", service_id, professional_id, to_naive_local(start).isoformat(), to_naive_local(end).isoformat()))
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def mark_gcal_synced(r: ReservationDB, cal_id: str, event: dict) -> None:
+    """Anota en la reserva el evento que tiene en GCal tras escribirlo o comprobarlo."""
+    if event.get("id"):
+        r.google_event_id = event["id"]
+    r.google_calendar_id = cal_id
+    r.google_etag = event.get("etag")
+    r.google_updated = _parse_gcal_dt(event["updated"]) if event.get("updated") else None
+    r.gcal_fingerprint = gcal_fingerprint(cal_id, r.service_id, r.professional_id, r.start, r.end)
+
+def _gcal_in_sync(r: ReservationDB, target_cal: str) -> bool:
+    """True si la reserva no cambió desde la última escritura o lectura de su evento en GCal."""
+    return bool(r.google_event_id and r.gcal_fingerprint and r.google_calendar_id == target_cal
+                and r.gcal_fingerprint == gcal_fingerprint(target_cal, r.service_id, r.professional_id, r.start, r.end))
+
+_SYNC_FIELDS = ("service_id", "professional_id", "start", "end", "google_event_id", "google_calendar_id", "google_etag", "google_updated", "gcal_fingerprint")
+# Margen bajo el límite de parámetros por sentencia de SQLite antiguos (999).
+_IN_CHUNK = 500
+
+def _gcal_item_row(it: dict, cal_id: str, pro_id: Optional[str], default_service: str) -> Optional[dict]:
+    """Fila de `ReservationDB` que corresponde a un evento de GCal, o None si no es importable."""
+    start_v = (it.get("start") or {}).get("dateTime") or (it.get("start") or {}).get("date")
+    end_v = (it.get("end") or {}).get("dateTime") or (it.get("end") or {}).get("date")
+    if not start_v or not end_v:
+        return None
+    priv = (it.get("extendedProperties") or {}).get("private") or {}
+    pro = priv.get("professional_id") or pro_id
+    if not pro:
+        return None
+    row = {
+        "id": priv.get("reservation_id") or f"gcal:{it.get('id')}",
+        "service_id": priv.get("service_id") or _detect_service_from_summary(it.get("summary"), default_service),
+        "professional_id": str(pro),
+        "start": _parse_gcal_dt(start_v),
+        "end": _parse_gcal_dt(end_v),
+        "google_event_id": it.get("id"),
+        "google_calendar_id": cal_id,
+        "google_etag": it.get("etag"),
+        "google_updated": _parse_gcal_dt(it["updated"]) if it.get("updated") else None,
+    }
+    # La fila queda igual que el evento: la reconciliación no tiene nada que enviar.
+    row["gcal_fingerprint"] = gcal_fingerprint(cal_id, row["service_id"], row["professional_id"], row["start"], row["end"])
+    return row
+
+def _same_value(field: str, old, new) -> bool:
+    # SQLite devuelve naive lo que se guardó aware: se comparan ambos en hora local naive.
+    if field in ("start", "end") and old is not None and new is not None:
+        return to_naive_local(old) == to_naive_local(new)
+    if field == "google_updated" and old is not None and new is not None:
+        # Google lo da en UTC y SQLite lo devuelve naive en UTC.
+        return as_utc(old) == as_utc(new)
+    return old == new
+
+def _bulk_upsert_gcal_items(session: Session, items: Iterable[dict], cal_id: str, pro_id: Optional[str], default_service: str, touched: list) -> tuple[int, int]:
+    """Importa eventos de GCal en bloque. Devuelve (insertadas, actualizadas).
+
+    Las filas existentes se leen con una consulta `IN` (por tramos) y sólo se escriben las
+    nuevas o las que cambian, con un único `INSERT ... ON CONFLICT DO UPDATE`.
+    """
+    incoming: dict[str, dict] = {}
+    for it in items:
+        row = _gcal_item_row(it, cal_id, pro_id, default_service)
+        if row is not None:
+            incoming[row["id"]] = row
+    if not incoming:
+        return 0, 0
+    cols = [getattr(ReservationDB, f) for f in _SYNC_FIELDS]
+    ids = list(incoming)
+    existing: dict[str, tuple] = {}
+    for lo in range(0, len(ids), _IN_CHUNK):
+        for rec in session.exec(select(ReservationDB.id, *cols).where(ReservationDB.id.in_(ids[lo:lo + _IN_CHUNK]))):
+            existing[rec[0]] = tuple(rec[1:])
+    now = datetime.now(_utc_tz.utc)
+    inserts: list[dict] = []
+    updates: list[dict] = []
+    for rid, row in incoming.items():
+        old = existing.get(rid)
+        if old is None:
+            inserts.append({**row, "created_at": now, "updated_at": now})
+            touched.append((row["professional_id"], row["start"], row["end"]))
+        elif not all(_same_value(f, o, row[f]) for f, o in zip(_SYNC_FIELDS, old)):
+            updates.append({**row, "updated_at": now})
+            touched.append((old[1], old[2], old[3]))
+            touched.append((row["professional_id"], row["start"], row["end"]))
+    if inserts or updates:
+        # Los cambios ORM pendientes (p. ej. cancelaciones) deben ir antes de la sentencia en bloque.
+        session.flush()
+        _upsert_reservation_rows(session, inserts, updates)
+    return len(inserts), len(updates)
+
+def _upsert_reservation_rows(session: Session, inserts: list[dict], updates: list[dict]) -> None:
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as _insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as _insert
+        table = ReservationDB.__table__
+        for rows in (inserts, updates):
+            if not rows:
+                continue
+            stmt = _insert(table)
+            stmt = stmt.on_conflict_do_update(index_elements=[table.c.id], set_={f: stmt.excluded[f] for f in (*_SYNC_FIELDS, "updated_at")})
+            # Las filas de inserción y de actualización tienen columnas distintas: una sentencia por grupo.
+            for lo in range(0, len(rows), _IN_CHUNK):
+                session.execute(stmt, rows[lo:lo + _IN_CHUNK])
+        return
+    # Otros motores: INSERT y UPDATE por clave primaria del ORM, ambos en executemany.
+    from sqlalchemy import insert as _orm_insert, update as _orm_update
+    if inserts:
+        session.execute(_orm_insert(ReservationDB), inserts)
+    if updates:
+        session.execute(_orm_update(ReservationDB), updates)
+
+def _apply_gcal_cancellation(session: Session, event_id: str, cal_id: str, touched: list) -> Optional[str]:
+    """Refleja un evento cancelado en GCal.
+
+    Los bloqueos importados (`gcal:`) se borran. Las reservas propias se conservan porque la BD
+    es la fuente de verdad; se desvinculan del evento para que la reconciliación lo recree.
+    """
+    q = select(ReservationDB).where(ReservationDB.google_event_id == event_id)
+    result = None
+    for r in session.exec(q):
+        if r.google_calendar_id and r.google_calendar_id != cal_id:
+            continue
+        touched.append((r.professional_id, r.start, r.end))
+        if r.id.startswith("gcal:"):
+            session.delete(r)
+            result = "deleted"
+        else:
+            r.google_event_id = None; r.google_calendar_id = None
+            r.google_etag = r.gcal_fingerprint = None; r.google_updated = None
+            r.updated_at = datetime.now(_utc_tz.utc)
+            session.add(r)
+            result = result or "detached"
+    return result
+
+GCAL_SYNC_LOOKBACK_DAYS = int(os.getenv("GCAL_SYNC_LOOKBACK_DAYS", "7"))
+# Hilos para la E/S con Google por calendario; la escritura en BD sigue siendo secuencial.
+GCAL_MAX_WORKERS = max(1, int(os.getenv("GCAL_MAX_WORKERS", "4")))
+
+def per_calendar(fn, pairs: list[tuple[str, str | None]]) -> list[tuple[object, Optional[BaseException]]]:
+    """Ejecuta `fn(cal_id, pro_id)` en paralelo (pool acotado) y devuelve (valor, error) en el orden de `pairs`.
+
+    El cliente compartido usa una conexión HTTP por hilo, así que es seguro llamarlo desde el pool.
+    """
+    def _safe(pair):
+        try:
+            return fn(*pair), None
+        except Exception as e:
+            return None, e
+    if len(pairs) <= 1 or GCAL_MAX_WORKERS == 1:
+        return [_safe(p) for p in pairs]
+    with ThreadPoolExecutor(max_workers=min(GCAL_MAX_WORKERS, len(pairs)), thread_name_prefix="gcal") as pool:
+        return list(pool.map(_safe, pairs))
+
+def sync_from_gcal_incremental(session: Session, default_service: str = "corte", professional_id: str | None = None, calendar_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid")) -> dict:
+    """Importación incremental con syncToken por calendario (tabla `gcal_sync_state`).
+
+    La primera vez, o si Google responde 410 (token caducado), hace una carga completa desde
+    hoy - GCAL_SYNC_LOOKBACK_DAYS y guarda el nuevo token. Después sólo pide lo cambiado.
+    """
     from app.data import PRO_CALENDAR
     try:
         svc = build_calendar()
     except Exception:
-        return {"inserted": 0, "updated": 0, "calendars": 0, "ok": False, "error": "gcal client"}
-    pairs: list[tuple[str, str | None]] = []
-    if by_professional:
-        for pro_id, cal in PRO_CALENDAR.items():
-            pairs.append((cal, pro_id))
-    else:
-        if not calendar_id:
-            return {"inserted": 0, "updated": 0, "calendars": 0, "ok": False, "error": "calendar_id requerido"}
-        pairs.append((calendar_id, professional_id))
-    total_ins = total_upd = 0
-    for cal_id, pro_id in pairs:
-        d = start_date
-        while d <= end_date:
-            start_iso = f"{d.isoformat()}T00:00:00"; end_iso = f"{d.isoformat()}T23:59:59"
+        return {"inserted": 0, "updated": 0, "deleted": 0, "calendars": 0, "ok": False, "error": "gcal client"}
+    pairs = [(cal, pid) for pid, cal in PRO_CALENDAR.items() if cal and (not professional_id or pid == professional_id) and (not calendar_id or cal == calendar_id)]
+    totals = {"inserted": 0, "updated": 0, "deleted": 0, "detached": 0}
+    full_syncs = 0
+    errors: list[dict] = []
+    touched: list[tuple[str, datetime, datetime]] = []
+    lookback = datetime.combine(date.today() - timedelta(days=GCAL_SYNC_LOOKBACK_DAYS), time(0, 0))
+    states = {cal_id: session.get(GCalSyncState, cal_id) or GCalSyncState(calendar_id=cal_id) for cal_id, _ in pairs}
+
+    def _fetch(cal_id: str, _pro_id: str | None):
+        token = states[cal_id].sync_token
+        if token:
             try:
-                items = list_events_range(svc, cal_id, start_iso, end_iso, tz)
-            except Exception:
-                items = []
-            for it in items:
-                start_v = (it.get("start") or {}).get("dateTime") or (it.get("start") or {}).get("date")
-                end_v = (it.get("end") or {}).get("dateTime") or (it.get("end") or {}).get("date")
-                if not start_v or not end_v:
-                    continue
-                start_dt = _parse_gcal_dt(start_v); end_dt = _parse_gcal_dt(end_v)
-                priv = (it.get("extendedProperties") or {}).get("private") or {}
-                rid = priv.get("reservation_id") or f"gcal:{it.get('id')}"
-                srv_id = priv.get("service_id") or _detect_service_from_summary(it.get("summary"), default_service)
-                pro = priv.get("professional_id") or pro_id
-                if not pro:
-                    continue
-                r = session.get(ReservationDB, rid)
-                if r is None:
-                    r = ReservationDB(id=rid, service_id=srv_id, professional_id=str(pro), start=start_dt, end=end_dt, google_event_id=it.get("id"), google_calendar_id=cal_id)
-                    session.add(r); total_ins += 1
-                else:
-                    changed = False
-                    if r.start != start_dt: r.start = start_dt; changed = True
-                    if r.end != end_dt: r.end = end_dt; changed = True
-                    if r.professional_id != pro: r.professional_id = str(pro); changed = True
-                    if r.service_id != srv_id: r.service_id = srv_id; changed = True
-                    if r.google_event_id != it.get("id"): r.google_event_id = it.get("id"); changed = True
-                    if r.google_calendar_id != cal_id: r.google_calendar_id = cal_id; changed = True
-                    if changed: session.add(r); total_upd += 1
-            d += timedelta(days=1)
+                return list_events_sync(svc, cal_id, sync_token=token, tz=tz) + (False,)
+            except SyncTokenExpired:
+                pass
+        return list_events_sync(svc, cal_id, time_min=lookback, tz=tz) + (True,)
+
+    for (cal_id, pro_id), (fetched, err) in zip(pairs, per_calendar(_fetch, pairs)):
+        if err is not None:
+            errors.append({"calendar_id": cal_id, "error": str(err)})
+            continue
+        items, next_token, full = fetched
+        state = states[cal_id]
+        # Google devuelve sólo el último estado de cada evento: altas/cambios y bajas no se pisan.
+        for it in items:
+            if it.get("status") == "cancelled" and it.get("id"):
+                res = _apply_gcal_cancellation(session, it.get("id"), cal_id, touched)
+                if res:
+                    totals[res] += 1
+        ins, upd = _bulk_upsert_gcal_items(session, (it for it in items if it.get("status") != "cancelled"), cal_id, pro_id, default_service, touched)
+        totals["inserted"] += ins
+        totals["updated"] += upd
+        now = datetime.now(_utc_tz.utc)
+        if full:
+            full_syncs += 1
+            state.last_full_sync_at = now
+        state.sync_token = next_token
+        state.updated_at = now
+        session.add(state)
         session.commit()
-    return {"ok": True, "inserted": total_ins, "updated": total_upd, "calendars": len(pairs)}
+        for t in touched:
+            invalidate_availability(*t)
+        touched.clear()
+    return {"ok": not errors, **totals, "calendars": len(pairs), "full_syncs": full_syncs, "errors": errors}
+
+def _gcal_range_bounds(start_date: date, end_date: date) -> tuple[datetime, datetime]:
+    """Ventana [inicio del primer día, inicio del día siguiente al último) para listar eventos."""
+    return datetime.combine(start_date, time(0, 0)), datetime.combine(end_date + timedelta(days=1), time(0, 0))
+
+def event_interval(it: dict) -> Optional[tuple[datetime, datetime]]:
+    """(inicio, fin) naive local de un evento de GCal, o None si no trae fechas."""
+    start_v = (it.get("start") or {}).get("dateTime") or (it.get("start") or {}).get("date")
+    end_v = (it.get("end") or {}).get("dateTime") or (it.get("end") or {}).get("date")
+    if not start_v or not end_v:
+        return None
+    return to_naive_local(_parse_gcal_dt(start_v)), to_naive_local(_parse_gcal_dt(end_v))
 
-def reconcile_db_to_gcal_range(session: Session, start_date: date, end_date: date, by_professional: bool = True, calendar_id: str | None = None, professional_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid")) -> dict:
-    """Alinea eventos de GCal con la BD local: crea, parchea o mueve entre calendarios."""
+def _gcal_pairs(by_professional: bool, calendar_id: str | None, professional_id: str | None) -> Optional[list[tuple[str, str | None]]]:
+    """Pares (calendario, profesional) a procesar; None si falta el calendar_id requerido."""
     from app.data import PRO_CALENDAR
+    if by_professional:
+        return [(cal, pid) for pid, cal in PRO_CALENDAR.items()]
+    if not calendar_id:
+        return None
+    return [(calendar_id, professional_id)]
+
+def rows_by_pair(session: Session, pairs: list[tuple[str, str | None]], start_date: date, end_date: date) -> dict[str | None, list[ReservationDB]]:
+    """Reservas del rango agrupadas por profesional de cada par, con una única consulta."""
+    pro_ids = None if any(pid is None for _, pid in pairs) else [pid for _, pid in pairs]
+    rows = _reservations_for_pros_in_range(session, pro_ids, start_date, end_date)
+    out: dict[str | None, list[ReservationDB]] = {pid: [] for _, pid in pairs}
+    for r in rows:
+        if r.professional_id in out:
+            out[r.professional_id].append(r)
+    if None in out:
+        out[None] = rows
+    return out
+
+def sync_from_gcal_range(session: Session, start_date: date, end_date: date, default_service: str = "corte", by_professional: bool = True, calendar_id: str | None = None, professional_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid")) -> dict:
+    """Importa eventos de GCal a la BD (upsert) en [start_date, end_date]."""
     try:
         svc = build_calendar()
     except Exception:
-        return {"ok": False, "created": 0, "patched": 0, "calendars": 0, "error": "gcal client"}
-    pairs: list[tuple[str, str | None]] = []
-    if by_professional:
-        for pid, cal in PRO_CALENDAR.items():
-            pairs.append((cal, pid))
-    else:
-        if not calendar_id:
-            return {"ok": False, "created": 0, "patched": 0, "calendars": 0, "error": "calendar_id requerido"}
-        pairs.append((calendar_id, professional_id))
-    created = patched = 0
-    def _day_bounds(d: date):
-        return datetime.combine(d, time(0, 0)), datetime.combine(d, time(23, 59, 59))
-    for cal_id, pro_id in pairs:
-        d = start_date
-        while d <= end_date:
-            day_start, day_end = _day_bounds(d)
-            try:
-                gitems = list_events_range(svc, cal_id, iso_datetime(day_start, tz), iso_datetime(day_end, tz), tz)
-            except Exception:
-                gitems = []
-            gmap = {it.get("id"): it for it in gitems if it.get("id")}
-            q = select(ReservationDB).where(ReservationDB.start < day_end, ReservationDB.end > day_start)
-            if pro_id:
-                q = q.where(ReservationDB.professional_id == pro_id)
-            rows = list(session.exec(q))
-            for r in rows:
-                target_cal = get_calendar_for_professional(r.professional_id)
-                if r.google_event_id and r.google_calendar_id and r.google_calendar_id != target_cal:
-                    try:
-                        delete_event(svc, r.google_calendar_id, r.google_event_id)
-                    except Exception:
-                        pass
-                    ev = create_event(svc, target_cal, r.start, r.end, summary=f"Reserva: {r.service_id} - {r.professional_id}", private_props={"reservation_id": r.id, "professional_id": r.professional_id, "service_id": r.service_id}, tz=tz)
-                    r.google_event_id = ev.get("id"); r.google_calendar_id = target_cal
-                    session.add(r); created += 1
-                    continue
-                if not r.google_event_id or r.google_event_id not in gmap:
-                    ev = create_event(svc, target_cal, r.start, r.end, summary=f"Reserva: {r.service_id} - {r.professional_id}", private_props={"reservation_id": r.id, "professional_id": r.professional_id, "service_id": r.service_id}, tz=tz)
-                    r.google_event_id = ev.get("id"); r.google_calendar_id = target_cal
-                    session.add(r); created += 1
-                    continue
-                it = gmap.get(r.google_event_id)
-                gs = (it.get("start") or {}).get("dateTime") or (it.get("start") or {}).get("date")
-                ge = (it.get("end") or {}).get("dateTime") or (it.get("end") or {}).get("date")
-                if gs and ge:
-                    gs_dt = _parse_gcal_dt(gs); ge_dt = _parse_gcal_dt(ge)
-                    if gs_dt != r.start or ge_dt != r.end:
-                        patch_event(svc, target_cal, r.google_event_id, r.start, r.end, tz); patched += 1
-            d += timedelta(days=1)
+        return {"inserted": 0, "updated": 0, "calendars": 0, "ok": False, "error": "gcal client"}
+    pairs = _gcal_pairs(by_professional, calendar_id, professional_id)
+    if pairs is None:
+        return {"inserted": 0, "updated": 0, "calendars": 0, "ok": False, "error": "calendar_id requerido"}
+    range_start, range_end = _gcal_range_bounds(start_date, end_date)
+    total_ins = total_upd = 0
+    touched: list[tuple[str, datetime, datetime]] = []
+    errors: list[dict] = []
+    fetched = per_calendar(lambda cal_id, _pid: list_events_range(svc, cal_id, range_start, range_end, tz), pairs)
+    for (cal_id, pro_id), (items, err) in zip(pairs, fetched):
+        if err is not None:
+            errors.append({"calendar_id": cal_id, "error": str(err)})
+            continue
+        ins, upd = _bulk_upsert_gcal_items(session, items, cal_id, pro_id, default_service, touched)
+        total_ins += ins
+        total_upd += upd
         session.commit()
-    return {"ok": True, "created": created, "patched": patched, "calendars": len(pairs)}
-
-def detect_conflicts_range(session: Session, start_date: date, end_date: date, by_professional: bool = True, calendar_id: str | None = None, professional_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid")) -> dict:
-    """Detecta inconsistencias BD ↔ GCal: faltantes, huérfanos, desajustes y solapes externos."""
+        for t in touched:
+            invalidate_availability(*t)
+        touched.clear()
+    return {"ok": not errors, "inserted": total_ins, "updated": total_upd, "calendars": len(pairs), "errors": errors}
+
+def reconcile_db_to_gcal_range(session: Session, start_date: date, end_date: date, by_professional: bool = True, calendar_id: str | None = None, professional_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid"), force: bool = False) -> dict:
+    """Alinea eventos de GCal con la BD local: crea, parchea o mueve entre calendarios.
+
+    Las reservas cuya huella coincide con la última escritura (`gcal_fingerprint`) se dan por
+    alineadas sin consultar Google, y sólo se listan los calendarios con alguna reserva cambiada;
+    `force` las comprueba todas. Los parches llevan `If-Match` con el etag listado: si el evento
+    cambió entretanto, Google responde 412 y la reserva queda pendiente para la siguiente pasada.
+    """
+    try:
+        svc = build_calendar()
+    except Exception:
+        return {"ok": False, "created": 0, "patched": 0, "calendars": 0, "error": "gcal client"}
+    pairs = _gcal_pairs(by_professional, calendar_id, professional_id)
+    if pairs is None:
+        return {"ok": False, "created": 0, "patched": 0, "calendars": 0, "error": "calendar_id requerido"}
+    range_start, range_end = _gcal_range_bounds(start_date, end_date)
+    rows_by_pro = rows_by_pair(session, pairs, start_date, end_date)
+    dirty_by_pro = {pid: [r for r in rows if force or not _gcal_in_sync(r, get_calendar_for_professional(r.professional_id))] for pid, rows in rows_by_pro.items()}
+    skipped = sum(len(rows) for rows in rows_by_pro.values()) - sum(len(rows) for rows in dirty_by_pro.values())
+    to_list = [(cal_id, pid) for cal_id, pid in pairs if dirty_by_pro.get(pid)]
+    batch = EventBatch(svc)
+    pending: dict[tuple[str, str], tuple[ReservationDB, str]] = {}
+    failed: list[dict] = []
+    fetched = per_calendar(lambda cal_id, _pid: list_events_range(svc, cal_id, range_start, range_end, tz), to_list)
+    for (cal_id, pro_id), (gitems, err) in zip(to_list, fetched):
+        if err is not None:
+            # Sin el listado no se sabe qué existe: crear a ciegas duplicaría eventos.
+            failed.append({"calendar_id": cal_id, "op": "list", "error": str(err)})
+            continue
+        gmap = {it.get("id"): it for it in gitems if it.get("id")}
+        for r in dirty_by_pro[pro_id]:
+            target_cal = get_calendar_for_professional(r.professional_id)
+            moved = bool(r.google_event_id and r.google_calendar_id and r.google_calendar_id != target_cal)
+            if moved or not r.google_event_id or r.google_event_id not in gmap:
+                if moved:
+                    # El borrado del evento antiguo es best-effort; su fallo no bloquea la creación.
+                    batch.delete(("delete", r.id), r.google_calendar_id, r.google_event_id)
+                batch.insert(("create", r.id), target_cal, r.start, r.end, summary=f"Reserva: {r.service_id} - {r.professional_id}", private_props={"reservation_id": r.id, "professional_id": r.professional_id, "service_id": r.service_id}, tz=tz)
+                pending[("create", r.id)] = (r, target_cal)
+                continue
+            item = gmap[r.google_event_id]
+            span = event_interval(item)
+            if span and span != (to_naive_local(r.start), to_naive_local(r.end)):
+                batch.patch(("patch", r.id), target_cal, r.google_event_id, r.start, r.end, tz, etag=item.get("etag"))
+                pending[("patch", r.id)] = (r, target_cal)
+            else:
+                # Ya coincide: basta con anotar la versión vista para saltarla la próxima vez.
+                mark_gcal_synced(r, target_cal, item)
+                session.add(r)
+    results = batch.execute(max_workers=GCAL_MAX_WORKERS) if len(batch) else {}
+    created = patched = conflicts = 0
+    touched: list[tuple[str, datetime, datetime]] = []
+    for key, (r, target_cal) in pending.items():
+        res = results.get(key)
+        if res is None or not res.ok:
+            if res is not None and res.status == 412:
+                conflicts += 1
+            failed.append({"id": r.id, "op": key[0], "error": res.error if res else "sin respuesta"})
+            continue
+        mark_gcal_synced(r, target_cal, res.response)
+        session.add(r)
+        if key[0] == "create":
+            created += 1
+            touched.append((r.professional_id, r.start, r.end))
+        else:
+            patched += 1
+    session.commit()
+    for t in touched:
+        invalidate_availability(*t)
+    return {"ok": not failed, "created": created, "patched": patched, "skipped": skipped, "conflicts": conflicts, "failed": len(failed), "errors": failed[:10], "calendars": len(pairs), "listed": len(to_list)}
+
+def _sweep_overlaps(locals_iv: list[tuple[datetime, datetime, ReservationDB]], external_iv: list[tuple[datetime, datetime, str]]) -> dict[str, str]:
+    """Eventos externos que solapan alguna reserva local: {event_id: id de la primera reserva}.
+
+    Barrido por inicio sobre ambas listas ordenadas; sólo se comparan intervalos activos a la vez,
+    así que el coste es O((n + m) log(n + m) + solapes) en vez de n × m.
+    """
+    marks = sorted([(s_dt, 1, e_dt, r) for s_dt, e_dt, r in locals_iv] + [(s_dt, 0, e_dt, ev_id) for s_dt, e_dt, ev_id in external_iv], key=lambda x: (x[0], x[1]))
+    active_local: list[tuple[datetime, ReservationDB]] = []
+    active_ext: list[tuple[datetime, str]] = []
+    found: dict[str, str] = {}
+    for start, is_local, end, obj in marks:
+        # Los intervalos que acaban justo al empezar este no solapan (son contiguos).
+        active_local = [(e, r) for e, r in active_local if e > start]
+        active_ext = [(e, ev) for e, ev in active_ext if e > start]
+        if is_local:
+            for _, ev_id in active_ext:
+                if ev_id not in found and obj.google_event_id != ev_id:
+                    found[ev_id] = obj.id
+            active_local.append((end, obj))
+        else:
+            if obj not in found:
+                for _, r in active_local:
+                    if r.google_event_id != obj:
+                        found[obj] = r.id
+                        break
+            active_ext.append((end, obj))
+    return found
+
+def reservation_spans(session: Session, ids: Iterable[str]) -> dict[str, tuple[datetime, datetime]]:
+    """(inicio, fin) naive local de las reservas indicadas, con una consulta `IN` por tramo."""
+    ids = list(ids)
+    out: dict[str, tuple[datetime, datetime]] = {}
+    for lo in range(0, len(ids), _IN_CHUNK):
+        q = select(ReservationDB.id, ReservationDB.start, ReservationDB.end).where(ReservationDB.id.in_(ids[lo:lo + _IN_CHUNK]))
+        for rid, s_dt, e_dt in session.exec(q):
+            out[rid] = (to_naive_local(s_dt), to_naive_local(e_dt))
+    return out
+
+CONFLICT_KINDS = ("missing_in_gcal", "orphaned_in_gcal", "time_mismatch", "overlaps_external")
+
+def tagged_reservation_id(it: dict) -> Optional[str]:
+    return ((it.get("extendedProperties") or {}).get("private") or {}).get("reservation_id")
+
+def calendar_conflicts(cal_id: str, items: list, rows: Iterable[ReservationDB], gids: set, spans: dict[str, tuple[datetime, datetime]]) -> dict[str, list[dict]]:
+    """Conflictos de un calendario entre sus eventos `items` y las reservas `rows`, en orden de hora.
+
+    `gids` son los ids de todos los eventos listados del calendario (una reserva cuyo evento cae en
+    otro día no falta) y `spans` el horario de las reservas referenciadas por eventos etiquetados.
+    """
+    found: dict[str, list[dict]] = {kind: [] for kind in CONFLICT_KINDS}
+    locals_iv = sorted(((to_naive_local(r.start), to_naive_local(r.end), r) for r in rows), key=lambda x: (x[0], x[2].id))
+    for _, _, r in locals_iv:
+        tgt_cal = get_calendar_for_professional(r.professional_id)
+        if not r.google_event_id or r.google_event_id not in gids or (r.google_calendar_id and r.google_calendar_id != tgt_cal):
+            found["missing_in_gcal"].append({"id": r.id, "cal": tgt_cal, "start": r.start.isoformat()})
+    external_iv: list[tuple[datetime, datetime, str]] = []
+    for it in items:
+        ev_id = it.get("id")
+        span = event_interval(it)
+        if not span:
+            continue
+        rid = tagged_reservation_id(it)
+        if rid:
+            if rid not in spans:
+                found["orphaned_in_gcal"].append({"event_id": ev_id, "rid": rid, "cal": cal_id})
+            elif spans[rid] != span:
+                found["time_mismatch"].append({"rid": rid, "event_id": ev_id})
+            continue
+        external_iv.append((span[0], span[1], ev_id))
+    external_iv.sort(key=lambda x: (x[0], x[2] or ""))
+    overlaps = _sweep_overlaps(locals_iv, external_iv)
+    for _, _, ev_id in external_iv:
+        if ev_id in overlaps:
+            found["overlaps_external"].append({"event_id": ev_id, "rid": overlaps[ev_id]})
+    return found
+
+def _list_pairs_in_range(svc, pairs: list[tuple[str, str | None]], start_date: date, end_date: date, tz: str) -> tuple[list[tuple[str, str | None, list]], list[dict]]:
+    """Lista cada calendario del rango en paralelo. Devuelve ([(cal, pro, items)], errores)."""
+    range_start, range_end = _gcal_range_bounds(start_date, end_date)
+    fetched = per_calendar(lambda cal_id, _pid: list_events_range(svc, cal_id, range_start, range_end, tz), pairs)
+    listed: list[tuple[str, str | None, list]] = []
+    errors: list[dict] = []
+    for (cal_id, pro_id), (items, err) in zip(pairs, fetched):
+        if err is not None:
+            errors.append({"calendar_id": cal_id, "error": str(err)})
+        else:
+            listed.append((cal_id, pro_id, items))
+    return listed, errors
+
+def page_conflict_samples(found: dict[str, list[dict]], sample_limit: int, sample_offset: int) -> dict:
+    """Contadores totales más la página [`sample_offset`, `sample_offset` + `sample_limit`) de cada tipo."""
+    lo = max(0, int(sample_offset))
+    hi = lo + max(0, int(sample_limit))
+    out: dict = {kind: len(found[kind]) for kind in CONFLICT_KINDS}
+    out["samples"] = {kind: found[kind][lo:hi] for kind in CONFLICT_KINDS}
+    out["sample_offset"], out["sample_limit"] = lo, hi - lo
+    return out
+
+def detect_conflicts_range(session: Session, start_date: date, end_date: date, by_professional: bool = True, calendar_id: str | None = None, professional_id: str | None = None, tz: str = os.getenv("TZ", "Europe/Madrid"), sample_limit: int = 10, sample_offset: int = 0) -> dict:
+    """Detecta inconsistencias BD ↔ GCal: faltantes, huérfanos, desajustes y solapes externos.
+
+    Los contadores son totales; `samples` trae la página [`sample_offset`, `sample_offset` + `sample_limit`)
+    de cada tipo, en orden de calendario y hora.
+    """
     try:
         svc = build_calendar()
     except Exception as e:
         return {"ok": False, "error": f"gcal client: {e}"}
-    from app.data import PRO_CALENDAR
-    pairs: list[tuple[str, str | None]] = []
-    if by_professional:
-        for pid, cal in PRO_CALENDAR.items():
-            pairs.append((cal, pid))
-    else:
-        if not calendar_id:
-            return {"ok": False, "error": "calendar_id requerido"}
-        pairs.append((calendar_id, professional_id))
-    summary = {"ok": True, "calendars": len(pairs), "missing_in_gcal": 0, "orphaned_in_gcal": 0, "time_mismatch": 0, "overlaps_external": 0, "samples": {"missing_in_gcal": [], "orphaned_in_gcal": [], "time_mismatch": [], "overlaps_external": []}}
-    def _add_sample(kind: str, item: dict):
-        arr = summary["samples"][kind]
-        if len(arr) < 10: arr.append(item)
-    d = start_date
-    while d <= end_date:
-        day_start = datetime.combine(d, time(0, 0)); day_end = datetime.combine(d, time(23, 59, 59))
-        for cal_id, pro_id in pairs:
-            try:
-                items = list_events_range(svc, cal_id, iso_datetime(day_start, tz), iso_datetime(day_end, tz), tz)
-            except Exception:
-                items = []
-            gmap = {it.get("id"): it for it in items if it.get("id")}
-            q = select(ReservationDB).where(ReservationDB.start < day_end, ReservationDB.end > day_start)
-            if pro_id:
-                q = q.where(ReservationDB.professional_id == pro_id)
-            locals_rows = list(session.exec(q))
-            for r in locals_rows:
-                tgt_cal = get_calendar_for_professional(r.professional_id)
-                if not r.google_event_id or r.google_event_id not in gmap or (r.google_calendar_id and r.google_calendar_id != tgt_cal):
-                    summary["missing_in_gcal"] += 1
-                    _add_sample("missing_in_gcal", {"id": r.id, "cal": tgt_cal, "start": r.start.isoformat()})
-            for it in items:
-                ev_id = it.get("id")
-                start_v = (it.get("start") or {}).get("dateTime") or (it.get("start") or {}).get("date")
-                end_v = (it.get("end") or {}).get("dateTime") or (it.get("end") or {}).get("date")
-                if not start_v or not end_v:
-                    continue
-                sdt = _parse_gcal_dt(start_v); edt = _parse_gcal_dt(end_v)
-                priv = (it.get("extendedProperties") or {}).get("private") or {}
-                rid = priv.get("reservation_id")
-                if rid:
-                    r = session.get(ReservationDB, rid)
-                    if not r:
-                        summary["orphaned_in_gcal"] += 1
-                        _add_sample("orphaned_in_gcal", {"event_id": ev_id, "rid": rid, "cal": cal_id})
-                    else:
-                        if _to_naive_local(r.start) != _to_naive_local(sdt) or _to_naive_local(r.end) != _to_naive_local(edt):
-                            summary["time_mismatch"] += 1
-                            _add_sample("time_mismatch", {"rid": r.id, "event_id": ev_id})
-                    continue
-                for r in locals_rows:
-                    if r.google_event_id == ev_id:
-                        continue
-                    if not (edt <= r.start or sdt >= r.end):
-                        summary["overlaps_external"] += 1
-                        _add_sample("overlaps_external", {"event_id": ev_id, "rid": r.id})
-                        break
-        d += timedelta(days=1)
+    pairs = _gcal_pairs(by_professional, calendar_id, professional_id)
+    if pairs is None:
+        return {"ok": False, "error": "calendar_id requerido"}
+    summary: dict = {"ok": True, "calendars": len(pairs)}
+    rows_by_pro = rows_by_pair(session, pairs, start_date, end_date)
+    listed, errors = _list_pairs_in_range(svc, pairs, start_date, end_date, tz)
+    if errors:
+        summary["ok"] = False
+        summary["errors"] = errors
+    # Todas las reservas referenciadas por eventos etiquetados, en una sola consulta.
+    spans = reservation_spans(session, {rid for _, _, items in listed for it in items if (rid := tagged_reservation_id(it))})
+    found: dict[str, list[dict]] = {kind: [] for kind in CONFLICT_KINDS}
+    for cal_id, pro_id, items in listed:
+        gids = {it.get("id") for it in items if it.get("id")}
+        for kind, entries in calendar_conflicts(cal_id, items, rows_by_pro.get(pro_id, []), gids, spans).items():
+            found[kind].extend(entries)
+    summary.update(page_conflict_samples(found, sample_limit, sample_offset))
     return summary
@@ -0,0 +1,87 @@
+"""
+Ocupación diaria por profesional como mapa de bits a granularidad fija.
+
+Cada bit representa una celda de `GRID_MIN` minutos del día. El horario, las
+reservas locales y el busy de Google Calendar se rasterizan una sola vez y la
+disponibilidad de cualquier duración se resuelve con desplazamientos y AND
+sobre enteros de Python, sin recorrer intervalos por cada inicio candidato.
+"""
+from __future__ import annotations
+from datetime import date, datetime, time
+from math import gcd
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+GRID_MIN = 5
+DAY_MIN = 24 * 60
+
+
+def grid_for(*minutes: int) -> int:
+    """Mayor granularidad (divisor de GRID_MIN) compatible con todos los valores dados."""
+    g = GRID_MIN
+    for m in minutes:
+        g = gcd(g, int(m))
+    return g or 1
+
+
+def _window_and(mask: int, width: int) -> int:
+    """Bit i activo si los bits i..i+width-1 están todos activos (ventana deslizante en O(log width))."""
+    if width <= 1:
+        return mask
+    out = mask
+    span = 1
+    while span * 2 <= width:
+        out &= out >> span
+        span *= 2
+    if span < width:
+        out &= out >> (width - span)
+    return out
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """Índices de los bits activos en orden ascendente."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class DayOccupancy:
+    """Mapa de bits de celdas libres de un profesional en un día concreto."""
+    __slots__ = ("day", "grid", "cells", "_day_start", "_free")
+
+    def __init__(self, day: date, open_ranges: Sequence[Tuple[time, time]] = (), grid: int = GRID_MIN, open_mask: Optional[int] = None):
+        self.day = day
+        self.grid = grid
+        self.cells = DAY_MIN // grid
+        self._day_start = datetime.combine(day, time(0, 0))
+        if open_mask is None:
+            open_mask = 0
+            for start_t, end_t in open_ranges:
+                lo = (start_t.hour * 60 + start_t.minute) // grid
+                hi = -(-(end_t.hour * 60 + end_t.minute) // grid)
+                open_mask |= ((1 << (hi - lo)) - 1) << lo if hi > lo else 0
+        self._free = open_mask
+
+    def _cell_range(self, start_dt: datetime, end_dt: datetime) -> Tuple[int, int]:
+        """Celdas [lo, hi) que intersecan el intervalo, recortado al día (suelo/techo conservadores)."""
+        start_s = (start_dt - self._day_start).total_seconds()
+        end_s = (end_dt - self._day_start).total_seconds()
+        cell_s = self.grid * 60
+        lo = max(0, int(start_s // cell_s))
+        hi = min(self.cells, int(-(-end_s // cell_s)))
+        return lo, hi
+
+    def mark_busy(self, start_dt: datetime, end_dt: datetime) -> None:
+        lo, hi = self._cell_range(start_dt, end_dt)
+        if hi > lo:
+            self._free &= ~(((1 << (hi - lo)) - 1) << lo)
+
+    def mark_busy_many(self, intervals: Iterable[Tuple[datetime, datetime]]) -> "DayOccupancy":
+        for s, e in intervals:
+            self.mark_busy(s, e)
+        return self
+
+    def free_starts(self, duration_min: int) -> int:
+        """Máscara de celdas desde las que cabe `duration_min` minutos libres consecutivos."""
+        width = -(-int(duration_min) // self.grid)
+        return _window_and(self._free, width)
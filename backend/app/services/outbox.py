@@ -0,0 +1,258 @@
+"""
+Outbox transaccional para las escrituras en Google Calendar.
+
+Las rutas de reserva sólo graban la fila de `gcal_outbox` junto a la reserva, en la
+misma transacción, y responden sin esperar a Google. Un hilo de fondo drena la
+tabla en lotes (`EventBatch`), con reintentos y backoff por fila.
+
+Idempotencia: `upsert` se resuelve con el estado actual de la reserva y crea el evento con
+un id fijo derivado de la reserva (`reservation_event_id`): una segunda inserción recibe 409
+en vez de duplicarlo, y el siguiente intento parchea ese evento. Los eventos antiguos con id
+aleatorio se buscan por `private.reservation_id` al reintentar, igual que en `delete` sin
+evento conocido.
+
+Varios procesos pueden drenar a la vez (varios workers de uvicorn, o `/admin/outbox/drain`
+junto al hilo de fondo): cada fila se reserva con un UPDATE condicional que la pasa de
+`pending` a `inflight` con un plazo (`lease_until`), y sólo se procesa si ese UPDATE la ha
+cambiado. Si el proceso cae con filas en vuelo, vuelven a reservarse al vencer el plazo.
+"""
+from __future__ import annotations
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import and_, or_, update
+from sqlmodel import Session, select, func
+
+from app.models import GCalOutbox, ReservationDB
+from app.utils.date import as_utc
+
+logger = logging.getLogger("pelubot.outbox")
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE_S = float(os.getenv("OUTBOX_BACKOFF_BASE_S", "5"))
+OUTBOX_BACKOFF_MAX_S = float(os.getenv("OUTBOX_BACKOFF_MAX_S", "900"))
+OUTBOX_POLL_S = float(os.getenv("OUTBOX_POLL_S", "5"))
+OUTBOX_LEASE_S = float(os.getenv("OUTBOX_LEASE_S", "300"))
+
+# Despierta al worker en cuanto hay trabajo nuevo en vez de esperar al siguiente sondeo.
+_wakeup = threading.Event()
+
+
+def enqueue_gcal_upsert(session: Session, reservation_id: str, new: bool = False) -> None:
+    """Añade (sin commit) la sincronización de la reserva.
+
+    Hay como mucho un `upsert` pendiente por reserva: si ya existe se adelanta, ya que se
+    resuelve con el estado de la reserva en el momento de procesarlo. Con `new=True`
+    (reserva recién creada) no puede haber ninguna y se omite la consulta.
+    """
+    pending = None if new else session.exec(select(GCalOutbox).where(GCalOutbox.reservation_id == reservation_id, GCalOutbox.op == "upsert", GCalOutbox.status == "pending")).first()
+    if pending is None:
+        session.add(GCalOutbox(reservation_id=reservation_id, op="upsert"))
+    else:
+        pending.next_attempt_at = datetime.now(timezone.utc)
+        session.add(pending)
+
+
+def enqueue_gcal_delete(session: Session, reservation_id: str, calendar_id: Optional[str], event_id: Optional[str]) -> None:
+    """Añade (sin commit) el borrado del evento de una reserva que se está cancelando."""
+    session.add(GCalOutbox(reservation_id=reservation_id, op="delete", calendar_id=calendar_id, event_id=event_id))
+
+
+def notify_worker() -> None:
+    _wakeup.set()
+
+
+def _claim(session: Session, now: datetime, limit: int) -> list[GCalOutbox]:
+    """Reserva hasta `limit` filas vencidas (o en vuelo con el plazo caducado) para este proceso.
+
+    El intento se anota en el mismo UPDATE, antes de llamar a Google: si el proceso cae a
+    mitad, el siguiente intento sabe que el evento pudo llegar a crearse.
+    """
+    claimable = or_(
+        and_(GCalOutbox.status == "pending", GCalOutbox.next_attempt_at <= now),
+        and_(GCalOutbox.status == "inflight", GCalOutbox.lease_until < now),
+    )
+    candidates = list(session.exec(select(GCalOutbox.id).where(claimable).order_by(GCalOutbox.id).limit(limit)))
+    lease_until = now + timedelta(seconds=OUTBOX_LEASE_S)
+    claimed: list[int] = []
+    for row_id in candidates:
+        # Otro proceso pudo reservarla entre la consulta y aquí: sólo cuenta si el UPDATE la cambió.
+        res = session.exec(update(GCalOutbox).where(GCalOutbox.id == row_id, claimable).values(status="inflight", lease_until=lease_until, attempts=GCalOutbox.attempts + 1))
+        if res.rowcount == 1:
+            claimed.append(row_id)
+        session.commit()
+    if not claimed:
+        return []
+    return list(session.exec(select(GCalOutbox).where(GCalOutbox.id.in_(claimed)).order_by(GCalOutbox.id)))
+
+
+def _fail(row: GCalOutbox, error: str, now: datetime) -> None:
+    row.last_error = error[:500]
+    row.status, row.lease_until = "pending", None
+    if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+        row.status = "dead"
+        logger.error("Outbox %s (%s %s) descartada tras %d intentos: %s", row.id, row.op, row.reservation_id, row.attempts, error)
+        return
+    delay = min(OUTBOX_BACKOFF_MAX_S, OUTBOX_BACKOFF_BASE_S * (2 ** (row.attempts - 1)))
+    row.next_attempt_at = now + timedelta(seconds=delay)
+
+
+def drain_outbox(session: Session, limit: int = OUTBOX_BATCH_SIZE) -> dict:
+    """Procesa un lote de filas pendientes y vencidas. Devuelve contadores del lote."""
+    from app.integrations.circuit_breaker import gcal_breaker
+    from app.integrations.google_calendar import build_calendar, EventBatch, find_events_by_reservation, reservation_event_id
+    from app.services.logic import get_calendar_for_professional, mark_gcal_synced
+
+    if gcal_breaker.is_open():
+        # Las filas esperan sin gastar intentos hasta que el circuito deje pasar la prueba.
+        return {"processed": 0, "done": 0, "failed": 0, "dead": 0, "circuit": "open"}
+    now = datetime.now(timezone.utc)
+    rows = _claim(session, now, limit)
+    if not rows:
+        return {"processed": 0, "done": 0, "failed": 0, "dead": 0}
+    try:
+        svc = build_calendar()
+    except Exception as e:
+        for row in rows:
+            _fail(row, f"gcal client: {e}", now)
+            session.add(row)
+        session.commit()
+        return {"processed": len(rows), "done": 0, "failed": len(rows), "dead": sum(1 for r in rows if r.status == "dead")}
+
+    batch = EventBatch(svc)
+    # Por fila: (reserva, calendario destino) para aplicar el resultado del upsert.
+    plans: dict[int, tuple[Optional[ReservationDB], Optional[str]]] = {}
+    done: list[GCalOutbox] = []
+    failed: list[tuple[GCalOutbox, str]] = []
+    for row in rows:
+        try:
+            if row.op == "delete":
+                event_ids = [row.event_id] if row.event_id else [ev["id"] for ev in find_events_by_reservation(svc, row.calendar_id, row.reservation_id)]
+                if not event_ids:
+                    done.append(row)
+                    continue
+                for i, ev_id in enumerate(event_ids):
+                    batch.delete((row.id, "delete", i), row.calendar_id, ev_id)
+                plans[row.id] = (None, row.calendar_id)
+                continue
+            r = session.get(ReservationDB, row.reservation_id)
+            if r is None:
+                # Cancelada antes de sincronizar: su fila `delete` se encarga del evento.
+                done.append(row)
+                continue
+            target_cal = get_calendar_for_professional(r.professional_id)
+            if r.google_event_id and r.google_calendar_id == target_cal:
+                batch.patch((row.id, "patch"), target_cal, r.google_event_id, r.start, r.end, restore=True)
+                plans[row.id] = (r, target_cal)
+                continue
+            if r.google_event_id and r.google_calendar_id:
+                batch.delete((row.id, "move"), r.google_calendar_id, r.google_event_id)
+            existing = find_events_by_reservation(svc, target_cal, r.id) if row.attempts > 1 else []
+            if existing:
+                r.google_event_id, r.google_calendar_id = existing[0]["id"], target_cal
+                batch.patch((row.id, "patch"), target_cal, r.google_event_id, r.start, r.end, restore=True)
+            else:
+                batch.insert((row.id, "insert"), target_cal, r.start, r.end, summary=f"Reserva: {r.service_id} - {r.professional_id}", private_props={"reservation_id": r.id, "professional_id": r.professional_id, "service_id": r.service_id}, event_id=reservation_event_id(r.id))
+            plans[row.id] = (r, target_cal)
+        except Exception as e:
+            failed.append((row, str(e)))
+
+    results = batch.execute() if len(batch) else {}
+    by_row: dict[int, list] = {}
+    for key, res in results.items():
+        by_row.setdefault(key[0], []).append((key[1], res))
+    for row in rows:
+        if row.id not in plans:
+            continue
+        r, target_cal = plans[row.id]
+        outcome = by_row.get(row.id, [])
+        # Un evento ya borrado (404/410) cuenta como éxito; el borrado previo a un traslado es best-effort.
+        errors = [res.error for kind, res in outcome if not res.ok and kind != "move" and not (kind == "delete" and res.status in (404, 410))]
+        if errors:
+            if r is not None and any(kind == "insert" and res.status == 409 for kind, res in outcome):
+                # El evento de id fijo ya existe (otro drenado lo creó, o quedó cancelado en
+                # Google): el siguiente intento lo parchea con el estado actual de la reserva.
+                r.google_event_id, r.google_calendar_id = reservation_event_id(r.id), target_cal
+                session.add(r)
+            elif r is not None and any(kind == "patch" and res.status in (404, 410) for kind, res in outcome):
+                # El evento se borró a mano en Google: el siguiente intento lo vuelve a crear.
+                r.google_event_id = r.google_calendar_id = None
+                session.add(r)
+            failed.append((row, errors[0] or "error"))
+            continue
+        for kind, res in outcome:
+            if kind in ("insert", "patch") and r is not None:
+                # Con la huella anotada la reconciliación nocturna no vuelve a consultar esta reserva.
+                mark_gcal_synced(r, target_cal, res.response)
+                session.add(r)
+        done.append(row)
+
+    for row in done:
+        session.delete(row)
+    for row, error in failed:
+        _fail(row, error, now)
+        session.add(row)
+    session.commit()
+    return {"processed": len(rows), "done": len(done), "failed": len(failed), "dead": sum(1 for r, _ in failed if r.status == "dead")}
+
+
+def outbox_stats(session: Session) -> dict:
+    counts = dict(session.exec(select(GCalOutbox.status, func.count()).group_by(GCalOutbox.status)).all())
+    oldest = session.exec(select(func.min(GCalOutbox.created_at)).where(GCalOutbox.status == "pending")).one()
+    return {"pending": counts.get("pending", 0), "inflight": counts.get("inflight", 0), "dead": counts.get("dead", 0), "oldest_pending": as_utc(oldest).isoformat() if oldest else None}
+
+
+def retry_dead(session: Session) -> int:
+    """Vuelve a poner en cola las filas descartadas (p. ej. tras arreglar credenciales)."""
+    rows = list(session.exec(select(GCalOutbox).where(GCalOutbox.status == "dead")))
+    now = datetime.now(timezone.utc)
+    for row in rows:
+        row.status, row.attempts, row.next_attempt_at = "pending", 0, now
+        session.add(row)
+    session.commit()
+    return len(rows)
+
+
+class OutboxWorker:
+    """Hilo que drena el outbox al recibir aviso o cada `OUTBOX_POLL_S` segundos.
+
+    Con `lease` sólo drena mientras este proceso tenga el plazo de los trabajos de fondo.
+    """
+
+    def __init__(self, engine, poll_s: float = OUTBOX_POLL_S, lease=None):
+        self._engine = engine
+        self._poll_s = poll_s
+        self._lease = lease
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="gcal-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        _wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            _wakeup.clear()
+            if self._lease is not None and not self._lease.held:
+                _wakeup.wait(self._poll_s)
+                continue
+            try:
+                with Session(self._engine) as s:
+                    # Mientras salgan lotes llenos se sigue drenando sin esperar.
+                    while not self._stop.is_set() and drain_outbox(s)["processed"] >= OUTBOX_BATCH_SIZE:
+                        pass
+            except Exception:
+                logger.exception("Error drenando el outbox de Google Calendar")
+            _wakeup.wait(self._poll_s)
@@ -0,0 +1,109 @@
+"""
+Tabla precalculada de inicios candidatos por (duración, día de la semana, paso).
+
+Los inicios se expresan en minutos desde medianoche y se derivan de
+`WEEKLY_SCHEDULE`, de modo que el motor de huecos y la validación de
+reprogramaciones no repiten aritmética de fechas en cada petición. La tabla se
+construye al arrancar (o en la primera consulta) y no vigila el horario ni el catálogo:
+las reconstrucciones son explícitas. Quien cambie `WEEKLY_SCHEDULE` o `SERVICES` en
+caliente debe llamar a `start_grids.invalidate()` (o a `rebuild()`).
+"""
+from __future__ import annotations
+import threading
+from dataclasses import dataclass
+from typing import Dict, Sequence, Tuple
+
+from app.data import SERVICES, WEEKLY_SCHEDULE
+from app.services.occupancy import grid_for
+
+DEFAULT_STEP_MIN = 15
+
+
+@dataclass(frozen=True)
+class StartGrid:
+    """Inicios de un (duración, día, paso) y sus máscaras a la granularidad `grid`."""
+    duration_min: int
+    weekday: int
+    step_min: int
+    grid: int
+    offsets: Tuple[int, ...]
+    mask: int
+    open_mask: int
+
+
+def _minutes(t) -> int:
+    return t.hour * 60 + t.minute
+
+
+def _ranges(weekday: int) -> Sequence[Tuple[int, int]]:
+    return tuple((_minutes(s), _minutes(e)) for s, e in WEEKLY_SCHEDULE.get(weekday, []))
+
+
+def _build(duration_min: int, weekday: int, step_min: int) -> StartGrid:
+    ranges = _ranges(weekday)
+    grid = grid_for(step_min, duration_min, *(m for r in ranges for m in r))
+    offsets = []
+    mask = open_mask = 0
+    for lo, hi in ranges:
+        cursor = lo
+        while cursor + duration_min <= hi:
+            offsets.append(cursor)
+            mask |= 1 << (cursor // grid)
+            cursor += step_min
+        first, last = lo // grid, -(-hi // grid)
+        if last > first:
+            open_mask |= ((1 << (last - first)) - 1) << first
+    return StartGrid(duration_min, weekday, step_min, grid, tuple(offsets), mask, open_mask)
+
+
+class StartGridTable:
+    """Memoiza `StartGrid` por clave; sólo se rehace con `rebuild()` o tras `invalidate()`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grids: Dict[Tuple[int, int, int], StartGrid] = {}
+        self._windows: Dict[Tuple[int, int], Tuple[Tuple[int, int], ...]] = {}
+        self._built = False
+
+    def _check(self) -> None:
+        # Camino de cada consulta: sólo mira si hay tabla, sin recorrer horario ni catálogo.
+        if not self._built:
+            self.rebuild()
+
+    def invalidate(self) -> None:
+        """Descarta la tabla; la siguiente consulta la reconstruye con el horario y catálogo actuales."""
+        with self._lock:
+            self._built = False
+
+    def rebuild(self, steps: Sequence[int] = (DEFAULT_STEP_MIN,)) -> None:
+        """Reconstruye la tabla para todas las duraciones del catálogo y los pasos indicados."""
+        grids = {(d, wd, step): _build(d, wd, step) for d in sorted({svc.duration_min for svc in SERVICES}) for wd in range(7) for step in steps}
+        with self._lock:
+            self._grids, self._windows, self._built = grids, {}, True
+
+    def get(self, duration_min: int, weekday: int, step_min: int = DEFAULT_STEP_MIN) -> StartGrid:
+        self._check()
+        key = (int(duration_min), int(weekday), int(step_min))
+        grid = self._grids.get(key)
+        if grid is None:
+            grid = _build(*key)
+            with self._lock:
+                self._grids[key] = grid
+        return grid
+
+    def windows(self, duration_min: int, weekday: int) -> Tuple[Tuple[int, int], ...]:
+        """Intervalos [primer, último] de inicios (minutos) en los que cabe la duración."""
+        self._check()
+        key = (int(duration_min), int(weekday))
+        w = self._windows.get(key)
+        if w is None:
+            w = tuple((lo, hi - duration_min) for lo, hi in _ranges(weekday) if hi - lo >= duration_min)
+            with self._lock:
+                self._windows[key] = w
+        return w
+
+    def fits(self, duration_min: int, weekday: int, start_min: float) -> bool:
+        return any(lo <= start_min <= hi for lo, hi in self.windows(duration_min, weekday))
+
+
+start_grids = StartGridTable()
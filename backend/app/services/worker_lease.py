@@ -0,0 +1,117 @@
+"""
+Elección de un único proceso para los trabajos de fondo.
+
+Con `uvicorn --workers N` cada proceso ejecuta el lifespan: sin coordinación el outbox, el
+informe de conflictos y la renovación de canales correrían N veces, pisándose el estado y
+gastando cuota de Google. Todos compiten por una fila de `worker_lease` con plazo; quien la
+tiene la renueva cada tercio del plazo desde un hilo propio, y los trabajos sólo hacen su
+pasada si `held` es cierto. Si el proceso cae, otro la toma al vencer el plazo.
+
+`PELUBOT_RUN_WORKERS=0` deja una instancia fuera de la elección (p. ej. réplicas que sólo
+atienden peticiones).
+"""
+from __future__ import annotations
+import logging
+import os
+import socket
+import threading
+import time as _time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from app.models import WorkerLease
+
+logger = logging.getLogger("pelubot.worker_lease")
+
+WORKER_LEASE_TTL_S = float(os.getenv("WORKER_LEASE_TTL_S", "60"))
+
+
+def run_workers_enabled() -> bool:
+    return os.getenv("PELUBOT_RUN_WORKERS", "true").lower() in ("1", "true", "yes", "si", "sí", "y")
+
+
+def try_acquire(session: Session, name: str, holder: str, ttl_s: float) -> bool:
+    """Toma o renueva el plazo `name` para `holder` si está libre, vencido o ya es suyo."""
+    now = datetime.now(timezone.utc)
+    expires = now + timedelta(seconds=ttl_s)
+    res = session.exec(update(WorkerLease).where(WorkerLease.name == name, or_(WorkerLease.holder == holder, WorkerLease.expires_at < now)).values(holder=holder, expires_at=expires))
+    session.commit()
+    if res.rowcount == 1:
+        return True
+    if session.get(WorkerLease, name) is not None:
+        return False
+    try:
+        session.add(WorkerLease(name=name, holder=holder, expires_at=expires))
+        session.commit()
+        return True
+    except IntegrityError:
+        # Otro proceso creó la fila a la vez.
+        session.rollback()
+        return False
+
+
+def release(session: Session, name: str, holder: str) -> None:
+    session.exec(update(WorkerLease).where(WorkerLease.name == name, WorkerLease.holder == holder).values(expires_at=datetime.now(timezone.utc)))
+    session.commit()
+
+
+class LeaderLease:
+    """Mantiene (o intenta conseguir) el plazo `name` para este proceso en un hilo de fondo."""
+
+    def __init__(self, engine, name: str = "background", ttl_s: float = WORKER_LEASE_TTL_S):
+        self._engine = engine
+        self.name = name
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._ttl_s = ttl_s
+        # Instante (monotónico) hasta el que este proceso puede confiar en tener el plazo.
+        self._held_until = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def held(self) -> bool:
+        return _time.monotonic() < self._held_until
+
+    def renew(self) -> bool:
+        started = _time.monotonic()
+        try:
+            with Session(self._engine) as s:
+                ok = try_acquire(s, self.name, self.holder, self._ttl_s)
+        except Exception:
+            logger.exception("Error renovando el plazo %s", self.name)
+            ok = False
+        was_held = self.held
+        # Se descuenta un margen para dejarlo antes de que otro proceso pueda tomarlo.
+        self._held_until = started + self._ttl_s * 0.8 if ok else 0.0
+        if ok != was_held:
+            logger.info("Plazo %s %s por %s", self.name, "conseguido" if ok else "perdido", self.holder)
+        return ok
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self.renew()
+            self._thread = threading.Thread(target=self._run, name=f"lease-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.held:
+            # Se libera al apagar para que otro proceso no espere a que venza.
+            self._held_until = 0.0
+            try:
+                with Session(self._engine) as s:
+                    release(s, self.name, self.holder)
+            except Exception:
+                logger.exception("Error liberando el plazo %s", self.name)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._ttl_s / 3):
+            self.renew()
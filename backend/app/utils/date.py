@@ -1,4 +1,5 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 from zoneinfo import ZoneInfo
 
 TZ = ZoneInfo("Europe/Madrid")
@@ -8,6 +9,15 @@ MAX_AHEAD_DAYS = 183  # ~6 meses
 def now_tz() -> datetime:
     return datetime.now(TZ)
 
+def as_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    """Marca como UTC un datetime naive leído de una columna `timezone=True`.
+
+    SQLite devuelve naive lo que se guardó aware; las columnas de marcas de tiempo se guardan en UTC.
+    """
+    if dt is None:
+        return None
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
 def validate_target_dt(dt: datetime) -> None:
     """
     Reglas:
@@ -1,10 +1,12 @@
 # tests/conftest.py
 import importlib
+from datetime import date, timedelta
 from pathlib import Path
 import sys
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event
 from sqlalchemy.pool import StaticPool
 from sqlmodel import SQLModel, create_engine, Session
 
@@ -21,19 +23,76 @@ def _import_app_and_deps():
     main = importlib.import_module("app.main")
     return models, db, routes, main
 
+def _next_workday(days_ahead: int = 32) -> date:
+    d = date.today() + timedelta(days=days_ahead)
+    while d.weekday() >= 5:  # lunes a viernes: jornada de mañana y tarde
+        d += timedelta(days=1)
+    return d
+
 @pytest.fixture()
-def app_client(monkeypatch):
-    models, db, routes, main = _import_app_and_deps()
+def next_workday():
+    """Primer día de lunes a viernes a partir de hoy + `days_ahead` (32 por defecto)."""
+    return _next_workday
+
+@pytest.fixture()
+def api_headers():
+    """Cabecera con la API key que espera la app, sea cual sea el entorno con que se importó."""
+    _, _, routes, _ = _import_app_and_deps()
+    return {"X-API-Key": routes.API_KEY}
 
+@pytest.fixture(autouse=True)
+def _reset_caches():
+    # Las cachés en proceso sobreviven entre tests; cada test parte de BD vacía.
+    from app.services.availability_cache import availability_cache
+    from app.integrations.google_calendar import reset_calendar_client
+    from app.integrations.google_calendar_async import reset_calendar_client_async
+    from app.integrations.freebusy_cache import freebusy_cache
+    from app.integrations.rate_limit import gcal_throttle
+    from app.integrations.circuit_breaker import gcal_breaker
+    from app.services.slot_grid import start_grids
+    availability_cache.clear()
+    freebusy_cache.clear()
+    reset_calendar_client()
+    reset_calendar_client_async()
+    # Sin límite de cuota salvo en los tests que lo configuren explícitamente.
+    gcal_throttle.reset(rate=0)
+    gcal_breaker.reset()
+    # Los tests que alteran WEEKLY_SCHEDULE lo restauran al terminar; la tabla se rehace con él.
+    start_grids.invalidate()
+    yield
+
+@pytest.fixture()
+def db_engine():
+    _import_app_and_deps()
     # Engine de prueba: una sola conexión en memoria para todas las sesiones
     engine = create_engine(
         "sqlite://",  # equivalente a :memory: pero con StaticPool
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
-
     # Crear todas las tablas del modelo en esta conexión compartida
     SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture()
+def query_counter(db_engine):
+    """Cuenta las sentencias SELECT emitidas contra el engine de prueba."""
+    statements: list[str] = []
+
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(db_engine, "before_cursor_execute", _before)
+    try:
+        yield statements
+    finally:
+        event.remove(db_engine, "before_cursor_execute", _before)
+
+@pytest.fixture()
+def app_client(monkeypatch, db_engine):
+    models, db, routes, main = _import_app_and_deps()
+    engine = db_engine
 
     # Dependency override para que la app use nuestra sesión de test
     def get_test_session():
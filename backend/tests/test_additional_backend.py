@@ -104,3 +104,58 @@ def test_delete_cancel_and_double_cancel(app_client):
     r_del2 = app_client.delete(f"/reservations/{res_id}", headers={"X-API-Key": API_KEY})
     assert r_del2.status_code == 404
 
+
+
+def test_migrations_upgrade_legacy_sqlite_and_range_query_uses_index(tmp_path, db_engine):
+    from sqlalchemy import create_engine, inspect, text
+    from sqlmodel import Session
+    from app.migrations import MIGRATIONS, current_version, run_migrations
+    from app.services.logic import _reservations_for_pros_in_range
+
+    # Tabla tal como la dejaba `create_all` antes de las columnas de GCal y los índices.
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with legacy.begin() as conn:
+        conn.execute(text('CREATE TABLE reservationdb (id VARCHAR PRIMARY KEY, service_id VARCHAR NOT NULL, professional_id VARCHAR NOT NULL, start DATETIME NOT NULL, "end" DATETIME NOT NULL, google_event_id VARCHAR, google_calendar_id VARCHAR, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)'))
+        conn.execute(text("INSERT INTO reservationdb VALUES ('r1', 'corte', 'ana', '2030-01-07 10:00:00', '2030-01-07 10:30:00', NULL, NULL, '2030-01-01 00:00:00', '2030-01-01 00:00:00')"))
+    assert run_migrations(legacy) == [v for v, _, _ in MIGRATIONS]
+    assert run_migrations(legacy) == [] and current_version(legacy) == MIGRATIONS[-1][0]
+    insp = inspect(legacy)
+    assert {"google_etag", "google_updated", "gcal_fingerprint"} <= {c["name"] for c in insp.get_columns("reservationdb")}
+    assert {"ix_reservationdb_professional_id_start_end", "ix_reservationdb_start", "ix_reservationdb_google_event_id"} <= {i["name"] for i in insp.get_indexes("reservationdb")}
+    with Session(legacy) as s:
+        assert [r.id for r in _reservations_for_pros_in_range(s, ["ana"], date(2030, 1, 7), date(2030, 1, 7))] == ["r1"]
+
+    # En una BD nueva `create_all` ya crea los índices: la consulta de solape no recorre la tabla.
+    with db_engine.connect() as conn:
+        plan = " ".join(str(row[-1]) for row in conn.execute(text("EXPLAIN QUERY PLAN SELECT id FROM reservationdb WHERE professional_id IN ('ana') AND start < '2030-01-08' AND \"end\" > '2030-01-07'")))
+    assert "ix_reservationdb_professional_id_start_end" in plan
+
+
+def test_migrations_from_concurrent_workers_apply_once(tmp_path):
+    import threading
+    from sqlalchemy import create_engine, text
+    from app.migrations import MIGRATIONS, run_migrations
+
+    path = tmp_path / "shared.db"
+    with create_engine(f"sqlite:///{path}").begin() as conn:
+        conn.execute(text('CREATE TABLE reservationdb (id VARCHAR PRIMARY KEY, service_id VARCHAR NOT NULL, professional_id VARCHAR NOT NULL, start DATETIME NOT NULL, "end" DATETIME NOT NULL, google_event_id VARCHAR, google_calendar_id VARCHAR, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)'))
+    # Dos workers de uvicorn arrancando a la vez, cada uno con su engine.
+    start = threading.Barrier(2)
+    results: list = []
+
+    def _worker():
+        engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+        start.wait()
+        try:
+            results.append(run_migrations(engine))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=_worker) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results, key=len) == [[], [v for v, _, _ in MIGRATIONS]]
+    with create_engine(f"sqlite:///{path}").connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM schema_version")).scalar() == len(MIGRATIONS)
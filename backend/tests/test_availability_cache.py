@@ -0,0 +1,45 @@
+from datetime import date
+
+from app.services.availability_cache import AvailabilityCache
+
+
+def test_cache_lru_and_versions():
+    cache = AvailabilityCache(maxsize=2, ttl_s=0)
+    d = date(2030, 1, 7)
+    deps = [("ana", d)]
+    v = cache.snapshot(deps)
+    cache.put("a", (1,), deps, v)
+    assert cache.get("a") == (1,)
+    # Una escritura durante el cálculo impide guardar un valor obsoleto.
+    v_old = cache.snapshot(deps)
+    cache.invalidate("ana", d)
+    cache.put("b", (2,), deps, v_old)
+    assert cache.get("b") is None
+    assert cache.get("a") is None
+    v = cache.snapshot(deps)
+    for key in ("x", "y", "z"):
+        cache.put(key, (0,), deps, v)
+    assert cache.get("x") is None and cache.get("z") == (0,)
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["size"] == 2
+
+
+def test_slots_cache_hits_and_invalidates_on_booking(app_client, query_counter, next_workday, api_headers):
+    target = next_workday()
+    q = {"service_id": "corte", "date_str": target.isoformat(), "professional_id": "luis"}
+    first = app_client.post("/slots", json=q).json()["slots"]
+    query_counter.clear()
+    again = app_client.post("/slots", json=q).json()["slots"]
+    assert again == first
+    assert query_counter == []
+    assert app_client.get("/metrics").status_code == 401
+    m = app_client.get("/metrics", headers=api_headers).json()["availability_cache"]
+    assert m["hits"] >= 1 and m["misses"] >= 1
+
+    r = app_client.post("/reservations", headers=api_headers, json={"service_id": "corte", "professional_id": "luis", "start": first[0]})
+    assert r.status_code == 200
+    after = app_client.post("/slots", json=q).json()["slots"]
+    assert first[0] not in after
+    res_id = r.json()["message"].split("ID: ")[1].split(",")[0]
+    assert app_client.delete(f"/reservations/{res_id}", headers=api_headers).status_code == 200
+    assert first[0] in app_client.post("/slots", json=q).json()["slots"]
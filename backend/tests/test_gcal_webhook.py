@@ -0,0 +1,78 @@
+import os
+from datetime import date
+
+from sqlmodel import Session, select
+
+import app.integrations.google_calendar as gcal
+from app.data import PRO_CALENDAR
+from app.models import GCalChannel, GCalSyncState
+from app.services.availability_cache import availability_cache
+
+API_KEY = "test-api-key"
+os.environ["API_KEY"] = API_KEY
+HEADERS = {"X-API-Key": API_KEY}
+
+
+def _notify(client, channel, state="exists", token=None):
+    return client.post("/gcal/webhook", headers={
+        "X-Goog-Channel-ID": channel.id,
+        "X-Goog-Resource-State": state,
+        "X-Goog-Channel-Token": channel.token if token is None else token,
+        "X-Goog-Resource-ID": channel.resource_id,
+    })
+
+
+def test_watch_register_renew_and_stop(app_client, db_engine):
+    r = app_client.post("/admin/gcal/watch", headers=HEADERS, json={"address": "https://example.test/gcal/webhook"})
+    assert r.json()["registered"] == len(PRO_CALENDAR)
+    r = app_client.post("/admin/gcal/watch", headers=HEADERS, json={"address": "https://example.test/gcal/webhook"})
+    assert r.json()["registered"] == 0 and r.json()["kept"] == len(PRO_CALENDAR)
+    r = app_client.post("/admin/gcal/watch", headers=HEADERS, json={"address": "https://example.test/gcal/webhook", "force": True, "professional_id": "ana"})
+    assert (r.json()["registered"], r.json()["stopped"]) == (1, 1)
+    assert len(gcal.build_calendar()._channels) == len(PRO_CALENDAR)
+    r = app_client.post("/admin/gcal/watch", headers=HEADERS, json={"stop": True})
+    assert r.json()["stopped"] == len(PRO_CALENDAR)
+    with Session(db_engine) as s:
+        assert s.exec(select(GCalChannel)).all() == []
+
+
+def test_webhook_imports_calendar_and_invalidates_caches(app_client, db_engine, monkeypatch):
+    app_client.post("/admin/gcal/watch", headers=HEADERS, json={"address": "https://example.test/gcal/webhook", "professional_id": "ana"})
+    with Session(db_engine) as s:
+        channel = s.exec(select(GCalChannel)).one()
+    invalidated = []
+    monkeypatch.setattr(gcal.freebusy_cache, "invalidate", lambda cal=None: invalidated.append(cal))
+    before = availability_cache.snapshot([("ana", date(2030, 1, 7))])
+
+    assert _notify(app_client, channel, state="sync").json()["state"] == "sync"
+    assert invalidated == []
+    assert _notify(app_client, channel, token="wrong").status_code == 403
+    channel_unknown = GCalChannel(id="nope", calendar_id="x", resource_id="r", token="t", address="a")
+    assert _notify(app_client, channel_unknown).status_code == 404
+
+    # Se responde sin importar; la tarea de fondo (que TestClient ejecuta antes de volver) importa.
+    r = _notify(app_client, channel)
+    assert r.status_code == 200 and r.json()["queued"] and "import" not in r.json()
+    assert invalidated == [PRO_CALENDAR["ana"]]
+    assert availability_cache.snapshot([("ana", date(2030, 1, 7))]) != before
+    with Session(db_engine) as s:
+        assert s.get(GCalSyncState, PRO_CALENDAR["ana"]).sync_token.startswith("fake-sync")
+
+
+def test_channels_renewed_by_the_lease_holder_and_registered_under_a_lock(db_engine, monkeypatch):
+    import app.services.gcal_watch as gcal_watch
+    from app.services.worker_lease import LeaderLease, try_acquire
+
+    monkeypatch.setattr(gcal_watch, "GCAL_WEBHOOK_URL", "https://example.test/gcal/webhook")
+    leader, follower = LeaderLease(db_engine), LeaderLease(db_engine)
+    assert leader.renew() and not follower.renew()
+    assert gcal_watch.ChannelRenewer(db_engine, lease=follower).run_once() is None
+    assert gcal_watch.ChannelRenewer(db_engine, lease=leader).run_once()["registered"] == len(PRO_CALENDAR)
+    assert gcal_watch.ChannelRenewer(db_engine, lease=leader).run_once()["kept"] == len(PRO_CALENDAR)
+
+    # Con el calendario bloqueado por otro proceso registrándolo, no se crea un segundo canal.
+    with Session(db_engine) as s:
+        assert try_acquire(s, f"gcal_watch:{PRO_CALENDAR['ana']}", "otro-proceso", 60)
+        out = gcal_watch.ensure_channels(s, professional_id="ana", force=True)
+    assert (out["busy"], out["registered"]) == (1, 0)
+    assert len(gcal.build_calendar()._channels) == len(PRO_CALENDAR)
@@ -0,0 +1,763 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import app.integrations.google_calendar as gcal
+
+
+def test_build_calendar_is_shared_and_resettable():
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        clients = list(pool.map(lambda _: gcal.build_calendar(), range(32)))
+    assert all(c is clients[0] for c in clients)
+    gcal.reset_calendar_client()
+    assert gcal.build_calendar() is not clients[0]
+
+
+def test_credentials_refreshed_before_expiry():
+    class _Creds:
+        def __init__(self, expires_in):
+            self.token = "t"
+            self.expiry = datetime.utcnow() + timedelta(seconds=expires_in)
+            self.refreshed = 0
+
+        def refresh(self, request):
+            self.refreshed += 1
+            self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    soon = _Creds(gcal.GCAL_REFRESH_MARGIN_S - 10)
+    later = _Creds(gcal.GCAL_REFRESH_MARGIN_S + 600)
+    gcal._ensure_fresh(soon)
+    gcal._ensure_fresh(later)
+    assert soon.refreshed == 1 and later.refreshed == 0
+
+
+def test_freebusy_cache_single_flight_and_stale_while_revalidate():
+    import threading
+    import time
+    from app.integrations.freebusy_cache import FreebusyCache
+
+    cache = FreebusyCache(ttl_s=0.05, swr_s=10)
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(1)
+        return {"cal": [len(calls)]}
+
+    key = cache.make_key(["cal"], "a", "b", "tz")
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        futures = [pool.submit(cache.get_or_fetch, key, fetch) for _ in range(10)]
+        time.sleep(0.05)
+        release.set()
+        results = [f.result() for f in futures]
+    assert len(calls) == 1 and all(r == {"cal": [1]} for r in results)
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced_waiters"] == 9
+
+    time.sleep(0.06)
+    # Caducado pero dentro de la ventana SWR: valor anterior y refresco en segundo plano.
+    assert cache.get_or_fetch(key, fetch) == {"cal": [1]}
+    for _ in range(100):
+        if cache.stats()["inflight"] == 0:
+            break
+        time.sleep(0.01)
+    assert cache.get_or_fetch(key, fetch) == {"cal": [2]}
+    assert cache.stats()["stale_hits"] == 1
+
+
+def test_freebusy_cache_invalidated_by_event_writes():
+    from app.integrations.freebusy_cache import freebusy_cache
+
+    svc = gcal.build_calendar()
+    gcal.freebusy_multi_cached(svc, ["cal-a"], "2030-01-07T00:00:00", "2030-01-08T00:00:00")
+    gcal.freebusy_multi_cached(svc, ["cal-a"], "2030-01-07T00:00:00", "2030-01-08T00:00:00")
+    assert freebusy_cache.stats()["hits"] == 1
+    gcal.create_event(svc, "cal-a", datetime(2030, 1, 7, 10), datetime(2030, 1, 7, 10, 30), summary="x")
+    gcal.freebusy_multi_cached(svc, ["cal-a"], "2030-01-07T00:00:00", "2030-01-08T00:00:00")
+    assert freebusy_cache.stats()["misses"] == 2
+
+
+def test_incremental_sync_uses_token_handles_cancellations_and_410(db_engine, monkeypatch):
+    from googleapiclient.errors import HttpError
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.data import PRO_CALENDAR
+    from app.models import GCalSyncState, ReservationDB
+
+    cal = PRO_CALENDAR["ana"]
+
+    def _ev(eid, hour, **extra):
+        day = "2030-01-07"
+        return {"id": eid, "start": {"dateTime": f"{day}T{hour:02d}:00:00+01:00"}, "end": {"dateTime": f"{day}T{hour:02d}:30:00+01:00"}, "summary": "Corte", **extra}
+
+    pages = {
+        None: [{"items": [_ev("e1", 10)], "nextPageToken": "p2"}, {"items": [_ev("e2", 11)], "nextSyncToken": "tok1"}],
+        "tok1": [{"items": [{"id": "e1", "status": "cancelled"}, _ev("e3", 12)], "nextSyncToken": "tok2"}],
+    }
+    calls = []
+
+    class _Resp:
+        status = 410
+        reason = "Gone"
+
+    class _Req:
+        def __init__(self, kw):
+            self.kw = kw
+
+        def execute(self):
+            token = self.kw.get("syncToken")
+            calls.append((self.kw["calendarId"], token, self.kw.get("pageToken")))
+            if token == "expired":
+                raise HttpError(_Resp(), b"fullSyncRequired")
+            if self.kw["calendarId"] != cal:
+                return {"items": [], "nextSyncToken": "other"}
+            seq = pages[token]
+            return seq[1] if self.kw.get("pageToken") else seq[0]
+
+    class _Svc:
+        def events(self):
+            return self
+
+        def list(self, **kw):
+            return _Req(dict(kw))
+
+    monkeypatch.setattr(logic, "build_calendar", lambda: _Svc())
+    with Session(db_engine) as s:
+        first = logic.sync_from_gcal_incremental(s, professional_id="ana")
+        assert first["inserted"] == 2 and first["full_syncs"] == 1
+        assert s.get(GCalSyncState, cal).sync_token == "tok1"
+
+        second = logic.sync_from_gcal_incremental(s, professional_id="ana")
+        assert (second["inserted"], second["deleted"], second["full_syncs"]) == (1, 1, 0)
+        assert s.get(ReservationDB, "gcal:e1") is None and s.get(ReservationDB, "gcal:e3") is not None
+
+        state = s.get(GCalSyncState, cal)
+        state.sync_token = "expired"
+        s.add(state); s.commit()
+        third = logic.sync_from_gcal_incremental(s, professional_id="ana")
+        assert third["full_syncs"] == 1 and third["ok"]
+        assert s.get(GCalSyncState, cal).sync_token == "tok1"
+
+
+def test_admin_incremental_sync_honours_calendar_id(app_client, db_engine, api_headers):
+    from sqlmodel import Session, select
+    from app.data import PRO_CALENDAR
+    from app.models import GCalSyncState
+
+    cal = PRO_CALENDAR["ana"]
+    r = app_client.post("/admin/sync", headers=api_headers, json={"mode": "incremental", "calendar_id": cal})
+    assert r.status_code == 200 and r.json()["results"]["import"]["calendars"] == 1
+    with Session(db_engine) as s:
+        assert [st.calendar_id for st in s.exec(select(GCalSyncState)).all()] == [cal]
+
+
+def test_range_operations_fetch_each_calendar_once_with_pagination(db_engine, query_counter, monkeypatch):
+    from datetime import date
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.models import ReservationDB
+
+    calls = []
+
+    def _ev(eid, day):
+        return {"id": eid, "start": {"dateTime": f"2030-01-{day:02d}T10:00:00+01:00"}, "end": {"dateTime": f"2030-01-{day:02d}T10:30:00+01:00"}, "summary": "Barba"}
+
+    class _Req:
+        def __init__(self, kw):
+            self.kw = kw
+
+        def execute(self):
+            calls.append(self.kw)
+            if self.kw.get("pageToken"):
+                return {"items": [_ev(f"{self.kw['calendarId'][:4]}-b", 11)]}
+            return {"items": [_ev(f"{self.kw['calendarId'][:4]}-a", 7)], "nextPageToken": "p2"}
+
+    class _Svc:
+        def events(self):
+            return self
+
+        def list(self, **kw):
+            return _Req(dict(kw))
+
+    monkeypatch.setattr(logic, "build_calendar", lambda: _Svc())
+    with Session(db_engine) as s:
+        out = logic.sync_from_gcal_range(s, date(2030, 1, 7), date(2030, 1, 13))
+        assert out["inserted"] == 4
+        assert len(calls) == 4 and all("fields" in c and "nextPageToken" in c["fields"] for c in calls)
+
+        calls.clear(); query_counter.clear()
+        report = logic.detect_conflicts_range(s, date(2030, 1, 7), date(2030, 1, 13))
+        assert len(calls) == 4
+        assert len(query_counter) == 1
+        assert report["missing_in_gcal"] == 0 and report["overlaps_external"] == 0
+        assert len(s.exec(logic.select(ReservationDB)).all()) == 4
+
+
+def test_event_batch_chunks_and_reports_per_item_results():
+    svc = gcal.build_calendar()
+    batches = []
+    original = svc.new_batch_http_request
+
+    def _counting(callback=None):
+        b = original(callback)
+        batches.append(b)
+        return b
+
+    svc.new_batch_http_request = _counting
+    batch = gcal.EventBatch(svc)
+    start = datetime(2030, 1, 7, 10, 0)
+    for i in range(gcal.GCAL_BATCH_MAX + 5):
+        batch.insert(i, "cal", start, start + timedelta(minutes=30), summary=f"r{i}")
+
+    class _Boom:
+        def execute(self):
+            raise RuntimeError("boom")
+
+    batch._ops.append(("bad", "cal", lambda: _Boom()))
+    results = batch.execute()
+    assert len(batches) == 2
+    assert all(results[i].ok and results[i].response["id"] for i in range(gcal.GCAL_BATCH_MAX + 5))
+    assert not results["bad"].ok and "boom" in results["bad"].error
+
+
+def test_reconcile_pushes_reservations_in_batch(db_engine):
+    from datetime import date
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.models import ReservationDB
+
+    with Session(db_engine) as s:
+        for i in range(3):
+            start = datetime(2030, 1, 7 + i, 10, 0)
+            s.add(ReservationDB(id=f"r{i}", service_id="corte", professional_id="ana", start=start, end=start + timedelta(minutes=30)))
+        s.commit()
+        out = logic.reconcile_db_to_gcal_range(s, date(2030, 1, 7), date(2030, 1, 13))
+        assert out["ok"] and out["created"] == 3 and out["failed"] == 0
+        assert all(s.get(ReservationDB, f"r{i}").google_event_id for i in range(3))
+
+
+def test_range_sync_fetches_calendars_concurrently(db_engine, monkeypatch):
+    import threading
+    import time
+    from datetime import date
+    from sqlmodel import Session
+    import app.data as data
+    import app.services.logic as logic
+
+    for pid in ("p3", "p4"):
+        monkeypatch.setitem(data.PRO_CALENDAR, pid, f"{pid}@calendar")
+    monkeypatch.setattr(logic, "GCAL_MAX_WORKERS", 4)
+    threads = set()
+
+    class _Req:
+        def execute(self):
+            threads.add(threading.get_ident())
+            time.sleep(0.2)
+            return {"items": []}
+
+    class _Svc:
+        def events(self):
+            return self
+
+        def list(self, **kw):
+            return _Req()
+
+    monkeypatch.setattr(logic, "build_calendar", lambda: _Svc())
+    with Session(db_engine) as s:
+        t0 = time.perf_counter()
+        out = logic.sync_from_gcal_range(s, date(2030, 1, 7), date(2030, 1, 13))
+        elapsed = time.perf_counter() - t0
+    assert out["calendars"] == 4 and len(threads) == 4
+    assert elapsed < 0.6
+
+
+def test_async_fake_client_matches_sync_interface():
+    import asyncio
+    import app.integrations.google_calendar_async as agcal
+    from app.integrations.freebusy_cache import freebusy_cache
+
+    async def _run():
+        svc = agcal.build_calendar_async()
+        start = datetime(2030, 1, 7, 10, 0)
+        ev = await agcal.create_event(svc, "cal", start, start + timedelta(minutes=30), summary="Reserva", private_props={"reservation_id": "r1"})
+        await agcal.patch_event(svc, "cal", ev["id"], start, start + timedelta(hours=1), etag=ev["etag"])
+        try:
+            await agcal.patch_event(svc, "cal", ev["id"], start, start + timedelta(hours=2), etag=ev["etag"])
+        except RuntimeError as e:
+            stale = e
+        busy = await asyncio.gather(*(agcal.freebusy_multi_cached(svc, ["cal"], start, start + timedelta(days=1)) for _ in range(200)))
+        await agcal.delete_event(svc, "cal", ev["id"])
+        return ev, stale, busy
+
+    ev, stale, busy = asyncio.run(_run())
+    # El segundo parche lleva el etag ya superado: Google (y el simulador) responden 412.
+    assert gcal._http_status(stale.__cause__) == 412
+    # El simulador guarda el evento: freebusy refleja el horario ya modificado (Madrid, UTC+1).
+    assert ev["id"] and len(busy) == 200 and busy[0] == {"cal": [{"start": "2030-01-07T09:00:00Z", "end": "2030-01-07T10:00:00Z"}]}
+    assert gcal.build_calendar().calls["freebusy.query"] == 1 and freebusy_cache.stats()["coalesced_waiters"] + freebusy_cache.stats()["hits"] == 199
+    assert ev["id"] not in gcal.build_calendar()._events_store
+
+
+def test_async_client_closes_session_of_previous_event_loop():
+    import asyncio
+    import app.integrations.google_calendar_async as agcal
+
+    class _Session:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    old = _Session()
+    loop = asyncio.new_event_loop()
+    loop.close()
+    asyncio.run(agcal._close_stale_session(old, loop))
+    assert old.closed
+
+
+def test_async_client_paginates_and_surfaces_http_status():
+    import asyncio
+    import app.integrations.google_calendar_async as agcal
+
+    calls = []
+
+    class _Resp:
+        def __init__(self, status, payload):
+            self.status, self._payload = status, payload
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def json(self, content_type=None):
+            return self._payload
+
+        async def text(self):
+            return "gone"
+
+    class _Session:
+        closed = False
+
+        def request(self, method, url, params=None, json=None, headers=None):
+            calls.append((method, url, dict(params or {}), headers["Authorization"]))
+            if method == "DELETE":
+                return _Resp(410, None)
+            if params.get("pageToken"):
+                return _Resp(200, {"items": [{"id": "b"}]})
+            return _Resp(200, {"items": [{"id": "a"}], "nextPageToken": "p2"})
+
+    class _Creds:
+        token = "tok"
+        expiry = datetime.utcnow() + timedelta(hours=1)
+
+    client = agcal.AsyncCalendarClient(_Creds(), session=_Session())
+
+    async def _run():
+        items = await agcal.list_events_range(client, "a@b", datetime(2030, 1, 7), datetime(2030, 1, 8))
+        try:
+            await agcal.delete_event(client, "a@b", "ev1")
+        except RuntimeError as e:
+            return items, e
+        return items, None
+
+    items, err = asyncio.run(_run())
+    assert [it["id"] for it in items] == ["a", "b"]
+    assert calls[0][1].endswith("/calendars/a%40b/events") and calls[0][2]["singleEvents"] == "true"
+    assert calls[0][3] == "Bearer tok" and calls[1][2]["pageToken"] == "p2"
+    assert err is not None and gcal._http_status(err.__cause__) == 410
+
+
+def _http_error(status, reason=""):
+    from googleapiclient.errors import HttpError
+
+    class _Resp:
+        def __init__(self):
+            self.status = status
+            self.reason = reason
+
+    return HttpError(_Resp(), f'{{"error": {{"errors": [{{"reason": "{reason}"}}]}}}}'.encode())
+
+
+def test_throttle_paces_calls_and_retries_rate_limits():
+    from app.integrations.rate_limit import GoogleThrottle
+
+    slept = []
+    throttle = GoogleThrottle(rate=10, burst=2, max_retries=3, backoff_base_s=1, sleep=slept.append)
+    for _ in range(4):
+        throttle.acquire()
+    assert len(slept) == 2 and abs(sum(slept) - 0.3) < 0.05
+
+    slept.clear()
+    attempts = iter([_http_error(403, "rateLimitExceeded"), _http_error(503), None])
+
+    def _flaky():
+        exc = next(attempts)
+        if exc:
+            raise exc
+        return "ok"
+
+    throttle.reset(rate=0)
+    assert throttle.call(_flaky) == "ok"
+    assert throttle.stats()["retries"] == 2 and throttle.stats()["rate_limited"] == 1
+    assert slept[0] <= 1 and slept[1] <= 2
+
+    import pytest
+    with pytest.raises(Exception):
+        throttle.call(lambda: (_ for _ in ()).throw(_http_error(404)))
+    with pytest.raises(Exception):
+        throttle.call(lambda: (_ for _ in ()).throw(_http_error(429)))
+    assert throttle.stats()["gave_up"] == 1
+
+
+def test_event_batch_resends_rate_limited_items(monkeypatch):
+    from app.integrations.rate_limit import gcal_throttle
+
+    monkeypatch.setattr(gcal_throttle, "_sleep", lambda s: None)
+    svc = gcal.build_calendar()
+    failures = {"r1": 2}
+
+    class _Op:
+        def __init__(self, key):
+            self.key = key
+
+        def execute(self):
+            if failures.get(self.key, 0) > 0:
+                failures[self.key] -= 1
+                raise _http_error(403, "userRateLimitExceeded")
+            return {"id": f"ev-{self.key}"}
+
+    batch = gcal.EventBatch(svc)
+    for key in ("r0", "r1"):
+        batch._ops.append((key, "cal", lambda key=key: _Op(key)))
+    results = batch.execute()
+    assert results["r0"].ok and results["r1"].ok and results["r1"].response["id"] == "ev-r1"
+    assert gcal_throttle.stats()["retries"] == 2
+
+
+def test_event_batch_retries_only_failed_items_never_the_whole_batch(monkeypatch):
+    from app.integrations.rate_limit import gcal_throttle
+
+    monkeypatch.setattr(gcal_throttle, "_sleep", lambda s: None)
+    svc = gcal.build_calendar()
+    start = datetime(2030, 1, 7, 10, 0)
+    # La primera inserción del lote recibe un 503; la segunda entra a la primera.
+    svc.inject("events.insert", status=503, times=1)
+    batch = gcal.EventBatch(svc)
+    for key in ("a", "b"):
+        batch.insert(key, "cal", start, start + timedelta(minutes=30), summary=key)
+    results = batch.execute()
+    assert results["a"].ok and results["b"].ok
+    assert svc.calls["batch"] == 2 and svc.calls["events.insert"] == 3
+    assert sorted(ev["summary"] for ev in svc._events_store.values()) == ["a", "b"]
+
+    # Si la petición multipart falla tras procesar sus llamadas, no se reenvía entera.
+    original = svc.new_batch_http_request
+
+    def _flaky(callback=None):
+        b = original(callback)
+        run = b.execute
+
+        def _execute():
+            run()
+            raise _http_error(503)
+        b.execute = _execute
+        return b
+
+    monkeypatch.setattr(svc, "new_batch_http_request", _flaky)
+    batch.insert("c", "cal", start, start + timedelta(minutes=30), summary="c")
+    assert batch.execute()["c"].ok
+    assert sorted(ev["summary"] for ev in svc._events_store.values()) == ["a", "b", "c"]
+
+
+def test_reconcile_skips_calendar_when_listing_fails(db_engine, monkeypatch):
+    from datetime import date
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.models import ReservationDB
+
+    monkeypatch.setattr(logic, "list_events_range", lambda *a, **k: (_ for _ in ()).throw(RuntimeError("Error listando eventos: 429")))
+    with Session(db_engine) as s:
+        start = datetime(2030, 1, 7, 10, 0)
+        s.add(ReservationDB(id="r0", service_id="corte", professional_id="ana", start=start, end=start + timedelta(minutes=30)))
+        s.commit()
+        out = logic.reconcile_db_to_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7))
+        # Sólo se lista el calendario de ana, el único con reservas por enviar.
+        assert not out["ok"] and out["created"] == 0 and out["failed"] == 1
+        assert s.get(ReservationDB, "r0").google_event_id is None
+        assert not logic.sync_from_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7))["ok"]
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    import asyncio
+    import pytest
+    from app.integrations.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, cooldown_s=10, clock=lambda: now[0])
+    calls = []
+
+    def _fail(exc):
+        def fn():
+            calls.append(exc)
+            raise exc
+        return fn
+
+    # Un 404 es un error de la petición: no acerca el circuito a abrirse.
+    for exc in (_http_error(404), _http_error(503), _http_error(404), _http_error(503)):
+        with pytest.raises(Exception):
+            breaker.call(_fail(exc))
+    assert breaker.state == "closed"
+    with pytest.raises(Exception):
+        breaker.call(_fail(_http_error(503)))
+    assert breaker.state == "open" and len(calls) == 5
+    with pytest.raises(CircuitOpenError):
+        breaker.call(_fail(_http_error(503)))
+    assert len(calls) == 5 and breaker.stats()["rejected"] == 1
+
+    now[0] = 10
+    assert breaker.state == "half_open"
+    with pytest.raises(Exception):
+        breaker.call(_fail(_http_error(500)))
+    assert breaker.state == "open"
+    now[0] = 20
+    assert breaker.call(lambda: "ok") == "ok" and breaker.state == "closed"
+
+    # Errores locales y cancelaciones no son fallos de Google.
+    for exc in (KeyError("x"), TypeError("x"), asyncio.CancelledError(), KeyError("y")):
+        with pytest.raises(BaseException):
+            breaker.call(_fail(exc))
+    assert breaker.state == "closed" and breaker.stats()["consecutive_failures"] == 0
+    # Una prueba cancelada en semiabierto libera el paso para la siguiente.
+    for _ in range(2):
+        with pytest.raises(Exception):
+            breaker.call(_fail(ConnectionResetError("reset")))
+    now[0] = 30
+    with pytest.raises(asyncio.CancelledError):
+        breaker.call(_fail(asyncio.CancelledError()))
+    assert breaker.call(lambda: "ok") == "ok" and breaker.state == "closed"
+
+
+def test_open_circuit_skips_google_for_slots_and_outbox(app_client, monkeypatch):
+    from datetime import date
+    from app.api import routes
+    from app.integrations.circuit_breaker import gcal_breaker
+    from app.services.availability_cache import availability_cache
+
+    monkeypatch.setattr(gcal_breaker, "failure_threshold", 2)
+    fake = gcal.build_calendar()
+    fake.inject("freebusy.query", error=ConnectionResetError("connection reset"), times=None)
+
+    target = date.today() + timedelta(days=33)
+    while target.weekday() == 6:
+        target += timedelta(days=1)
+    q = {"service_id": "corte", "date_str": target.isoformat(), "professional_id": "ana"}
+    for _ in range(3):
+        availability_cache.clear()
+        assert app_client.post("/slots", json=q).json()["slots"]
+    # Tras dos fallos el circuito se abre y la tercera consulta ni siquiera llama a Google.
+    assert fake.calls["freebusy.query"] == 2
+    assert app_client.get("/ready").json()["gcal_circuit"] == "open"
+    assert app_client.get("/metrics", headers={"X-API-Key": routes.API_KEY}).json()["gcal_circuit"]["opened"] == 1
+    assert app_client.post("/admin/outbox/drain", headers={"X-API-Key": routes.API_KEY}).json()["circuit"] == "open"
+
+
+def test_fake_calendar_is_stateful_paginates_and_injects_faults():
+    import pytest
+    from app.integrations.fake_calendar import FakeCalendarConfig, FakeCalendarService
+    from app.integrations.rate_limit import is_rate_limited
+
+    slept = []
+    svc = FakeCalendarService(FakeCalendarConfig(latency_ms=20, jitter_ms=10, page_size=2, seed=1), sleep=slept.append)
+    start = datetime(2030, 1, 7, 10, 0)
+    ids = [gcal.create_event(svc, "cal", start + timedelta(hours=i), start + timedelta(hours=i, minutes=30), summary=f"e{i}")["id"] for i in range(5)]
+    assert all(0.02 <= s <= 0.03 for s in slept) and len(slept) == 5
+
+    items = gcal.list_events_range(svc, "cal", start, start + timedelta(days=1))
+    assert [it["id"] for it in items] == ids and svc.calls["events.list"] == 3
+    busy = gcal.freebusy(svc, "cal", start, start + timedelta(hours=2))
+    assert busy == [{"start": "2030-01-07T09:00:00Z", "end": "2030-01-07T09:30:00Z"}, {"start": "2030-01-07T10:00:00Z", "end": "2030-01-07T10:30:00Z"}]
+
+    # El syncToken devuelve sólo los cambios, incluidas las cancelaciones.
+    _, token = gcal.list_events_sync(svc, "cal", time_min=start)
+    gcal.patch_event(svc, "cal", ids[0], start, start + timedelta(hours=1))
+    gcal.delete_event(svc, "cal", ids[1])
+    changed, token = gcal.list_events_sync(svc, "cal", sync_token=token)
+    assert [(it["id"], it["status"]) for it in changed] == [(ids[0], "confirmed"), (ids[1], "cancelled")]
+    svc.expire_sync_tokens()
+    with pytest.raises(gcal.SyncTokenExpired):
+        gcal.list_events_sync(svc, "cal", sync_token=token)
+
+    svc.inject("events.insert", status=403, reason="rateLimitExceeded")
+    with pytest.raises(Exception) as err:
+        svc.events().insert(calendarId="cal", body={}).execute()
+    assert is_rate_limited(err.value) and svc.stats()["errors"] == {"events.insert": 1}
+    with pytest.raises(Exception) as err:
+        svc.events().patch(calendarId="cal", eventId="nope", body={}).execute()
+    assert gcal._http_status(err.value) == 404
+
+
+def test_range_import_upserts_in_bulk_and_skips_unchanged_rows(db_engine, query_counter):
+    from datetime import date
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.data import PRO_CALENDAR
+    from app.models import ReservationDB
+
+    svc = gcal.build_calendar()
+    cal = PRO_CALENDAR["ana"]
+    start = datetime(2030, 1, 7, 9, 0)
+    ids = [gcal.create_event(svc, cal, start + timedelta(minutes=10 * i), start + timedelta(minutes=10 * i + 10), summary="Barba")["id"] for i in range(60)]
+    with Session(db_engine) as s:
+        query_counter.clear()
+        out = logic.sync_from_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7), professional_id="ana")
+        assert (out["inserted"], out["updated"]) == (60, 0)
+        # Una sola consulta IN para todo el calendario, no una por evento.
+        assert len([q for q in query_counter if "reservationdb" in q.lower()]) == 1
+
+        # Sin cambios en Google no se reescribe nada (las fechas se comparan normalizadas).
+        assert logic.sync_from_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7), professional_id="ana")["updated"] == 0
+        gcal.patch_event(svc, cal, ids[0], start + timedelta(hours=3), start + timedelta(hours=4))
+        out = logic.sync_from_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7), professional_id="ana")
+        assert (out["inserted"], out["updated"]) == (0, 1)
+        row = s.get(ReservationDB, f"gcal:{ids[0]}")
+        assert logic.to_naive_local(row.start) == datetime(2030, 1, 7, 12, 0) and row.service_id == "barba"
+
+
+def test_conflicts_sweep_counts_everything_and_pages_samples(db_engine, query_counter):
+    from datetime import date
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.data import PRO_CALENDAR
+    from app.models import ReservationDB
+
+    svc = gcal.build_calendar()
+    cal = PRO_CALENDAR["ana"]
+    day = datetime(2030, 1, 7, 9, 0)
+    with Session(db_engine) as s:
+        for i in range(12):
+            start = day + timedelta(hours=i % 10, days=i // 10)
+            ev = gcal.create_event(svc, cal, start, start + timedelta(minutes=30), summary="Reserva", private_props={"reservation_id": f"r{i}"})
+            s.add(ReservationDB(id=f"r{i}", service_id="corte", professional_id="ana", start=start, end=start + timedelta(minutes=30), google_event_id=ev["id"], google_calendar_id=cal))
+        s.commit()
+        # Externos: 12 que pisan una reserva (incluido uno que sólo la roza por dentro) y uno contiguo que no.
+        for i in range(12):
+            start = day + timedelta(hours=i % 10, days=i // 10, minutes=20)
+            gcal.create_event(svc, cal, start, start + timedelta(minutes=20), summary="Médico")
+        gcal.create_event(svc, cal, day + timedelta(hours=12, minutes=30), day + timedelta(hours=13), summary="Contiguo")
+        gcal.create_event(svc, cal, day + timedelta(hours=14), day + timedelta(hours=15), summary="Reserva", private_props={"reservation_id": "gone"})
+
+        query_counter.clear()
+        out = logic.detect_conflicts_range(s, date(2030, 1, 7), date(2030, 1, 8), professional_id="ana", sample_limit=5, sample_offset=10)
+        assert len(query_counter) == 2
+        assert (out["overlaps_external"], out["orphaned_in_gcal"], out["missing_in_gcal"], out["time_mismatch"]) == (12, 1, 0, 0)
+        assert [x["rid"] for x in out["samples"]["overlaps_external"]] == ["r10", "r11"]
+        assert out["samples"]["orphaned_in_gcal"] == [] and out["sample_limit"] == 5
+
+
+def test_conflict_reports_recompute_only_changed_days(app_client, db_engine):
+    from datetime import date
+    from sqlmodel import Session
+    import app.api.routes as routes
+    from app.data import PRO_CALENDAR
+    from app.models import ReservationDB
+    from app.services.conflict_reports import refresh_conflict_reports
+
+    svc = gcal.build_calendar()
+    cal = PRO_CALENDAR["ana"]
+    start = datetime(2030, 1, 7, 9, 0)
+    with Session(db_engine) as s:
+        ev = gcal.create_event(svc, cal, start, start + timedelta(minutes=30), summary="Reserva", private_props={"reservation_id": "r1"})
+        s.add(ReservationDB(id="r1", service_id="corte", professional_id="ana", start=start, end=start + timedelta(minutes=30), google_event_id=ev["id"], google_calendar_id=cal))
+        s.commit()
+        ext = gcal.create_event(svc, cal, start + timedelta(days=1), start + timedelta(days=1, hours=1), summary="Médico")
+
+        first = refresh_conflict_reports(s, date(2030, 1, 7), date(2030, 1, 9), professional_id="ana")
+        assert (first["recomputed"], first["unchanged"]) == (3, 0)
+        assert refresh_conflict_reports(s, date(2030, 1, 7), date(2030, 1, 9), professional_id="ana")["recomputed"] == 0
+
+        # Sólo cambia el día 8: el evento externo pasa a pisar una reserva nueva.
+        s.add(ReservationDB(id="r2", service_id="corte", professional_id="ana", start=start + timedelta(days=1), end=start + timedelta(days=1, minutes=30)))
+        s.commit()
+        again = refresh_conflict_reports(s, date(2030, 1, 7), date(2030, 1, 9), professional_id="ana")
+        assert (again["recomputed"], again["unchanged"]) == (1, 2)
+
+    r = app_client.post("/admin/conflicts", headers={"X-API-Key": routes.API_KEY}, json={"start": "2030-01-07", "end": "2030-01-09", "professional_id": "ana"}).json()
+    assert r["source"] == "stored" and r["days_reported"] == 3 and r["complete"]
+    assert (r["overlaps_external"], r["missing_in_gcal"]) == (1, 1)
+    assert r["samples"]["overlaps_external"] == [{"event_id": ext["id"], "rid": "r2"}]
+    assert r["computed_at"] <= r["latest_computed_at"]
+
+
+def test_conflict_reports_read_only_calendar_changes_and_span_midnight(db_engine):
+    from datetime import date
+    from sqlmodel import Session
+    from app.data import PRO_CALENDAR
+    from app.models import ConflictReport, ReservationDB
+    from app.services.conflict_reports import refresh_conflict_reports
+
+    svc = gcal.build_calendar()
+    cal = PRO_CALENDAR["ana"]
+    night = datetime(2030, 1, 7, 23, 0)
+    with Session(db_engine) as s:
+        # Evento externo de 23:00 a 01:00 y una reserva a las 00:30 del día siguiente.
+        ext = gcal.create_event(svc, cal, night, night + timedelta(hours=2), summary="Guardia")
+        gcal.create_event(svc, cal, night, night + timedelta(hours=2), summary="Reserva", private_props={"reservation_id": "gone"})
+        s.add(ReservationDB(id="r1", service_id="corte", professional_id="ana", start=night + timedelta(minutes=90), end=night + timedelta(minutes=120)))
+        s.commit()
+        first = refresh_conflict_reports(s, date(2030, 1, 7), date(2030, 1, 9), professional_id="ana")
+        assert first["full_loads"] == 1
+        day2 = s.get(ConflictReport, ("ana", date(2030, 1, 8)))
+        assert day2.samples["overlaps_external"] == [{"event_id": ext["id"], "rid": "r1"}]
+        # El huérfano se cuenta una vez, en el día en que empieza.
+        assert (s.get(ConflictReport, ("ana", date(2030, 1, 7))).orphaned_in_gcal, day2.orphaned_in_gcal) == (1, 0)
+
+        # Las pasadas siguientes sólo piden los cambios: mover el evento deja libre el día 8.
+        gcal.patch_event(svc, cal, ext["id"], night - timedelta(hours=3), night - timedelta(hours=2))
+        again = refresh_conflict_reports(s, date(2030, 1, 7), date(2030, 1, 9), professional_id="ana")
+        assert again["full_loads"] == 0 and again["recomputed"] == 2
+        assert s.get(ConflictReport, ("ana", date(2030, 1, 8))).overlaps_external == 0
+
+
+def test_reconcile_skips_unchanged_rows_and_patches_with_if_match(db_engine, monkeypatch):
+    from datetime import date
+    from sqlmodel import Session
+    import app.services.logic as logic
+    from app.data import PRO_CALENDAR
+    from app.models import ReservationDB
+
+    svc = gcal.build_calendar()
+    cal = PRO_CALENDAR["ana"]
+    start = datetime(2030, 1, 7, 10, 0)
+    with Session(db_engine) as s:
+        for i in range(3):
+            s.add(ReservationDB(id=f"r{i}", service_id="corte", professional_id="ana", start=start + timedelta(hours=i), end=start + timedelta(hours=i, minutes=30)))
+        s.commit()
+        assert logic.reconcile_db_to_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7))["created"] == 3
+        assert s.get(ReservationDB, "r0").google_etag
+
+        # Sin cambios locales no hay ni una llamada a Google.
+        svc.calls.clear()
+        out = logic.reconcile_db_to_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7))
+        assert (out["skipped"], out["listed"], sum(svc.calls.values())) == (3, 0, 0)
+
+        # Se mueve r1 y alguien edita su evento en Google entre el listado y el parche: 412, sin pisarlo.
+        r1 = s.get(ReservationDB, "r1")
+        r1.start, r1.end = start + timedelta(hours=5), start + timedelta(hours=5, minutes=30)
+        s.add(r1); s.commit()
+        listed = gcal.list_events_range
+        def _list_then_edit(*a, **k):
+            items = listed(*a, **k)
+            gcal.patch_event(svc, cal, r1.google_event_id, start + timedelta(hours=7), start + timedelta(hours=8))
+            return items
+        monkeypatch.setattr(logic, "list_events_range", _list_then_edit)
+        out = logic.reconcile_db_to_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7))
+        monkeypatch.setattr(logic, "list_events_range", listed)
+        assert (out["patched"], out["conflicts"], out["skipped"]) == (0, 1, 2)
+        assert svc._events_store[r1.google_event_id]["start"]["dateTime"].startswith("2030-01-07T17:00")
+
+        # La reserva sigue pendiente: la siguiente pasada la parchea con el etag nuevo.
+        out = logic.reconcile_db_to_gcal_range(s, date(2030, 1, 7), date(2030, 1, 7))
+        assert (out["patched"], out["conflicts"]) == (1, 0)
+        assert svc._events_store[r1.google_event_id]["start"]["dateTime"].startswith("2030-01-07T15:00")
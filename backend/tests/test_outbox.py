@@ -0,0 +1,138 @@
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from sqlmodel import Session, select
+
+import app.integrations.google_calendar as gcal
+import app.services.outbox as outbox
+from app.data import PRO_CALENDAR
+from app.models import GCalOutbox, ReservationDB
+
+API_KEY = "test-api-key"
+os.environ["API_KEY"] = API_KEY
+HEADERS = {"X-API-Key": API_KEY}
+
+
+def _book(client, pro="luis"):
+    target = date.today() + timedelta(days=32)
+    while target.weekday() == 6:
+        target += timedelta(days=1)
+    slots = client.post("/slots", json={"service_id": "corte", "date_str": target.isoformat(), "professional_id": pro}).json()["slots"]
+    r = client.post("/reservations", headers=HEADERS, json={"service_id": "corte", "professional_id": pro, "start": slots[0]})
+    assert r.status_code == 200
+    return r.json()["message"].split("ID: ")[1].split(",")[0], slots
+
+
+def _events():
+    return gcal.build_calendar()._events_store
+
+
+def test_booking_reschedule_and_cancel_go_through_outbox(app_client, db_engine):
+    res_id, slots = _book(app_client)
+    # La reserva responde sin tocar Google: queda una fila pendiente y ningún evento.
+    assert _events() == {}
+    with Session(db_engine) as s:
+        rows = s.exec(select(GCalOutbox)).all()
+        assert [(r.op, r.reservation_id) for r in rows] == [("upsert", res_id)]
+
+    r = app_client.post("/admin/outbox/drain", headers=HEADERS)
+    assert (r.json()["done"], r.json()["outbox"]["pending"]) == (1, 0)
+    with Session(db_engine) as s:
+        row = s.get(ReservationDB, res_id)
+        event_id, cal_id = row.google_event_id, row.google_calendar_id
+    assert cal_id == PRO_CALENDAR["luis"] and _events()[event_id]["calendarId"] == cal_id
+
+    # Cambiar de profesional mueve el evento a su calendario.
+    r = app_client.post("/reschedule", headers=HEADERS, json={"reservation_id": res_id, "new_start": slots[0], "professional_id": "ana"})
+    assert r.status_code == 200
+    app_client.post("/admin/outbox/drain", headers=HEADERS)
+    with Session(db_engine) as s:
+        row = s.get(ReservationDB, res_id)
+        assert row.google_calendar_id == PRO_CALENDAR["ana"]
+    assert [ev["calendarId"] for ev in _events().values()] == [PRO_CALENDAR["ana"]]
+
+    assert app_client.delete(f"/reservations/{res_id}", headers=HEADERS).status_code == 200
+    app_client.post("/admin/outbox/drain", headers=HEADERS)
+    assert _events() == {}
+    assert app_client.get("/admin/outbox", headers=HEADERS).json()["pending"] == 0
+
+
+def test_failed_rows_back_off_then_die_and_can_be_retried(app_client, db_engine, monkeypatch):
+    res_id, _ = _book(app_client)
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 2)
+    gcal.build_calendar().inject("events.insert", error=RuntimeError("google caído"), times=None)
+
+    r = app_client.post("/admin/outbox/drain", headers=HEADERS).json()
+    assert (r["failed"], r["dead"]) == (1, 0)
+    with Session(db_engine) as s:
+        row = s.exec(select(GCalOutbox)).one()
+        assert row.attempts == 1 and "google caído" in row.last_error
+        assert row.next_attempt_at.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc)
+        # Aún en backoff: un drenado inmediato no la vuelve a intentar.
+        assert outbox.drain_outbox(s)["processed"] == 0
+        row.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        s.add(row); s.commit()
+        assert outbox.drain_outbox(s)["dead"] == 1
+
+    gcal.build_calendar().clear_faults()
+    r = app_client.post("/admin/outbox/drain", headers=HEADERS, json={"retry_dead": True}).json()
+    assert (r["requeued"], r["done"]) == (1, 1)
+    with Session(db_engine) as s:
+        assert s.get(ReservationDB, res_id).google_event_id in _events()
+    # El segundo intento busca antes por reservation_id: no duplica eventos.
+    assert len(_events()) == 1
+
+
+def test_concurrent_drains_claim_each_row_once_and_inserts_are_idempotent(app_client, db_engine, monkeypatch):
+    res_id, _ = _book(app_client)
+    inner: list[dict] = []
+    real_execute = gcal.EventBatch.execute
+
+    def _execute_while_another_drain_runs(self, *a, **kw):
+        # Un segundo drenado (otro worker o /admin/outbox/drain) entra con el lote en vuelo.
+        if not inner:
+            with Session(db_engine) as s2:
+                inner.append(outbox.drain_outbox(s2))
+        return real_execute(self, *a, **kw)
+
+    monkeypatch.setattr(gcal.EventBatch, "execute", _execute_while_another_drain_runs)
+    with Session(db_engine) as s:
+        assert outbox.drain_outbox(s)["done"] == 1
+    assert inner == [{"processed": 0, "done": 0, "failed": 0, "dead": 0}]
+    assert list(_events()) == [gcal.reservation_event_id(res_id)]
+
+    # Si el evento ya existe (p. ej. lo insertó otro proceso sin llegar a anotarlo), la
+    # inserción recibe 409 y el siguiente intento lo parchea en vez de duplicarlo.
+    with Session(db_engine) as s:
+        r = s.get(ReservationDB, res_id)
+        r.google_event_id = r.google_calendar_id = None
+        s.add(r)
+        outbox.enqueue_gcal_upsert(s, res_id)
+        s.commit()
+        assert outbox.drain_outbox(s)["failed"] == 1
+        row = s.exec(select(GCalOutbox)).one()
+        row.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        s.add(row); s.commit()
+        assert outbox.drain_outbox(s)["done"] == 1
+        assert s.get(ReservationDB, res_id).google_event_id == gcal.reservation_event_id(res_id)
+    assert len(_events()) == 1
+
+
+def test_background_work_runs_in_a_single_process(app_client, db_engine):
+    from app.services.worker_lease import LeaderLease
+
+    # Dos workers de uvicorn: sólo uno consigue el plazo y el otro no drena.
+    first, second = LeaderLease(db_engine, ttl_s=60), LeaderLease(db_engine, ttl_s=60)
+    assert first.renew() and first.held
+    assert not second.renew() and not second.held
+    _book(app_client)
+    follower = outbox.OutboxWorker(db_engine, poll_s=0.01, lease=second)
+    follower.start()
+    time.sleep(0.1)
+    follower.stop()
+    assert app_client.get("/admin/outbox", headers=HEADERS).json()["pending"] == 1
+
+    # Al apagarse el primero lo libera y el otro toma el relevo sin esperar al vencimiento.
+    first.stop()
+    assert second.renew() and not first.renew()
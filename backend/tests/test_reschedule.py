@@ -28,3 +28,22 @@ def test_reschedule_flow(app_client, monkeypatch):
     assert r2.status_code == 200
     assert r2.json()["ok"] is True
     assert "Reprogramada" in r2.json()["message"]
+
+
+def test_reschedule_synced_reservation_overlapping_its_own_event(app_client):
+    from datetime import datetime
+    import app.integrations.google_calendar as gcal
+
+    target = date.today() + timedelta(days=32)
+    while target.weekday() == 6:
+        target += timedelta(days=1)
+    slots = app_client.post("/slots", json={"service_id": "corte", "date_str": target.isoformat(), "professional_id": "ana"}).json()["slots"]
+    r = app_client.post("/reservations", headers={"X-API-Key": API_KEY}, json={"service_id": "corte", "professional_id": "ana", "start": slots[0]})
+    res_id = r.json()["message"].split("ID: ")[1].split(",")[0]
+    # Con el evento ya en Google (simulador con estado), el freebusy de ana incluye la propia reserva.
+    app_client.post("/admin/outbox/drain", headers={"X-API-Key": API_KEY})
+    assert len(gcal.build_calendar()._events_store) == 1
+
+    new_start = (datetime.fromisoformat(slots[0]) + timedelta(minutes=15)).isoformat()
+    r2 = app_client.post("/reservations/reschedule", headers={"X-API-Key": API_KEY}, json={"reservation_id": res_id, "new_start": new_start})
+    assert r2.status_code == 200 and r2.json()["ok"] is True
@@ -0,0 +1,208 @@
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from sqlmodel import Session
+
+from app.models import ReservationDB
+from app.services.logic import TZ, find_available_slots
+
+
+def _add_reservations(engine, on_date: date, pro_id: str, hours: list[int]) -> None:
+    with Session(engine) as s:
+        for h in hours:
+            start = datetime.combine(on_date, time(h, 0))
+            s.add(ReservationDB(id=f"r-{pro_id}-{h}", service_id="corte", professional_id=pro_id, start=start, end=start + timedelta(minutes=30)))
+        s.commit()
+
+
+def test_find_available_slots_single_query(db_engine, query_counter, next_workday):
+    target = next_workday()
+    _add_reservations(db_engine, target, "ana", [10, 12, 17])
+    _add_reservations(db_engine, target, "luis", [10, 11])
+    query_counter.clear()
+    with Session(db_engine) as s:
+        slots = find_available_slots(s, "corte", target, use_gcal_busy_override=False)
+    # Una consulta para todos los profesionales, independientemente del número de candidatos.
+    assert len(query_counter) == 1
+    # A las 10:00 ambos están ocupados; a las 11:00 Ana sigue libre.
+    assert datetime.combine(target, time(10, 0)) not in slots
+    assert datetime.combine(target, time(11, 0)) in slots
+
+
+def test_slots_endpoint_respects_overlaps(db_engine, query_counter, app_client, next_workday):
+    target = next_workday()
+    _add_reservations(db_engine, target, "ana", [10])
+    query_counter.clear()
+    r = app_client.post("/slots", json={"service_id": "corte", "date_str": target.isoformat(), "professional_id": "ana", "use_gcal": False})
+    assert r.status_code == 200
+    assert len(query_counter) == 1
+    slots = r.json()["slots"]
+    assert datetime.combine(target, time(10, 0)).isoformat() not in slots
+    assert datetime.combine(target, time(10, 15)).isoformat() not in slots
+    assert datetime.combine(target, time(10, 30)).isoformat() in slots
+
+
+def test_occupancy_matches_interval_scan(next_workday):
+    import random
+    from app.data import WEEKLY_SCHEDULE
+    from app.services.occupancy import DayOccupancy, iter_bits
+    from app.services.slot_grid import start_grids
+
+    rnd = random.Random(7)
+    day = next_workday()
+    ranges = WEEKLY_SCHEDULE[day.weekday()]
+    for _ in range(50):
+        busy = []
+        for _ in range(rnd.randint(0, 8)):
+            s = datetime.combine(day, time(9, 0)) + timedelta(minutes=rnd.randint(0, 12 * 60))
+            busy.append((s, s + timedelta(minutes=rnd.randint(1, 120))))
+        for duration in (20, 30, 90):
+            grid = start_grids.get(duration, day.weekday(), 15)
+            occ = DayOccupancy(day, ranges).mark_busy_many(busy)
+            base = datetime.combine(day, time(0, 0))
+            got = [base + timedelta(minutes=c * occ.grid) for c in iter_bits(grid.mask & occ.free_starts(duration))]
+            expected = []
+            for start_t, end_t in ranges:
+                cur = datetime.combine(day, start_t)
+                while cur + timedelta(minutes=duration) <= datetime.combine(day, end_t):
+                    end = cur + timedelta(minutes=duration)
+                    if not any(not (end <= bs or cur >= be) for bs, be in busy):
+                        expected.append(cur)
+                    cur += timedelta(minutes=15)
+            assert got == expected
+
+
+def test_days_availability_single_freebusy_call(db_engine, query_counter, app_client, monkeypatch, next_workday):
+    import app.integrations.google_calendar as gcal
+
+    calls = []
+    real = gcal.freebusy_multi
+
+    def counting(*args, **kwargs):
+        calls.append(args[1:4])
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(gcal, "freebusy_multi", counting)
+    start = next_workday()
+    # Día completo para Ana en tinte (90 min): no debe aparecer como disponible.
+    with Session(db_engine) as s:
+        s.add(ReservationDB(id="full-1", service_id="tinte", professional_id="ana", start=datetime.combine(start, time(10, 0)), end=datetime.combine(start, time(20, 0))))
+        s.commit()
+    end = start + timedelta(days=27)
+    query_counter.clear()
+    r = app_client.post("/slots/days", json={"service_id": "tinte", "start": start.isoformat(), "end": end.isoformat(), "professional_id": "ana", "use_gcal": True})
+    assert r.status_code == 200
+    days = r.json()["available_days"]
+    assert len(calls) == 1
+    assert len(query_counter) == 1
+    assert start.isoformat() not in days
+    with Session(db_engine) as s:
+        expected = [d.isoformat() for d in (start + timedelta(days=i) for i in range(28)) if find_available_slots(s, "tinte", d, "ana", use_gcal_busy_override=False)]
+    assert days == expected
+
+
+def test_start_grid_rebuilds_after_invalidate(monkeypatch, next_workday):
+    from app.data import WEEKLY_SCHEDULE
+    from app.services.logic import _fits_in_schedule
+    from app.services.slot_grid import start_grids
+
+    day = next_workday()
+    grid = start_grids.get(30, day.weekday(), 15)
+    assert grid.offsets[0] == 10 * 60 and grid.offsets[-1] == 19 * 60 + 30
+    assert _fits_in_schedule(datetime.combine(day, time(13, 30)), 30)
+    assert not _fits_in_schedule(datetime.combine(day, time(13, 31)), 30)
+
+    monkeypatch.setitem(WEEKLY_SCHEDULE, day.weekday(), [(time(9, 0), time(10, 0))])
+    assert start_grids.get(30, day.weekday(), 15) is grid
+    start_grids.invalidate()
+    assert start_grids.get(30, day.weekday(), 15).offsets == (540, 555, 570)
+    assert _fits_in_schedule(datetime.combine(day, time(9, 30)), 30)
+    assert not _fits_in_schedule(datetime.combine(day, time(13, 0)), 30)
+
+
+def test_next_slots_stops_early(db_engine, app_client, query_counter, next_workday):
+    target = next_workday()
+    with Session(db_engine) as s:
+        # Luis ocupado toda la mañana del día objetivo.
+        s.add(ReservationDB(id="busy-am", service_id="corte", professional_id="luis", start=datetime.combine(target, time(10, 0)), end=datetime.combine(target, time(14, 0))))
+        s.commit()
+    after = datetime.combine(target, time(8, 0), tzinfo=ZoneInfo(TZ)).isoformat()
+    query_counter.clear()
+    r = app_client.post("/slots/next", json={"service_id": "corte", "professional_id": "luis", "after": after, "limit": 3, "use_gcal": False})
+    assert r.status_code == 200, r.text
+    slots = r.json()["slots"]
+    assert slots == [datetime.combine(target, time(16, m)).isoformat() for m in (0, 15, 30)]
+    # El primer bloque (un día) ya basta: una única consulta.
+    assert len(query_counter) == 1
+
+    r = app_client.post("/slots/next", json={"service_id": "corte", "limit": 0})
+    assert r.status_code == 422
+
+
+def test_slots_report_free_professionals_and_point_check(db_engine, app_client, query_counter, next_workday, api_headers):
+    from app.services.logic import is_start_available
+
+    target = next_workday()
+    _add_reservations(db_engine, target, "ana", [10])
+    r = app_client.post("/slots", json={"service_id": "corte", "date_str": target.isoformat(), "use_gcal": False})
+    body = r.json()
+    ten = datetime.combine(target, time(10, 0)).isoformat()
+    eleven = datetime.combine(target, time(11, 0)).isoformat()
+    assert body["free_professionals"][ten] == ["luis"]
+    assert body["free_professionals"][eleven] == ["ana", "luis"]
+
+    with Session(db_engine) as s:
+        assert not is_start_available(s, "corte", "ana", datetime.combine(target, time(10, 15)), use_gcal_busy_override=False)
+        assert is_start_available(s, "corte", "ana", datetime.combine(target, time(10, 15)), exclude_reservation_id="r-ana-10", use_gcal_busy_override=False)
+        # Fuera de la rejilla de 15 minutos o fuera de horario.
+        assert not is_start_available(s, "corte", "luis", datetime.combine(target, time(11, 5)))
+        assert not is_start_available(s, "corte", "luis", datetime.combine(target, time(13, 45)))
+
+    # El camino de escritura ya no recalcula el día: una consulta de solape y el INSERT.
+    query_counter.clear()
+    r = app_client.post("/reservations", headers=api_headers, json={"service_id": "corte", "professional_id": "luis", "start": ten})
+    assert r.status_code == 200
+    assert len(query_counter) == 1
+
+
+def test_slots_batch_shares_one_load(db_engine, app_client, query_counter, monkeypatch, next_workday):
+    import app.integrations.google_calendar as gcal
+
+    calls = []
+    real = gcal.freebusy_multi
+    monkeypatch.setattr(gcal, "freebusy_multi", lambda *a, **k: calls.append(a[1]) or real(*a, **k))
+    d1 = next_workday()
+    d2 = next_workday(40)
+    _add_reservations(db_engine, d1, "ana", [10])
+    queries = [
+        {"service_id": "corte", "date_str": d1.isoformat(), "professional_id": "ana"},
+        {"service_id": "tinte", "date_str": d2.isoformat()},
+        {"service_id": "barba", "date_str": d2.isoformat(), "professional_id": "luis"},
+        {"service_id": "corte", "date_str": "2024-01-01"},
+    ]
+    query_counter.clear()
+    r = app_client.post("/slots/batch", json={"queries": queries})
+    assert r.status_code == 200, r.text
+    results = r.json()["results"]
+    assert len(query_counter) == 1 and len(calls) == 1
+    assert "pasado" in results[3]["error"].lower()
+    for q, res in zip(queries[:3], results[:3]):
+        single = app_client.post("/slots", json=q).json()
+        assert res["slots"] == single["slots"] and res["error"] is None
+    assert datetime.combine(d1, time(10, 0)).isoformat() not in results[0]["slots"]
+
+
+def test_point_check_reads_freebusy_uncached(db_engine, next_workday):
+    from app.data import PRO_CALENDAR
+    from app.integrations.google_calendar import build_calendar, _event_body
+    from app.services.logic import _load_gcal_busy, is_start_available
+
+    target = next_workday()
+    start = datetime.combine(target, time(10, 0))
+    end = start + timedelta(minutes=30)
+    assert _load_gcal_busy(["ana"], start, end) == {"ana": []}
+    # Evento creado fuera de la app: la caché de freebusy no se entera.
+    build_calendar().events().insert(calendarId=PRO_CALENDAR["ana"], body=_event_body(start, end, "Europe/Madrid", summary="Médico")).execute()
+    assert _load_gcal_busy(["ana"], start, end) == {"ana": []}
+    with Session(db_engine) as s:
+        assert not is_start_available(s, "corte", "ana", start)